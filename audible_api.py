@@ -1,23 +1,26 @@
 import os
 import json
-import sys
 import asyncio
-import requests
+import importlib.util
 from getpass import getpass
 import webbrowser
 import io
 from datetime import datetime
 
-import pandas as pd
-import pandas.io.formats.excel
-import audible
-import httpx
 
-from pydub import AudioSegment
-
-import speech_recognition as sr
 
 from errors import ExternalError
+from clips import clip_window, extract_clips, CLIP_WORKERS
+from downloader import DownloadManager, DOWNLOAD_SEGMENTS, DOWNLOAD_WORKERS
+from library_cache import LibraryCache
+from ffmpeg_runner import FFmpegRunner, FFMPEG_TIMEOUT, FFMPEG_WORKERS, probe_duration
+from ratelimit import HostRateLimiter
+from sync_state import SyncState, record_key, SYNC_STATE_FILE_NAME
+from clip_cache import ClipCache, clip_key
+from transcription import TranscriptionPool, get_backend, pcm_loader, DEFAULT_TRANSCRIPTION_BACKEND, TRANSCRIPTION_WORKERS
+from excel_export import TranscriptionWorkbook
+from metrics import span
+from pipeline import Pipeline, Stage
 from constants import artifacts_root_directory
 
 # not currently in use, but so the user can choose their store
@@ -42,12 +45,54 @@ AUDIBLE_URL_BASE = "https://www.audible"
 START_POSITION_OFFSET = 10000
 END_POSITION_OFFSET = 0
 
+# How many requests to the Audible API can be in flight at once during bulk commands
+API_CONCURRENCY = 10
+
+# Connection pool limits for the session wide HTTP clients, see AudibleAPI.get_client
+HTTP_MAX_CONNECTIONS = 32
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 16
+
+# HTTP/2 is only negotiated when the optional h2 package is installed (pip install httpx[http2])
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+# How many sidecars (bookmarks) are fetched at once, and how many requests per second one host gets at most
+SIDECAR_CONCURRENCY = 8
+HOST_RATE_LIMIT = 10
+
+# The library endpoint returns at most 1000 items per page, pages after the first are fetched this many at a time
+LIBRARY_PAGE_SIZE = 1000
+LIBRARY_PAGE_CONCURRENCY = 4
+
+# Without response groups library items only have an asin and a title, contributors brings the authors
+LIBRARY_RESPONSE_GROUPS = "contributors, product_desc, product_attrs"
+
+
+# Command kwargs arrive as strings, i.e --mp3=true
+def is_enabled(value):
+    return str(value).lower() in ["true", "yes", "1"]
+
 class AudibleAPI:
 
-    def __init__(self, auth):
+    def __init__(self, auth, max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS):
         self.auth = auth
         self.books = []
         self.library = {}
+        self.library_cache = None
+        self.clip_cache = None
+        # One pool of keep-alive connections shared by every request this session makes, see get_client
+        self.max_connections = int(max_connections)
+        self.max_keepalive_connections = int(max_keepalive_connections)
+        self._client = None
+        self._http_client = None
+        self.rate_limiter = HostRateLimiter(HOST_RATE_LIMIT)
+        # Caps how many Audible API requests a bulk command has in flight at once
+        self.api_semaphore = asyncio.Semaphore(API_CONCURRENCY)
+
+    # Loads stored credentials, audible is only imported once a command needs Audible
+    @classmethod
+    def from_file(cls, credentials_path, **kwargs) -> "AudibleAPI":
+        import audible
+        return cls(audible.Authenticator.from_file(credentials_path), **kwargs)
 
     @classmethod
     async def authenticate(cls) -> "AudibleAPI":
@@ -68,6 +113,7 @@ class AudibleAPI:
     @classmethod
     async def _authenticate_with_browser_assistance(cls, secrets_dir_path, credentials_path):
         """Enhanced authentication with browser assistance for 2FA issues"""
+        import audible
         print("=== Enhanced Authentication Process ===")
         print("If you're having trouble with 2FA codes, try this process:")
         print("1. First, log into Amazon.com in your browser to verify your account is working")
@@ -328,11 +374,49 @@ class AudibleAPI:
             
             return None
 
+    @property
+    def http_limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive_connections)
+
+    # Signed Audible API client shared by every call, requests to absolute urls like the sidecar go through it as well
+    def get_client(self):
+        if self._client is None:
+            import audible
+            self._client = audible.AsyncClient(self.auth, limits=self.http_limits, http2=HTTP2_AVAILABLE)
+        return self._client
+
+    # Plain client for the unsigned CDN downloads, shares the same pool limits
+    def get_http_client(self):
+        if self._http_client is None:
+            import httpx
+            self._http_client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(30.0, read=120.0),
+                limits=self.http_limits,
+                http2=HTTP2_AVAILABLE)
+        return self._http_client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        if self._http_client is not None:
+            await self._http_client.aclose()
+            self._http_client = None
+
     # Gets information about a book
     async def get_book_infos(self, asin):
-        async with audible.AsyncClient(self.auth) as client:
-            try:                
-                book = await client.get(
+        cached_book = self.get_library_cache().get_book_info(asin)
+        if cached_book:
+            return cached_book
+
+        try:
+            # download_books asks for every book at once, waiting for a pooled connection longer than
+            # audible's timeout would drop the book with a NotResponding error
+            async with self.api_semaphore:
+                book = await self.get_client().get(
                     path=f"library/{asin}",
                     params={
                         "response_groups": (
@@ -345,16 +429,22 @@ class AudibleAPI:
                         )
                     }
                 )
-                return book
-            except Exception as e:
-                print(e)
+            self.get_library_cache().set_book_info(asin, book)
+            return book
+        except Exception as e:
+            print(e)
 
     # Helper function for displaying the users books and allowing them to select one based on the index number
-    async def get_book_selection(self):
+    # books selects them without asking, see select_books
+    async def get_book_selection(self, books=None):
 
-        if not self.library:
+        # A long running session (i.e the daemon) picks up new purchases once the library cache goes stale
+        if not self.library or not self.get_library_cache().is_fresh():
             await self.get_library()
 
+        if books is not None:
+            return self.select_books(books)
+
         li_books = []
         # if not self.lib
         for index, book in enumerate(self.library["items"]):
@@ -366,20 +456,55 @@ class AudibleAPI:
             "Enter the index number of the book you would like to download, or press ENTER for all available books: \n")
 
         if book_selection == "" or book_selection == "--all":
-            li_books = [{"title": book.get("title", 'untitled'), "asin": book["asin"]}
-                        for book in self.library["items"]]
+            li_books = [self.selected_book(book) for book in self.library["items"]]
 
         else:
             try:
-                li_books = [{"title": self.library["items"][int(book_selection)].get("title", 'untitled'),
-                             "asin": self.library["items"][int(book_selection)].get("asin", None)}]
+                li_books = [self.selected_book(self.library["items"][int(book_selection)])]
             except (IndexError, ValueError):
                 print("Invalid selection")                
         return li_books
 
+    # Picks books from the library without prompting, for scripted runs. selection is "all", ASINs separated by
+    # commas (or a list of them), or title:<text> / author:<text> to match part of a title or an author name
+    def select_books(self, selection):
+        items = self.library["items"]
+        if isinstance(selection, str):
+            selection = selection.strip()
+            if selection.lower() in ["", "all", "--all"]:
+                selected = items
+            elif selection.lower().startswith(("title:", "author:")):
+                field, text = selection.split(":", 1)
+                selected = [book for book in items if text.strip().lower() in self.book_field(book, field.lower())]
+            else:
+                selection = [asin.strip() for asin in selection.split(",") if asin.strip()]
+
+        if isinstance(selection, list):
+            by_asin = {book["asin"]: book for book in items}
+            for asin in selection:
+                if asin not in by_asin:
+                    ExternalError(self.select_books, asin, "not in the library").show_error()
+            selected = [by_asin[asin] for asin in selection if asin in by_asin]
+
+        return [self.selected_book(book) for book in selected]
+
+    # What the commands get for a picked library item, the authors go along so exports can credit them
+    @staticmethod
+    def selected_book(book):
+        return {"title": book.get("title", 'untitled'), "asin": book.get("asin"), "authors": book.get("authors") or []}
+
+    def book_field(self, book, field):
+        if field == "author":
+            return ", ".join(author.get("name", "") for author in book.get("authors") or []).lower()
+        return (book.get("title") or "").lower()
+
     # Main download books function
-    async def cmd_download_books(self):
-        li_books = await self.get_book_selection()
+    # With --decrypt=true every book is decrypted while it downloads, the .aax is only kept with --keep_aax=true
+    # --verify=true checks the checksum of books downloaded before instead of only their size
+    async def cmd_download_books(self, workers=DOWNLOAD_WORKERS, segments=DOWNLOAD_SEGMENTS, books=None,
+                                 decrypt="false", keep_aax="false", verify="false"):
+        li_books = await self.get_book_selection(books)
+        activation_bytes = self.get_activation_bytes() if is_enabled(decrypt) else None
 
         tasks = []
         for book in li_books:
@@ -389,62 +514,65 @@ class AudibleAPI:
                         book.get("asin"))))
 
         books = await asyncio.gather(*tasks)
+        books = [book for book in books if book is not None]
+        self.get_library_cache().save()
+
+        async with DownloadManager(workers=workers, segments=segments, client=self.get_http_client(),
+                                   verify=is_enabled(verify)) as manager:
+            results = await asyncio.gather(
+                *[self.download_book(book["item"], manager, activation_bytes, is_enabled(keep_aax))
+                  for book in books],
+                return_exceptions=True)
+
+        for book, result in zip(books, results):
+            if isinstance(result, Exception):
+                ExternalError(self.download_book, book["item"]["asin"], result).show_error()
+
+    # Resolves the download link and downloads a single book, many of these run at once through the manager
+    # Returns False when Audible doesn't let the book be downloaded
+    # Given activation bytes, the book is decrypted to .m4b as it arrives and the .aax is only written with keep_aax
+    async def download_book(self, item, manager, activation_bytes=None, keep_aax=False):
+        import audible
+        print(item["title"])
+        asin = item["asin"]
+        raw_title = item["title"]
+        title = raw_title.lower().replace(" ", "_")
+
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        title_file_path = os.path.join(title_dir_path, f"{title}.aax")
+        title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
+        if activation_bytes and os.path.exists(title_m4b_path):
+            print(f"{raw_title} is already decrypted, skipping")
+            return True
+        if await manager.is_downloaded(title_file_path):
+            message = ", run convert_audiobook to decrypt it" if activation_bytes else ""
+            print(f"{raw_title} is already downloaded, skipping{message}")
+            return True
 
-        all_books = {}
-
-        for book in books:
-            if book is not None:
-                print(book["item"]["title"])
-                asin = book["item"]["asin"]
-                raw_title = book["item"]["title"]
-                title = raw_title.lower().replace(" ", "_")
-                all_books[asin] = title
-
-                # Attempt to download book
-                try:
-                    re = self.get_download_url(self.generate_url(self.auth.locale.country_code, "download", asin), num_results=1000, response_groups="product_desc, product_attrs")
-
-                # Audible API throws error, usually for free books that are not allowed to be downloaded, we skip to the next
-                except audible.exceptions.NetworkError as e:
-                    ExternalError(self.get_download_url,
-                                  asin, e).show_error()
-                    continue
-
-                audible_response = requests.get(re, stream=True)
+        # The manager asks for the link once it has a free slot for the book, the signed link expires
+        async def resolve_download_url():
+            async with self.api_semaphore:
+                with span("download_url", asin=asin):
+                    download_url = await self.get_download_url(self.generate_url(self.auth.locale.country_code, "download", asin), num_results=1000, response_groups="product_desc, product_attrs")
+            os.makedirs(title_dir_path, exist_ok=True)
+            return download_url
 
-                title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-                path_exists = os.path.exists(title_dir_path)
-                if not path_exists:
-                    os.makedirs(title_dir_path)
-                    
-
-                if audible_response.ok:
-                    title_file_path = os.path.join(title_dir_path, f"{title}.aax")
-                    with open(title_file_path, 'wb') as f:
-                        print("Downloading %s" % raw_title)
+        # Attempt to download book
+        try:
+            if activation_bytes:
+                await manager.download_decrypted(resolve_download_url, title_m4b_path, raw_title, activation_bytes,
+                                                 aax_path=title_file_path if keep_aax else None)
+            else:
+                await manager.download(resolve_download_url, title_file_path, raw_title)
 
-                        total_length = audible_response.headers.get(
-                            'content-length')
+        # Audible API throws error, usually for free books that are not allowed to be downloaded, we skip to the next
+        except audible.exceptions.NetworkError as e:
+            ExternalError(self.get_download_url,
+                          asin, e).show_error()
+            return False
 
-                        if total_length is None:  # no content length header
-                            print(
-                                "Unable to estimate download size, downloading, this might take a while...")
-                            f.write(audible_response.content)
-                        else:
-                            # Save book locally and calculate and print download progress (progress bar)
-                            dl = 0
-                            total_length = int(total_length)
-                            for data in audible_response.iter_content(chunk_size=1024*1024):
-                                dl += len(data)
-                                f.write(data)
-                                done = int(50 * dl / total_length)
-                                sys.stdout.write("\r[%s%s]" % ('=' * done, ' ' * (50-done)))
-
-                                sys.stdout.write(f"   {int(dl / total_length * 100)}%")
-                                sys.stdout.flush()
-
-                else:
-                    print(audible_response.text)
+        print(f"Finished downloading {raw_title}")
+        return True
 
     # WIP
     def generate_url(self, country_code, url_type, asin=None):
@@ -456,54 +584,359 @@ class AudibleAPI:
         return resp.next_request
 
     # Sends a request to get the download link for the selected book
-    def get_download_url(self, url, **kwargs):
+    async def get_download_url(self, url, **kwargs):
+
+        library = await self.get_client().get(
+            url,
+            response_callback=self.get_download_link_callback,
+            **kwargs
+        )
+        return library.url
+
+    async def cmd_list_books(self, refresh="false"):
+        await self.cmd_show_library(refresh=refresh)
+
+    def get_clip_cache(self):
+        if self.clip_cache is None:
+            self.clip_cache = ClipCache()
+        return self.clip_cache
+
+    # Lazily opens the on-disk library cache for the authenticated account and store
+    def get_library_cache(self):
+        if self.library_cache is None:
+            customer_info = getattr(self.auth, "customer_info", None) or {}
+            account = customer_info.get("user_id", "default")
+            self.library_cache = LibraryCache(account, self.auth.locale.country_code)
+        return self.library_cache
+
+    # Gets all books and info for account and adds it to self.books, also returns ASIN for all books
+    # Served from the library cache while it is fresh, then only the items purchased since the last sync are fetched
+    # on_items is called with every page of items as soon as it is added to self.library
+    async def get_library(self, refresh=False, on_items=None):
+        cache = self.get_library_cache()
+
+        # A cache filled before the items had their authors is synced again in full
+        if refresh or not cache.synced_at_iso or cache.response_groups != LIBRARY_RESPONSE_GROUPS:
+            # Fill the in-memory library page by page so it can be used before the last page lands
+            self.library = {"items": []}
+            self.books = []
+            async for items in self.iter_library_pages():
+                self.library["items"].extend(items)
+                self.books.extend(book.get("title", "Unable to retrieve book name") for book in items)
+                if on_items:
+                    on_items(items)
+            cache.replace_items(self.library["items"], LIBRARY_RESPONSE_GROUPS)
+            cache.save()
+            return [book["asin"] for book in cache.items]
+
+        if not cache.is_fresh():
+            cache.merge_items(await self.fetch_library_items(purchased_after=cache.synced_at_iso))
+            cache.save()
+
+        self.library = {"items": cache.items}
+        self.books = [book.get("title", "Unable to retrieve book name") for book in cache.items]
+        if on_items:
+            on_items(cache.items)
+
+        return [book["asin"] for book in cache.items]
+
+    async def fetch_library_items(self, **params):
+        items = []
+        async for page_items in self.iter_library_pages(**params):
+            items.extend(page_items)
+        return items
+
+    # Yields the library one page at a time in library order, once the first page tells us the total count
+    # the remaining pages are all requested at once, bounded by LIBRARY_PAGE_CONCURRENCY
+    async def iter_library_pages(self, **params):
+        semaphore = asyncio.Semaphore(LIBRARY_PAGE_CONCURRENCY)
+
+        async def fetch_page(page):
+            async with semaphore:
+                with span("library_fetch", page=page) as page_span:
+                    response = await self.get_client().get(
+                        path="library",
+                        response_callback=self.bookmark_response_callback,
+                        params={
+                            "num_results": LIBRARY_PAGE_SIZE,
+                            "page": page,
+                            "response_groups": LIBRARY_RESPONSE_GROUPS,
+                            **params
+                        }
+                    )
+                    response.raise_for_status()
+                    items = response.json().get("items", [])
+                    page_span.add(bytes=len(response.content), items=len(items))
+                    return response, items
+
+        response, items = await fetch_page(1)
+        yield items
+
+        total_count = response.headers.get("total-count")
+        if total_count is not None:
+            total_pages = -(-int(total_count) // LIBRARY_PAGE_SIZE)
+            tasks = [asyncio.ensure_future(fetch_page(page)) for page in range(2, total_pages + 1)]
+            try:
+                for task in tasks:
+                    yield (await task)[1]
+            finally:
+                for task in tasks:
+                    task.cancel()
+        else:
+            # No total count, keep paging until a page comes back short
+            page = 1
+            while len(items) == LIBRARY_PAGE_SIZE:
+                page += 1
+                _, items = await fetch_page(page)
+                yield items
+
+    async def cmd_new_books(self):
+        cache = self.get_library_cache()
+        if cache.synced_at_iso:
+            cache.merge_items(await self.fetch_library_items(purchased_after=cache.synced_at_iso))
+        await self.get_library()
+
+        new_items = cache.pop_new_items()
+        cache.save()
+        if not new_items:
+            print("No new books since new_books was last run")
+        for book in new_items:
+            print(book.get("title", "Unable to retrieve book name"))
+
+    async def cmd_show_library(self, refresh="false"):
+        refresh = is_enabled(refresh)
+        if self.books and not refresh:
+            for index, book_title in enumerate(self.books):
+                print(f"{index}: {book_title}")
+            return
+
+        # Print every page as soon as it arrives instead of waiting for the whole library
+        index = 0
+
+        def print_items(items):
+            nonlocal index
+            for book in items:
+                print(f"{index}: {book.get('title', 'Unable to retrieve book name')}")
+                index += 1
+
+        await self.get_library(refresh=refresh, on_items=print_items)
+   
 
-        with audible.Client(auth=self.auth, response_callback=self.get_download_link_callback) as client:
-            library = client.get(
-                url,
-                **kwargs
+    async def cmd_get_bookmarks(self, books=None):
+        li_books = await self.get_book_selection(books)
+
+        # Fetch every sidecar at once, then slice the books one after another, slicing already uses every core
+        li_results = await self.fetch_sidecars([book.get("asin") for book in li_books])
+
+        for book, records in zip(li_books, li_results):
+            if isinstance(records, Exception):
+                ExternalError(self.fetch_sidecar, book.get("asin"), records).show_error()
+                continue
+            await self.get_bookmarks(book, records=records)
+
+        self.get_clip_cache().report()
+
+    # Fetches the sidecars of many books concurrently, at most `concurrency` at a time and rate limited per host
+    # Returns the records (or the exception for that book) in the order of asins
+    async def fetch_sidecars(self, asins, concurrency=SIDECAR_CONCURRENCY):
+        semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+
+        async def fetch(asin):
+            async with semaphore:
+                return await self.fetch_sidecar(asin)
+
+        return await asyncio.gather(*[fetch(asin) for asin in asins], return_exceptions=True)
+
+    # Fetches the bookmark, clip and note records Audible keeps for a book in the sidecar service
+    async def fetch_sidecar(self, asin):
+        bookmarks_url = f"https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar?type=AUDI&key={asin}"
+        await self.rate_limiter.wait(bookmarks_url)
+        with span("bookmark_fetch", asin=asin) as fetch_span:
+            library = await self.get_client().get(
+                bookmarks_url,
+                response_callback=self.bookmark_response_callback,
+                num_results=1000,
+                response_groups="product_desc, product_attrs"
             )
-            return library.url
+            records = library.json().get("payload", {}).get("records", [])
+            fetch_span.add(bytes=len(library.content), items=len(records))
+        return records
+
+    # Slices the clips for a book, records are the sidecar records when the caller already fetched them
+    async def get_bookmarks(self, book, records=None):
+        plan = await self.plan_bookmarks(book, records)
+        if not plan:
+            return None
 
-    async def cmd_list_books(self):
-        if not self.books:
-            await self.cmd_show_library()
+        plan["failed"] = await self.slice_clip_files(plan, plan["to_slice"])
 
-        await self.cmd_show_library()
+        state = plan["state"]
+        state.remove_untracked_clips()
+        if plan["removed"]:
+            state.write_contents()
+        state.save()
+        return plan
+
+    # Works out which clips of a book are new or changed since the last run, removes the ones deleted on Audible
+    # require_files=False is for in-memory transcription, where transcribed records don't need a clip file
+    async def plan_bookmarks(self, book, records=None, require_files=True):
+        asin = book.get("asin")
+        # Handle both string and nested dictionary formats for title
+        title_value = book.get("title", {})
+        if isinstance(title_value, str):
+            _title = title_value
+        else:
+            _title = title_value.get("title", "untitled")
         
-    # Gets all books and info for account and adds it to self.books, also returns ASIN for all books
-    async def get_library(self):
-        async with audible.AsyncClient(self.auth) as client:
-            self.library = await client.get(
-                path="library",
-                params={
-                    "num_results": 999
-                }
-            )
-            asins = [book["asin"] for book in self.library["items"]]
+        if not _title:
+            return None
 
-            for book in self.library["items"]:
-                asins.append(book["asin"])
-                book_title = book.get("title", "Unable to retrieve book name")
-                self.books.append(book_title)
+        title = _title.lower().replace(" ", "_")
 
-            return asins
+        if records is None:
+            print(f"Getting bookmarks for {_title}")
+            records = await self.fetch_sidecar(asin)
+        li_bookmarks = records
+        li_clips = sorted(
+            li_bookmarks, key=lambda i: i["type"], reverse=True)
+
+        source_path, input_args = self.get_clip_source(title)
+        if not source_path:
+            ExternalError(self.get_bookmarks, asin,
+                          f"No audio found for {_title}, run download_books first").show_error()
+            return None
 
-    async def cmd_show_library(self):
-        if not self.books:
-            await self.get_library()
+        notes_dict = {}
+        clips = {}
+
+        # Check whether a folder in clips/ for the book exists or not
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        clips_dir_path = os.path.join(title_dir_path, "clips")
+        path_exists = os.path.exists(clips_dir_path)
+        if not path_exists:
+            os.makedirs(clips_dir_path)
+
+        for audio_clip in li_clips:
+            # Get start position to slice
+            raw_start_pos = int(audio_clip["startPosition"])
+
+            # If we have a note then we save it so we can use it as the title for the bookmark text
+            if audio_clip.get("type", None) in ["audible.note"]:
+                notes_dict[raw_start_pos] = audio_clip.get("text")
+                print(
+                    f"CLIP: {notes_dict[raw_start_pos]}  {raw_start_pos}")
+
+            if audio_clip.get("type", None) in ["audible.clip", "audible.bookmark"]:
+                # File names are derived from the position so they stay the same between runs
+                note = notes_dict.get(raw_start_pos)
+                file_name = note or f"clip_{raw_start_pos}"
+                if f"{file_name}.flac" in {clip["clip"] for clip in clips.values()}:
+                    file_name = f"{file_name}_{raw_start_pos}"
+
+                window = clip_window(audio_clip, START_POSITION_OFFSET, END_POSITION_OFFSET)
+                clips[record_key(audio_clip)] = {
+                    "clip": f"{file_name}.flac",
+                    "window": window,
+                    "note": note,
+                    "cache_key": clip_key(asin, window, START_POSITION_OFFSET, END_POSITION_OFFSET, source_path)
+                }
 
-        for index, book_title in enumerate(self.books):
-            print(f"{index}: {book_title}")
-   
+        # Only slice the bookmarks added since the last run, and drop the ones deleted on Audible
+        state = SyncState(title_dir_path)
+        to_slice, removed = state.plan(clips, require_files=require_files)
+        state.remove_artifacts(removed)
+        print(f"{_title}: {len(to_slice)} new clips, {len(clips) - len(to_slice)} unchanged, {len(removed)} removed")
+
+        return {
+            "asin": asin,
+            "_title": _title,
+            "title": title,
+            "title_dir_path": title_dir_path,
+            "clips_dir_path": clips_dir_path,
+            "source_path": source_path,
+            "input_args": input_args,
+            "state": state,
+            "clips": clips,
+            "to_slice": to_slice,
+            "removed": removed
+        }
+
+    # Writes the FLAC files for the given clips of a planned book, returns how many clips couldn't be sliced
+    async def slice_clip_files(self, plan, keys):
+        clips = plan["clips"]
+        state = plan["state"]
+
+        # Clips already cut from the same audio with the same window come out of the clip cache
+        clip_cache = self.get_clip_cache()
+        clip_jobs = []
+        slice_keys = []
+        for key in keys:
+            clip = clips[key]
+            clip_path = os.path.join(plan["clips_dir_path"], clip["clip"])
+            if clip_cache.get_clip(clip["cache_key"], clip_path):
+                state.mark_sliced(key, clip)
+            else:
+                clip_jobs.append((*clip["window"], clip_path))
+                slice_keys.append(key)
+
+        # Seek to every clip window in the audiobook instead of loading the whole book into memory
+        with span("slice", asin=plan["asin"]) as slice_span:
+            clip_results = await asyncio.to_thread(extract_clips, plan["source_path"], clip_jobs,
+                                                   input_args=plan["input_args"])
+            failed = 0
+            for key, (clip_path, error) in zip(slice_keys, clip_results):
+                if error:
+                    ExternalError(self.get_bookmarks, plan["asin"], f"{clip_path}: {error}").show_error()
+                    failed += 1
+                else:
+                    state.mark_sliced(key, clips[key])
+                    clip_cache.put_clip(clips[key]["cache_key"], clip_path)
+                    slice_span.add(bytes=os.path.getsize(clip_path), items=1)
+            slice_span.ok = not failed
+
+        clip_cache.save()
+        return failed
+
+    # Picks the audio file clips are cut from, the decrypted .m4b if we have it, otherwise the .aax decrypted on the fly
+    # with the cached activation bytes, the .mp3 is only used for books converted before it became optional
+    def get_clip_source(self, title):
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
+        title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
+        title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
+
+        if os.path.exists(title_m4b_path):
+            return title_m4b_path, ()
+        if os.path.exists(title_aax_path):
+            return title_aax_path, ("-activation_bytes", self.get_activation_bytes())
+        if os.path.exists(title_mp3_path):
+            return title_mp3_path, ()
+        return None, ()
+
+    async def cmd_convert_audiobook(self, mp3="false", workers=FFMPEG_WORKERS, timeout=FFMPEG_TIMEOUT, books=None):
+        # FFMPEG needs to be installed for this step! see readme for more details
+        # Clips are cut straight from the .m4b, so the full .mp3 re-encode only runs when an archive is asked for
+        archive_mp3 = is_enabled(mp3)
+        li_books = await self.get_book_selection(books)
 
-    async def cmd_get_bookmarks(self):
-        li_books = await self.get_book_selection()
+        # Strips Audible DRM from the audiobooks, several books are converted at once by the runner
+        activation_bytes = self.get_activation_bytes()
+        jobs = []
 
         for book in li_books:
-            print(self.get_bookmarks(book))
+            job = await self.get_convert_job(book, activation_bytes, archive_mp3)
+            if job:
+                jobs.append(job)
+
+        runner = FFmpegRunner(workers=workers, timeout=timeout)
+        failures = await runner.run_all(jobs)
 
-    def get_bookmarks(self, book):
+        for asin, error in failures.items():
+            ExternalError(self.cmd_convert_audiobook, asin, error).show_error()
+        print(f"Converted {len(jobs) - len(failures)} of {len(jobs)} audiobooks")
+
+    # The (asin, label, steps, duration) FFmpegRunner job that converts a downloaded book, None when there's nothing to convert
+    async def get_convert_job(self, book, activation_bytes, archive_mp3=False):
         asin = book.get("asin")
         # Handle both string and nested dictionary formats for title
         title_value = book.get("title", {})
@@ -513,214 +946,345 @@ class AudibleAPI:
             _title = title_value.get("title", "untitled")
         
         if not _title:
+            return None
+
+        title = _title.replace(" ", "_").lower()
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
+        title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
+        title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
+
+        if not os.path.exists(title_aax_path):
+            ExternalError(self.cmd_convert_audiobook, asin,
+                          f"{title_aax_path} not found, run download_books first").show_error()
+            return None
+
+        steps = [("decrypt", ["-activation_bytes", activation_bytes, "-i", title_aax_path, "-c", "copy", title_m4b_path],
+                  title_m4b_path)]
+
+        # Converts audiobook to .mp3
+        if archive_mp3:
+            steps.append(("transcode", ["-i", title_m4b_path, "-vn", title_mp3_path], title_mp3_path))
+
+        try:
+            duration = await probe_duration(title_aax_path)
+        except FileNotFoundError:
+            # ffprobe isn't installed, the book is still converted, only without progress output
+            duration = None
+        return asin, _title, steps, duration
+
+    async def cmd_transcribe_bookmarks(self, workers=TRANSCRIPTION_WORKERS, backend=DEFAULT_TRANSCRIPTION_BACKEND,
+                                       books=None):
+        try:
+            transcription_backend = get_backend(backend)
+        except ValueError as e:
+            print(e)
             return
 
+        li_books = await self.get_book_selection(books)
+
+        prepared_books = []
+        jobs = []
+        for book in li_books:
+            title, state, book_jobs = self.prepare_transcription(book, transcription_backend)
+            prepared_books.append((title, state))
+            jobs.extend(book_jobs)
+
+        print(f"Transcribing {len(jobs)} clips with {transcription_backend.name}")
+        try:
+            await self.transcribe_clips(TranscriptionPool(transcription_backend, workers=workers), jobs)
+        finally:
+            transcription_backend.close()
+
+        self.write_transcriptions(prepared_books)
+
+    # Returns (title, sync state, jobs) for a book, jobs are the (state, entry, clip_path) of the clips to transcribe
+    def prepare_transcription(self, book, transcription_backend):
+        # Handle both string and nested dictionary formats for title
+        title_value = book.get("title", {})
+        if isinstance(title_value, str):
+            _title = title_value
+        else:
+            _title = title_value.get("title", "untitled")
+        
+        allAuthors = self.get_book_authors(book)
+
+        # Create new folder to store transcriptions
         title = _title.lower().replace(" ", "_")
+        title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+        clips_dir_path = os.path.join(title_dir_path, "clips")
+        directory = os.fsencode(clips_dir_path)
+
+        path_exists = os.path.exists(directory)
+        if not path_exists:
+            os.makedirs(directory)
+
+        transcribed_clips_dir_path = os.path.join(title_dir_path, "trancribed_clips")
+        trancribed_clips_path_exists = os.path.exists(transcribed_clips_dir_path)
+        if not trancribed_clips_path_exists:
+            os.makedirs(transcribed_clips_dir_path)
+
+        state = SyncState(title_dir_path)
+        state.set_book(_title, allAuthors)
+
+        # Only the clips sliced since the last run go to the recognizer
+        jobs = []
+        for key, entry in state.untranscribed():
+            clip_path = os.path.join(clips_dir_path, entry["clip"])
+            if not os.path.exists(clip_path) or self.use_cached_transcript(entry, transcription_backend):
+                continue
+            jobs.append((state, entry, clip_path))
 
-        bookmarks_url = f"https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar?type=AUDI&key={asin}"
-        print(f"Getting bookmarks for {_title}")
-        with audible.Client(auth=self.auth, response_callback=self.bookmark_response_callback) as client:
-            library = client.get(
-                bookmarks_url,
-                num_results=1000,
-                response_groups="product_desc, product_attrs"
-            )
+        return title, state, jobs
 
-            li_bookmarks = library.json().get("payload", {}).get("records", [])
-            li_clips = sorted(
-                li_bookmarks, key=lambda i: i["type"], reverse=True)
-
-            title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-            title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
-            title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
-            title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
-
-            # Load audiobook into AudioSegment so we can slice it
-            audio_book = AudioSegment.from_mp3(
-                title_mp3_path)
-
-            file_counter = 1
-            notes_dict = {}
-
-            # Check whether a folder in clips/ for the book exists or not
-            clips_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title, "clips")
-            path_exists = os.path.exists(clips_dir_path)
-            if not path_exists:
-                os.makedirs(clips_dir_path)
-
-            for audio_clip in li_clips:
-                # Get start position to slice
-                raw_start_pos = int(audio_clip["startPosition"])
-
-                # If we have a note then we save it so we can use it as the title for the bookmark text
-                if audio_clip.get("type", None) in ["audible.note"]:
-                    notes_dict[raw_start_pos] = audio_clip.get("text")
-                    print(
-                        f"CLIP: {notes_dict[raw_start_pos]}  {raw_start_pos}")
-
-                if audio_clip.get("type", None) in ["audible.clip", "audible.bookmark"]:
-                    start_pos = raw_start_pos - START_POSITION_OFFSET
-                    end_pos = int(audio_clip.get(
-                        "endPosition", raw_start_pos + 30000)) + END_POSITION_OFFSET
-                    if start_pos == end_pos:
-                        end_pos += 30000
-
-                    # Slice it up
-                    clip = audio_book[start_pos:end_pos]
-
-                    file_name = notes_dict.get(
-                        raw_start_pos, f"clip{file_counter}")
-
-                    # Save the clip
-                    clip_path = os.path.join(clips_dir_path, f"{file_name}.flac")
-                    clip.export(
-                        clip_path, format="flac")
-                    file_counter += 1
-
-    async def cmd_convert_audiobook(self):
-        # FFMPEG needs to be installed for this step! see readme for more details
-        li_books = await self.get_book_selection()
+    # Every clip of every selected book goes through one bounded worker pool, returns how many clips failed
+    # jobs are (state, entry, audio), audio is a clip path or a loader returning the clip's PCM
+    async def transcribe_clips(self, pool, jobs):
+        failures = 0
 
-        for book in li_books:
-            asin = book.get("asin")
-            # Handle both string and nested dictionary formats for title
-            title_value = book.get("title", {})
-            if isinstance(title_value, str):
-                _title = title_value
-            else:
-                _title = title_value.get("title", "untitled")
-            
-            if not _title:
+        def on_result(index, result):
+            nonlocal failures
+            state, entry, _ = jobs[index]
+            if isinstance(result, Exception):
+                print(f"Error while recognizing this clip {entry['clip']}: {result}")
+                failures += 1
                 return
 
-            title = _title.replace(" ", "_").lower()
-            # Strips Audible DRM  from audiobook
-            activation_bytes = self.get_activation_bytes()
-            title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-            title_aax_path = os.path.join(title_dir_path, f"{title}.aax")
-            title_m4b_path = os.path.join(title_dir_path, f"{title}.m4b")
-            title_mp3_path = os.path.join(title_dir_path, f"{title}.mp3")
-            os.system(
-                f"ffmpeg -activation_bytes {activation_bytes} -i {title_aax_path} -c copy {title_m4b_path}")
+            print(entry["clip"])
+            self.record_transcript(state, entry, pool.backend, result)
 
-            # Converts audiobook to .mp3
-            os.system(
-                f"ffmpeg -i {title_m4b_path} {title_mp3_path}")
+        try:
+            await pool.run([audio for _, _, audio in jobs], on_result)
+        finally:
+            for state in {id(state): state for state, _, _ in jobs}.values():
+                state.save()
+        return failures
+
+    # Selected books carry the authors of their library item, a nested title dict may hold them as well
+    def get_book_authors(self, book):
+        authors_value = book.get("authors")
+        if authors_value is None and isinstance(book.get("title"), dict):
+            authors_value = book["title"].get("authors")
+        if isinstance(authors_value, list) and authors_value:
+            return ", ".join(item.get('name', '') for item in authors_value if isinstance(item, dict))
+        return "Unknown Author"
+
+    # The same audio was recognized before, i.e the bookmark was deleted and added again
+    # Returns whether the record got its text from the clip cache
+    def use_cached_transcript(self, entry, transcription_backend):
+        cached_text = self.get_clip_cache().get_transcript(entry.get("cache_key"), transcription_backend.name)
+        if cached_text is not None:
+            entry["text"] = cached_text
+        return cached_text is not None
+
+    # Stores a recognized clip on its record and in the clip cache
+    def record_transcript(self, state, entry, transcription_backend, text):
+        entry["text"] = text
+        if entry.get("cache_key"):
+            self.get_clip_cache().put_transcript(entry["cache_key"], transcription_backend.name, text)
+
+        # Checkpoint every few clips so an interrupted run doesn't pay for the same clips twice,
+        # the caller saves the rest
+        state.checkpoint()
+
+    # Saves every book's state and contents.json of the run, then rewrites the workbook
+    def write_transcriptions(self, books):
+        for _, state in books:
+            state.save()
+            state.write_contents()
+
+        self.write_workbook()
+        clip_cache = self.get_clip_cache()
+        clip_cache.save()
+        clip_cache.report()
+
+    # One workbook with a sheet per transcribed book, built from the sync state of every book on disk
+    # so a run that only touched some books doesn't drop the sheets of the others
+    def write_workbook(self):
+        audiobooks_path = os.path.join(artifacts_root_directory, "audiobooks")
+        all_transcriptions_path = os.path.join(audiobooks_path, "All_Transcriptions.xlsx")
+
+        books = []
+        if os.path.isdir(audiobooks_path):
+            for title in sorted(os.listdir(audiobooks_path)):
+                title_dir_path = os.path.join(audiobooks_path, title)
+                if not os.path.exists(os.path.join(title_dir_path, SYNC_STATE_FILE_NAME)):
+                    continue
+                state = SyncState(title_dir_path)
+                if any(entry["text"] for entry in state.records.values()):
+                    books.append((title, state))
 
-    async def cmd_transcribe_bookmarks(self):
-        li_books = await self.get_book_selection()
+        if not books:
+            print("No transcriptions yet, the workbook was not written")
+            return None
 
-        r = sr.Recognizer()
+        os.makedirs(audiobooks_path, exist_ok=True)
+        with span("export", target="xlsx") as export_span:
+            workbook = TranscriptionWorkbook(all_transcriptions_path)
+            for title, state in books:
+                workbook.add_book(title, ((entry["clip"].replace(".flac", ""), entry["text"])
+                                          for _, entry in state.sorted_records() if entry["text"]))
+
+            # Apply changes and save xlsx
+            workbook.close()
+            export_span.add(bytes=os.path.getsize(all_transcriptions_path), items=len(books))
+        print(f"Transcriptions saved to {all_transcriptions_path}")
+        return all_transcriptions_path
+
+    # Slices and transcribes the new bookmarks in one pass, the audio goes to the recognizer as PCM in memory
+    # Clip files are only written with --archive=true
+    async def cmd_slice_and_transcribe(self, workers=TRANSCRIPTION_WORKERS, backend=DEFAULT_TRANSCRIPTION_BACKEND,
+                                       archive="false", books=None):
+        try:
+            transcription_backend = get_backend(backend)
+        except ValueError as e:
+            print(e)
+            return
 
-        # Create dictionary to store titles and transcriptions and new folder to store transcriptions
-        pairs = {}
-        jsonHighlights = []
-        
-        for book in li_books:
-            # Handle both string and nested dictionary formats for title
-            title_value = book.get("title", {})
-            if isinstance(title_value, str):
-                _title = title_value
-            else:
-                _title = title_value.get("title", "untitled")
-            
-            # Handle authors similarly
-            authors_value = book.get("title", {})
-            if isinstance(authors_value, dict):
-                _authors = authors_value.get("authors", [])
-                if isinstance(_authors, list):
-                    allAuthors = ", ".join(item.get('name', '') for item in _authors if isinstance(item, dict))
-                else:
-                    allAuthors = "Unknown Author"
-            else:
-                allAuthors = "Unknown Author"
-            
-            title = _title.lower().replace(" ", "_")
-            title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
-            clips_dir_path = os.path.join(title_dir_path, "clips")
-            directory = os.fsencode(clips_dir_path)
-
-            path_exists = os.path.exists(directory)
-            if not path_exists:
-                os.makedirs(directory)
-
-            transcribed_clips_dir_path = os.path.join(title_dir_path, "trancribed_clips")
-            trancribed_clips_path_exists = os.path.exists(transcribed_clips_dir_path)
-            if not trancribed_clips_path_exists:
-                os.makedirs(transcribed_clips_dir_path)
-
-            for file in os.listdir(directory):
-                highlight = {}
-                filename = os.fsdecode(file)
-                highlight["title"] = _title
-                highlight["author"] = allAuthors
-                if not filename.startswith("clip"):
-                    highlight["note"] = filename.replace(".flac", "")
-                highlight["source_type"] = "audible_bookmark_extractor"
-                if filename.endswith(".flac"):
-                    print(os.path.join(os.fsdecode(directory), filename))
-                    heading = filename.replace(".flac", "")
-
-                    audioclip = sr.AudioFile(os.path.join(
-                        os.fsdecode(directory), filename))
-                    with audioclip as source:
-                        audio = r.record(source)
-
-                    try:
-                        text = r.recognize_google(audio)
-                        pairs[str(heading)] = text
-                        highlight["text"] = text
-                    except Exception as e:
-                        highlight["text"] = ""
-                        print(f"Error while recognizing this clip {heading}: {e}")
-                    xcel = pd.DataFrame(pairs.values(), index=pairs.keys())
-
-                    # Change header format so that rows can be edited
-                    pandas.io.formats.excel.ExcelFormatter.header_style = None
-
-                    if highlight["text"]:
-                        jsonHighlights.append(highlight)
-                    
-                    # Create writer instance with desired path
-                    all_transcriptions_path = os.path.join(transcribed_clips_dir_path, "All_Transcriptions.xlsx")
-                    writer = pd.ExcelWriter(
-                        all_transcriptions_path, engine='xlsxwriter')
-
-                    # Create a sheet in the same workbook for each file in the directory
-                    sheet_name = title[:31].replace(":", "").replace("?", "")
-                    xcel.to_excel(writer, sheet_name=sheet_name)
-                    workbook = writer.book
-                    worksheet = writer.sheets[sheet_name]
-
-                    # Create header format to be used in all headers
-                    header_format = workbook.add_format({
-                        "valign": "vcenter",
-                        "align": "center",
-                        "bg_color": "#FFA500",
-                        "bold": True,
-                        "font_color": "#FFFFFF"})  # transcribe_bookmarks
-
-                    # Set desired cell format
-                    cell_format = workbook.add_format()
-                    cell_format.set_align("vcenter")
-                    cell_format.set_align("center")
-                    cell_format.set_text_wrap(True)
-
-                    # Apply header format and format columns to fit data
-                    worksheet.write(0, 0, 'Clip Note', header_format)
-                    worksheet.write(0, 1, 'Transcription', header_format)
-                    worksheet.set_column("B:B", 100)
-                    worksheet.set_column("A:A", 50)
-
-                    # Format cells for appropiate size, wrap the text for style points
-                    for i in range(1, (len(xcel)+1)):
-                        worksheet.set_row(i, 100, cell_format)
-
-                    # Apply changes and save xlsx to Transcribed bookmarks folder.
-                    writer.close()
-            transcription_contents_path = os.path.join(transcribed_clips_dir_path, "contents.json")
-            with open(transcription_contents_path, "w") as f:
-                json.dump(jsonHighlights, f, indent=4)                
+        archive = is_enabled(archive)
+        li_books = await self.get_book_selection(books)
+        li_results = await self.fetch_sidecars([book.get("asin") for book in li_books])
+
+        planned_books = []
+        jobs = []
+
+        for book, records in zip(li_books, li_results):
+            if isinstance(records, Exception):
+                ExternalError(self.fetch_sidecar, book.get("asin"), records).show_error()
+                continue
+
+            # Without archiving a transcribed record is done, its clip file is never needed
+            plan = await self.plan_bookmarks(book, records, require_files=archive)
+            if not plan:
+                continue
+
+            state = plan["state"]
+            state.set_book(plan["_title"], self.get_book_authors(book))
+            planned_books.append((plan["title"], state))
+
+            if archive:
+                await self.slice_clip_files(plan, plan["to_slice"])
+            state.mark_planned(plan["clips"], plan["to_slice"])
+
+            for key, entry in state.untranscribed():
+                if self.use_cached_transcript(entry, transcription_backend):
+                    continue
+
+                loader = pcm_loader(plan["source_path"], entry["window"], plan["input_args"],
+                                    transcription_backend.sample_rate)
+                jobs.append((state, entry, loader))
+
+            if archive:
+                state.remove_untracked_clips()
+            state.save()
+
+        print(f"Transcribing {len(jobs)} clips with {transcription_backend.name}")
+        try:
+            await self.transcribe_clips(TranscriptionPool(transcription_backend, workers=workers), jobs)
+        finally:
+            transcription_backend.close()
+
+        self.write_transcriptions(planned_books)
+
+    # Runs fetch -> slice -> transcribe -> post as one pipeline of stages connected by bounded queues, a clip is
+    # transcribed as soon as it is sliced and posted to Readwise as soon as it is transcribed
+    async def cmd_pipeline(self, readwise=None, workers=TRANSCRIPTION_WORKERS, backend=DEFAULT_TRANSCRIPTION_BACKEND,
+                           post="true", books=None):
+        try:
+            transcription_backend = get_backend(backend)
+        except ValueError as e:
+            print(e)
+            return
+
+        if is_enabled(post) and not readwise:
+            print("No Readwise Token found, highlights won't be posted. Run readwise_authenticate to post them")
+        readwise = readwise if is_enabled(post) else None
+
+        li_books = await self.get_book_selection(books)
+        pool = TranscriptionPool(transcription_backend, workers=workers)
+        planned_books = []
+
+        # Items passed between the stages are dicts of the book's "state", the record "key" and "entry",
+        # and once sliced the clip "audio"
+        async def fetch(books):
+            items = []
+            for book in books:
+                try:
+                    records = await self.fetch_sidecar(book.get("asin"))
+                except Exception as e:
+                    ExternalError(self.fetch_sidecar, book.get("asin"), e).show_error()
+                    continue
+
+                plan = await self.plan_bookmarks(book, records, require_files=False)
+                if not plan:
+                    continue
+
+                state = plan["state"]
+                state.set_book(plan["_title"], self.get_book_authors(book))
+                planned_books.append((plan["title"], state))
+                state.mark_planned(plan["clips"], plan["to_slice"])
+                state.save()
+
+                for key, entry in state.sorted_records():
+                    if entry["text"] is None and not self.use_cached_transcript(entry, transcription_backend):
+                        items.append({"state": state, "key": key, "entry": entry, "plan": plan})
+                    elif entry["text"] and not entry["exported"]:
+                        items.append({"state": state, "key": key, "entry": entry})
+            return items
+
+        async def slice_clips(items):
+            for item in items:
+                plan = item.pop("plan", None)
+                if not plan:
+                    continue
+                loader = pcm_loader(plan["source_path"], item["entry"]["window"], plan["input_args"],
+                                    transcription_backend.sample_rate)
+                try:
+                    item["audio"] = await asyncio.to_thread(loader)
+                except Exception as e:
+                    print(f"Error while slicing this clip {item['entry']['clip']}: {e}")
+            return [item for item in items if item["entry"]["text"] is not None or "audio" in item]
+
+        async def transcribe(items):
+            pending = [item for item in items if "audio" in item]
+            if pending:
+                try:
+                    texts = await pool.transcribe_batch([item.pop("audio") for item in pending])
+                except Exception as e:
+                    for item in pending:
+                        print(f"Error while recognizing this clip {item['entry']['clip']}: {e}")
+                    return [item for item in items if item not in pending]
+
+                for item, text in zip(pending, texts):
+                    print(item["entry"]["clip"])
+                    self.record_transcript(item["state"], item["entry"], transcription_backend, text)
+            return [item for item in items if item["entry"]["text"]]
+
+        async def post_highlights(items):
+            by_book = {}
+            for item in items:
+                by_book.setdefault(id(item["state"]), (item["state"], []))[1].append(item)
+
+            for state, book_items in by_book.values():
+                delivered = await readwise.post_highlights([state.highlight(item["entry"]) for item in book_items])
+                state.mark_exported([item["key"] for index, item in enumerate(book_items) if index in delivered])
+                state.save()
+
+        stages = [
+            Stage("fetch", fetch, workers=SIDECAR_CONCURRENCY),
+            Stage("slice", slice_clips, workers=CLIP_WORKERS),
+            Stage("transcribe", transcribe, workers=workers, batch_size=transcription_backend.batch_size)
+        ]
+        if readwise:
+            stages.append(Stage("post", post_highlights, batch_size=readwise.batch_size))
+
+        try:
+            counts = await Pipeline(stages).run(li_books)
+        finally:
+            transcription_backend.close()
+
+        print(", ".join(f"{name}: {count}" for name, count in counts.items()))
+        self.write_transcriptions(planned_books)
 
     def get_activation_bytes(self):
 
@@ -743,13 +1307,17 @@ class AudibleAPI:
     def bookmark_response_callback(self, resp):
         return resp
 
-    async def cmd_export_bookmarks(self):
+    async def cmd_export_bookmarks(self, books=None):
         """Export bookmarks to JSON file in current directory"""
-        li_books = await self.get_book_selection()
+        li_books = await self.get_book_selection(books)
         
         all_bookmarks = []
+
+        # Get bookmarks from Audible API, all books at once, results come back in library order
+        print(f"Getting bookmarks for {len(li_books)} books")
+        li_results = await self.fetch_sidecars([book.get("asin") for book in li_books])
         
-        for book in li_books:
+        for book, li_bookmarks in zip(li_books, li_results):
             asin = book.get("asin")
             # Handle both string and nested dictionary formats for title
             title_value = book.get("title", {})
@@ -761,41 +1329,28 @@ class AudibleAPI:
             if not _title:
                 continue
 
-            title = _title.lower().replace(" ", "_")
-            
-            print(f"Getting bookmarks for {_title}")
-            
-            # Get bookmarks from Audible API
-            bookmarks_url = f"https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar?type=AUDI&key={asin}"
-            
             try:
-                with audible.Client(auth=self.auth, response_callback=self.bookmark_response_callback) as client:
-                    library = client.get(
-                        bookmarks_url,
-                        num_results=1000,
-                        response_groups="product_desc, product_attrs"
-                    )
+                if isinstance(li_bookmarks, Exception):
+                    raise li_bookmarks
+                
+                # Process bookmarks into a simple format
+                for bookmark in li_bookmarks:
+                    # Ensure positions are integers
+                    start_pos = int(bookmark.get("startPosition", 0))
+                    end_pos = int(bookmark.get("endPosition", start_pos + 30000))
                     
-                    li_bookmarks = library.json().get("payload", {}).get("records", [])
+                    bookmark_data = {
+                        "book_title": _title,
+                        "asin": asin,
+                        "type": bookmark.get("type", ""),
+                        "start_position": start_pos,
+                        "end_position": end_pos,
+                        "text": bookmark.get("text", ""),
+                        "note": bookmark.get("note", ""),
+                        "creation_time": bookmark.get("creationTime", "")
+                    }
+                    all_bookmarks.append(bookmark_data)
                     
-                    # Process bookmarks into a simple format
-                    for bookmark in li_bookmarks:
-                        # Ensure positions are integers
-                        start_pos = int(bookmark.get("startPosition", 0))
-                        end_pos = int(bookmark.get("endPosition", start_pos + 30000))
-                        
-                        bookmark_data = {
-                            "book_title": _title,
-                            "asin": asin,
-                            "type": bookmark.get("type", ""),
-                            "start_position": start_pos,
-                            "end_position": end_pos,
-                            "text": bookmark.get("text", ""),
-                            "note": bookmark.get("note", ""),
-                            "creation_time": bookmark.get("creationTime", "")
-                        }
-                        all_bookmarks.append(bookmark_data)
-                        
             except Exception as e:
                 print(f"Error getting bookmarks for {_title}: {e}")
                 continue
@@ -851,39 +1406,30 @@ class AudibleAPI:
             print(f"Getting bookmarks for {_title}")
             
             # Get bookmarks from Audible API
-            bookmarks_url = f"https://cde-ta-g7g.amazon.com/FionaCDEServiceEngine/sidecar?type=AUDI&key={asin}"
-            
             try:
-                with audible.Client(auth=self.auth, response_callback=self.bookmark_response_callback) as client:
-                    library = client.get(
-                        bookmarks_url,
-                        num_results=1000,
-                        response_groups="product_desc, product_attrs"
-                    )
+                li_bookmarks = await self.fetch_sidecar(asin)
+                
+                # Process bookmarks into a simple format
+                for bookmark in li_bookmarks:
+                    # Convert milliseconds to a more standard format for the pipeline
+                    start_ms = int(bookmark.get("startPosition", 0))
+                    end_ms = int(bookmark.get("endPosition", start_ms + 30000))
                     
-                    li_bookmarks = library.json().get("payload", {}).get("records", [])
+                    bookmark_data = {
+                        "start_ms": start_ms,
+                        "end_ms": end_ms,
+                        "start": start_ms,  # Alternative field name
+                        "end": end_ms,      # Alternative field name
+                        "position": start_ms,  # Another alternative
+                        "book_title": _title,
+                        "asin": asin,
+                        "type": bookmark.get("type", ""),
+                        "text": bookmark.get("text", ""),
+                        "note": bookmark.get("note", ""),
+                        "creation_time": bookmark.get("creationTime", "")
+                    }
+                    all_bookmarks.append(bookmark_data)
                     
-                    # Process bookmarks into a simple format
-                    for bookmark in li_bookmarks:
-                        # Convert milliseconds to a more standard format for the pipeline
-                        start_ms = int(bookmark.get("startPosition", 0))
-                        end_ms = int(bookmark.get("endPosition", start_ms + 30000))
-                        
-                        bookmark_data = {
-                            "start_ms": start_ms,
-                            "end_ms": end_ms,
-                            "start": start_ms,  # Alternative field name
-                            "end": end_ms,      # Alternative field name
-                            "position": start_ms,  # Another alternative
-                            "book_title": _title,
-                            "asin": asin,
-                            "type": bookmark.get("type", ""),
-                            "text": bookmark.get("text", ""),
-                            "note": bookmark.get("note", ""),
-                            "creation_time": bookmark.get("creationTime", "")
-                        }
-                        all_bookmarks.append(bookmark_data)
-                        
             except Exception as e:
                 print(f"Error getting bookmarks for {_title}: {e}")
                 continue
@@ -0,0 +1,273 @@
+"""Local stand-ins for Audible, the sidecar service, Readwise and Notion, and API subclasses that talk to them.
+
+One ThreadingHTTPServer answers every service, their paths don't overlap:
+
+    GET   /1.0/library                  library pages of `library_size` items with a total-count header
+    GET   /1.0/library/<asin>           book details
+    GET   /library/download             302 redirect to /files/<asin>.aax, like the Audible download link
+    GET   /files/<name>                 the synthetic audiobook, with Range support
+    GET   /FionaCDEServiceEngine/sidecar bookmark records of a book
+    POST  /api/v2/highlights/           Readwise bulk highlights
+    POST  /v1/pages, PATCH /v1/blocks/<id>/children   Notion
+"""
+import json
+import os
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from audible_api import AudibleAPI  # noqa: E402
+from notion import NotionExporter, NOTION_API_URL  # noqa: E402
+from readwise import Readwise  # noqa: E402
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def book_asin(index):
+    return f"B{index:09d}"
+
+
+class StandinData:
+    """What the stand-in serves: a library of library_size books that all share one synthetic audiobook file,
+    and records_per_book sidecar records spread over the audiobook's duration"""
+
+    def __init__(self, audio_path, duration_ms, library_size=2500, records_per_book=1000, note_every=10):
+        self.audio_path = audio_path
+        self.duration_ms = int(duration_ms)
+        self.library_size = int(library_size)
+        self.records_per_book = int(records_per_book)
+        self.note_every = int(note_every)
+        self.stats = {"requests": 0, "bytes_sent": 0, "highlights": 0, "notion_blocks": 0}
+        self.lock = threading.Lock()
+
+    def item(self, index, response_groups="contributors"):
+        item = {
+            "asin": book_asin(index),
+            "title": f"Benchmark Book {index}",
+            "purchase_date": f"2024-01-01T00:00:{index % 60:02d}Z"
+        }
+        # Like Audible, the authors only come with the contributors response group
+        if "contributors" in response_groups:
+            item["authors"] = [{"name": "Benchmark Author"}]
+        return item
+
+    def library_page(self, page, num_results, response_groups=""):
+        start = (page - 1) * num_results
+        return [self.item(index, response_groups)
+                for index in range(start, min(start + num_results, self.library_size))]
+
+    def sidecar_records(self):
+        records = []
+        spacing = max(1, (self.duration_ms - 60000) // max(1, self.records_per_book))
+        for index in range(self.records_per_book):
+            start = 30000 + index * spacing
+            if self.note_every and index % self.note_every == 0:
+                records.append({"type": "audible.note", "startPosition": str(start),
+                                "creationTime": "2024-01-01 00:00:00.0", "text": f"Note {index}"})
+            records.append({"type": "audible.clip", "startPosition": str(start), "endPosition": str(start + 20000),
+                            "creationTime": "2024-01-01 00:00:00.0"})
+        return records
+
+    def count(self, **values):
+        with self.lock:
+            for key, value in values.items():
+                self.stats[key] += value
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    data = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        self.data.count(requests=1)
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if url.path == "/1.0/library":
+            num_results = int(query.get("num_results", 1000))
+            items = self.data.library_page(int(query.get("page", 1)), num_results,
+                                           query.get("response_groups", ""))
+            return self.send_json({"items": items}, headers={"total-count": str(self.data.library_size)})
+
+        match = re.fullmatch(r"/1.0/library/(\w+)", url.path)
+        if match:
+            index = int(match.group(1)[1:])
+            return self.send_json({"item": self.data.item(index)})
+
+        if url.path == "/library/download":
+            self.send_response(302)
+            self.send_header("Location", f"http://127.0.0.1:{self.server.server_port}/files/{query['asin']}.aax")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if url.path.startswith("/files/"):
+            return self.send_file()
+
+        if url.path == "/FionaCDEServiceEngine/sidecar":
+            return self.send_json({"payload": {"records": self.data.sidecar_records()}})
+
+        self.send_json({"error": f"no stand-in for {url.path}"}, status=404)
+
+    def send_file(self):
+        size = os.path.getsize(self.data.audio_path)
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header:
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", range_header.strip())
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        with open(self.data.audio_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                self.wfile.write(chunk)
+                remaining -= len(chunk)
+        self.data.count(bytes_sent=end - start + 1)
+
+    def do_POST(self):
+        self.data.count(requests=1)
+        payload = self.read_json()
+        if self.path == "/api/v2/highlights/":
+            self.data.count(highlights=len(payload.get("highlights", [])))
+            return self.send_json([])
+        if self.path == "/v1/pages":
+            return self.send_json({"id": f"page-{self.data.stats['requests']}"})
+        self.send_json({"error": f"no stand-in for {self.path}"}, status=404)
+
+    def do_PATCH(self):
+        self.data.count(requests=1)
+        payload = self.read_json()
+        if re.fullmatch(r"/v1/blocks/[\w-]+/children", self.path):
+            self.data.count(notion_blocks=len(payload.get("children", [])))
+            return self.send_json({"results": []})
+        self.send_json({"error": f"no stand-in for {self.path}"}, status=404)
+
+
+def start_server(data, port=0):
+    """Serves data on 127.0.0.1 from a background thread, returns the server, server.server_port is the port"""
+    handler = type("BoundStandinHandler", (StandinHandler,), {"data": data})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class StandinTransport(httpx.AsyncHTTPTransport):
+    """Sends every request to the stand-in, whatever host the code under test asked for"""
+
+    def __init__(self, port, **kwargs):
+        super().__init__(**kwargs)
+        self.port = int(port)
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(scheme="http", host="127.0.0.1", port=self.port)
+        return await super().handle_async_request(request)
+
+
+class StandinAudibleClient:
+    """Answers the calls AudibleAPI makes on audible.AsyncClient: relative paths are library API paths,
+    extra keyword arguments are query parameters, and without a response_callback the parsed JSON is returned"""
+
+    def __init__(self, port, limits):
+        self.client = httpx.AsyncClient(base_url="https://api.audible.com", transport=StandinTransport(port, limits=limits),
+                                        timeout=httpx.Timeout(30.0, read=120.0))
+
+    async def get(self, path, response_callback=None, params=None, **kwargs):
+        url = path if "://" in path else f"/1.0/{path}"
+        response = await self.client.get(url, params={**(params or {}), **kwargs})
+        if response_callback:
+            return response_callback(response)
+        response.raise_for_status()
+        return response.json()
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class StandinAudibleAPI(AudibleAPI):
+    """AudibleAPI with both clients pointed at the stand-in, everything above the clients is the real code"""
+
+    def __init__(self, port, **kwargs):
+        auth = SimpleNamespace(locale=SimpleNamespace(country_code="us"), customer_info={"user_id": "benchmark"})
+        super().__init__(auth, **kwargs)
+        self.port = port
+
+    def get_client(self):
+        if self._client is None:
+            self._client = StandinAudibleClient(self.port, self.http_limits)
+        return self._client
+
+    def get_http_client(self):
+        if self._http_client is None:
+            self._http_client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(30.0, read=120.0),
+                transport=StandinTransport(self.port, limits=self.http_limits))
+        return self._http_client
+
+
+class StandinReadwise(Readwise):
+
+    def __init__(self, port, **kwargs):
+        super().__init__("benchmark", **kwargs)
+        self.port = port
+
+    def get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(headers={"Authorization": f"Token {self.token}"},
+                                             transport=StandinTransport(self.port), timeout=httpx.Timeout(30.0))
+        return self._client
+
+
+class StandinNotionExporter(NotionExporter):
+
+    def __init__(self, port, **kwargs):
+        super().__init__("benchmark", "benchmark-database", **kwargs)
+        self.port = port
+
+    def get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(base_url=NOTION_API_URL, transport=StandinTransport(self.port),
+                                             timeout=httpx.Timeout(30.0))
+        return self._client
@@ -0,0 +1,85 @@
+"""Startup time benchmark for the CLI, run from anywhere with
+
+    python benchmarks/startup.py [--runs 10] [--budget-ms 150]
+
+Fails (exit code 1) when a trivial command like help takes more than budget-ms on top of a bare interpreter,
+or when importing command pulls in one of the heavy dependencies that should only load with the commands using them
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Only the commands that use them may import these
+HEAVY_MODULES = ["audible", "httpx", "msgpack", "xlsxwriter", "speech_recognition", "requests", "pandas", "pydub", "zmq"]
+
+# Commands that must start without credentials or heavy dependencies
+TRIVIAL_COMMANDS = [["main.py", "help"]]
+
+# in ms, the startup time a trivial command may add to a bare interpreter
+STARTUP_BUDGET_MS = 150
+
+
+def median_ms(args, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *args], cwd=REPO_ROOT, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def heavy_imports():
+    code = f"import json, sys, command; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    output = subprocess.run([sys.executable, "-c", code], cwd=REPO_ROOT, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout)
+
+
+def slowest_imports(count=10):
+    """(cumulative us, module) of the slowest imports of command, to point at what regressed"""
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import command"], cwd=REPO_ROOT,
+                            capture_output=True, text=True)
+    rows = []
+    for line in output.stderr.splitlines()[1:]:
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            rows.append((int(parts[1]), parts[2].strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--budget-ms", type=float, default=STARTUP_BUDGET_MS)
+    args = parser.parse_args()
+
+    failed = False
+    baseline = median_ms(["-c", "pass"], args.runs)
+    print(f"bare interpreter: {baseline:.1f} ms")
+
+    for command in TRIVIAL_COMMANDS:
+        overhead = median_ms(command, args.runs) - baseline
+        status = "ok" if overhead <= args.budget_ms else "FAIL"
+        print(f"{' '.join(command)}: +{overhead:.1f} ms (budget {args.budget_ms:.0f} ms) {status}")
+        failed |= overhead > args.budget_ms
+
+    heavy = heavy_imports()
+    if heavy:
+        print(f"import command loads heavy dependencies: {', '.join(heavy)} FAIL")
+        failed = True
+
+    if failed:
+        print("Slowest imports of command:")
+        for cumulative, module in slowest_imports():
+            print(f"  {cumulative / 1000:8.1f} ms  {module}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
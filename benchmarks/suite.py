@@ -0,0 +1,229 @@
+"""End to end benchmark suite against local stand-ins, needs ffmpeg/ffprobe and the packages in requirements.txt
+
+    python benchmarks/suite.py [--hours 2] [--books 2] [--records 1000] [--cases download,convert]
+                               [--update-baselines] [--tolerance 0.25]
+
+Generates a synthetic audiobook with ffmpeg's lavfi sine source, serves it together with a library, download
+redirects and sidecar records from standins.py, and runs the real commands against it in a fresh artifacts
+directory. Every case runs in its own process so its peak RSS is its own. Wall time, throughput and peak RSS are
+compared against benchmarks/baselines.json, the suite exits with 1 when a case got slower or bigger than the
+tolerance allows. Transcription uses the stub backend, the speech APIs can't be stood in for
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINES_PATH = os.path.join(BENCHMARKS_DIR, "baselines.json")
+
+# Cases run in this order, later ones use what the earlier ones left in the artifacts directory
+CASES = ["library", "download", "convert", "get_bookmarks", "transcribe", "readwise", "notion"]
+
+# A case regresses when it takes this much more time or memory than its baseline
+REGRESSION_TOLERANCE = 0.25
+
+ACTIVATION_BYTES = "deadbeef"
+
+
+def make_audiobook(path, hours):
+    """A mono AAC file of `hours` hours in an mp4 container, like a decrypted Audible download"""
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp.m4a"
+    subprocess.run([
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-f", "lavfi", "-i", f"sine=frequency=220:beep_factor=4:sample_rate=22050:duration={int(hours * 3600)}",
+        "-ac", "1", "-c:a", "aac", "-b:a", "32k", "-f", "mp4", tmp_path
+    ], check=True)
+    os.replace(tmp_path, path)
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+async def run_case(case, port, asins):
+    """Runs one case in this process, returns (items, bytes) it processed"""
+    # standins puts the repository on sys.path
+    from standins import StandinAudibleAPI, StandinNotionExporter, StandinReadwise
+    from constants import artifacts_root_directory
+
+    api = StandinAudibleAPI(port)
+    books = ",".join(asins)
+    audiobooks_path = os.path.join(artifacts_root_directory, "audiobooks")
+
+    def book_files(extension):
+        paths = [os.path.join(audiobooks_path, name, f"{name}.{extension}") for name in os.listdir(audiobooks_path)]
+        return [path for path in paths if os.path.exists(path)]
+
+    def clip_count():
+        from sync_state import SyncState
+        return sum(len(SyncState(os.path.join(audiobooks_path, name)).records) for name in os.listdir(audiobooks_path))
+
+    try:
+        if case == "library":
+            await api.get_library(refresh=True)
+            return len(api.library["items"]), 0
+        if case == "download":
+            await api.cmd_download_books(books=books)
+            return len(asins), sum(os.path.getsize(path) for path in book_files("aax"))
+        if case == "convert":
+            await api.cmd_convert_audiobook(books=books)
+            return len(asins), sum(os.path.getsize(path) for path in book_files("aax"))
+        if case == "get_bookmarks":
+            await api.cmd_get_bookmarks(books=books)
+            return clip_count(), 0
+        if case == "transcribe":
+            await api.cmd_transcribe_bookmarks(backend="stub", books=books)
+            return clip_count(), 0
+
+        li_books = await api.get_book_selection(books)
+        if case == "readwise":
+            readwise = StandinReadwise(port, rate=0)
+            try:
+                await readwise.cmd_post_highlights(li_books)
+            finally:
+                await readwise.close()
+            return clip_count(), 0
+        if case == "notion":
+            notion = StandinNotionExporter(port, rate=0)
+            try:
+                await notion.cmd_export_highlights(li_books)
+            finally:
+                await notion.close()
+            return clip_count(), 0
+        raise ValueError(f"Unknown case {case}")
+    finally:
+        await api.close()
+
+
+def case_main(args):
+    """Entry point of the per case process, prints its result as JSON on the last line"""
+    start = time.perf_counter()
+    items, size = asyncio.run(run_case(args.case, args.port, args.asins.split(",")))
+    seconds = time.perf_counter() - start
+    print(json.dumps({
+        "seconds": round(seconds, 3),
+        "items_per_second": round(items / seconds, 1),
+        "mb_per_second": round(size / (1024 * 1024) / seconds, 1),
+        "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "children_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN)
+    }))
+
+
+def prepare_home(home_path):
+    """A fresh artifacts directory with the secrets the commands look for"""
+    if os.path.exists(home_path):
+        shutil.rmtree(home_path)
+    secrets_path = os.path.join(home_path, "audibleextractor", "secrets")
+    os.makedirs(secrets_path)
+    with open(os.path.join(secrets_path, "activation_bytes.txt"), "w") as f:
+        f.write(ACTIVATION_BYTES)
+    with open(os.path.join(secrets_path, "readwise_token.json"), "w") as f:
+        f.write("benchmark")
+
+
+def compare(results, baselines, tolerance):
+    """Returns the list of regressions, slower wall time or bigger peak RSS than the baseline allows"""
+    regressions = []
+    for case, result in results.items():
+        baseline = baselines.get(case)
+        if not baseline:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if result[metric] > baseline[metric] * (1 + tolerance):
+                regressions.append(f"{case} {metric}: {result[metric]} vs baseline {baseline[metric]}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hours", type=float, default=2)
+    parser.add_argument("--books", type=int, default=2)
+    parser.add_argument("--library-size", type=int, default=2500)
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--cases", default=",".join(CASES))
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "audibleextractor-benchmarks"))
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--update-baselines", action="store_true")
+    # Used by the suite to run a single case in a child process
+    parser.add_argument("--case")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--asins")
+    args = parser.parse_args()
+
+    if args.case:
+        case_main(args)
+        return 0
+
+    for tool in ["ffmpeg", "ffprobe"]:
+        if not shutil.which(tool):
+            print(f"{tool} is needed for the benchmarks, see the readme")
+            return 1
+
+    from standins import StandinData, book_asin, start_server
+
+    audio_path = os.path.join(args.workdir, "audio", f"audiobook_{args.hours:g}h.m4a")
+    print(f"Generating a {args.hours:g} hour audiobook at {audio_path}")
+    make_audiobook(audio_path, args.hours)
+
+    data = StandinData(audio_path, args.hours * 3600 * 1000, library_size=args.library_size,
+                       records_per_book=args.records)
+    server = start_server(data)
+    home_path = os.path.join(args.workdir, "home")
+    prepare_home(home_path)
+    asins = ",".join(book_asin(index) for index in range(args.books))
+
+    results = {}
+    failed = False
+    for case in [case for case in CASES if case in args.cases.split(",")]:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--case", case, "--port", str(server.server_port),
+             "--asins", asins],
+            env={**os.environ, "HOME": home_path}, capture_output=True, text=True)
+        if process.returncode != 0:
+            print(f"{case} failed:\n{process.stdout[-2000:]}{process.stderr[-2000:]}")
+            failed = True
+            break
+        results[case] = json.loads(process.stdout.strip().splitlines()[-1])
+        result = results[case]
+        print(f"{case:14} {result['seconds']:9.2f}s {result['items_per_second']:10.1f} items/s "
+              f"{result['mb_per_second']:8.1f} MB/s {result['peak_rss_mb']:8.1f} MB RSS "
+              f"{result['children_peak_rss_mb']:8.1f} MB child RSS")
+    server.shutdown()
+
+    with open(os.path.join(args.workdir, "results.json"), "w") as f:
+        json.dump({"args": {k: v for k, v in vars(args).items() if k not in ["case", "port", "asins"]},
+                   "results": results, "server": data.stats}, f, indent=2)
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = json.load(f)
+    if args.update_baselines and not failed:
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2)
+        print(f"Baselines saved to {args.baselines}")
+    elif not baselines:
+        print("No baselines yet, run with --update-baselines on a known good build to record them")
+
+    regressions = compare(results, baselines, args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if failed or regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
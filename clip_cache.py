@@ -0,0 +1,134 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from constants import artifacts_root_directory
+
+# in bytes, once the cached clips take more than this the least recently used ones are evicted
+CLIP_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# entries kept at most, so transcript only entries can't grow the index without bound
+CLIP_CACHE_MAX_ENTRIES = 100000
+
+
+def source_identity(source_path):
+    """Cheap identity of the audio a clip is cut from, a re-download or re-conversion changes it"""
+    stat = os.stat(source_path)
+    return [os.path.basename(source_path), stat.st_size, stat.st_mtime_ns]
+
+
+def clip_key(asin, window, start_offset, end_offset, source_path):
+    payload = json.dumps([asin, list(window), start_offset, end_offset, source_identity(source_path)])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ClipCache:
+    """Content addressed cache of sliced clips and their transcriptions, so unchanged clips are
+    neither sliced nor sent to the recognizer again, bounded in size with LRU eviction"""
+
+    def __init__(self, max_bytes=CLIP_CACHE_MAX_BYTES, max_entries=CLIP_CACHE_MAX_ENTRIES):
+        self.dir_path = os.path.join(artifacts_root_directory, "cache", "clips")
+        self.index_path = os.path.join(self.dir_path, "index.json")
+        self.max_bytes = int(max_bytes)
+        self.max_entries = int(max_entries)
+        # entries maps the clip key to {"file", "size", "used", "transcripts": {backend: text}},
+        # size is the bytes of the cached clip, the transcripts are counted by entry_size
+        self.entries = {}
+        self.stats = {"clip_hits": 0, "clip_misses": 0, "transcript_hits": 0, "transcript_misses": 0, "evictions": 0}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        # Transcripts are only evicted here, put_transcript runs once per clip
+        self.evict()
+        os.makedirs(self.dir_path, exist_ok=True)
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f)
+        os.replace(tmp_path, self.index_path)
+
+    def cached_path(self, key):
+        entry = self.entries.get(key)
+        if not entry or not entry.get("file"):
+            return None
+        path = os.path.join(self.dir_path, entry["file"])
+        return path if os.path.exists(path) else None
+
+    def get_clip(self, key, dest_path):
+        """Puts the cached clip at dest_path, returns False when it has to be sliced"""
+        cached_path = self.cached_path(key)
+        if not cached_path:
+            self.stats["clip_misses"] += 1
+            return False
+
+        copy_clip(cached_path, dest_path)
+        self.entries[key]["used"] = time.time()
+        self.stats["clip_hits"] += 1
+        return True
+
+    def put_clip(self, key, clip_path):
+        file_name = f"{key}{os.path.splitext(clip_path)[1]}"
+        os.makedirs(self.dir_path, exist_ok=True)
+        copy_clip(clip_path, os.path.join(self.dir_path, file_name))
+
+        entry = self.entries.setdefault(key, {"transcripts": {}})
+        entry.update({"file": file_name, "size": os.path.getsize(clip_path), "used": time.time()})
+        self.evict()
+
+    def get_transcript(self, key, backend):
+        entry = self.entries.get(key)
+        text = entry.get("transcripts", {}).get(backend) if entry else None
+        if text is None:
+            self.stats["transcript_misses"] += 1
+            return None
+
+        entry["used"] = time.time()
+        self.stats["transcript_hits"] += 1
+        return text
+
+    def put_transcript(self, key, backend, text):
+        entry = self.entries.setdefault(key, {"file": None, "size": 0, "transcripts": {}})
+        entry["transcripts"][backend] = text
+        entry["used"] = time.time()
+
+    def evict(self):
+        total = sum(entry_size(entry) for entry in self.entries.values())
+        count = len(self.entries)
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1].get("used", 0)):
+            if total <= self.max_bytes and count <= self.max_entries:
+                break
+            cached_path = self.cached_path(key)
+            if cached_path:
+                os.remove(cached_path)
+            total -= entry_size(entry)
+            count -= 1
+            del self.entries[key]
+            self.stats["evictions"] += 1
+
+    def report(self):
+        stats = self.stats
+        print(f"Clip cache: {stats['clip_hits']} clip hits, {stats['clip_misses']} misses, "
+              f"{stats['transcript_hits']} transcription hits, {stats['transcript_misses']} misses, "
+              f"{stats['evictions']} evicted")
+
+
+
+def entry_size(entry):
+    # Transcripts are stored in the index, so they count towards the budget as well
+    transcripts = entry.get("transcripts", {}).values()
+    return entry.get("size", 0) + sum(len(text.encode()) for text in transcripts)
+
+
+def copy_clip(source_path, dest_path):
+    # Never a hard link, the clip in the book folder would keep the cached bytes on disk after eviction.
+    # Removing dest_path first also unlinks the clips older versions linked into the cache
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    shutil.copyfile(source_path, dest_path)
@@ -0,0 +1,85 @@
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import span
+
+# FFMPEG needs to be installed for this module! see readme for more details
+
+# How many ffmpeg processes may slice clips at the same time, each one only decodes its own few seconds of audio
+# so memory stays flat no matter how long the audiobook is
+CLIP_WORKERS = min(8, os.cpu_count() or 1)
+
+# Default clip length in ms when a record has no usable end position
+DEFAULT_CLIP_LENGTH = 30000
+
+
+def clip_window(audio_clip, start_offset, end_offset):
+    """Returns the (start, end) window in ms that should be sliced for a sidecar record"""
+    raw_start_pos = int(audio_clip["startPosition"])
+    start_pos = raw_start_pos - start_offset
+    end_pos = int(audio_clip.get(
+        "endPosition", raw_start_pos + DEFAULT_CLIP_LENGTH)) + end_offset
+    if start_pos == end_pos:
+        end_pos += DEFAULT_CLIP_LENGTH
+
+    # Bookmarks at the very beginning of a book would otherwise seek before the first frame
+    return max(start_pos, 0), end_pos
+
+
+def extract_clip(source_path, start_ms, end_ms, output_path, input_args=()):
+    """Seeks straight to the window in source_path and only decodes that window into output_path.
+    The output format is picked by ffmpeg from the output_path extension"""
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        *input_args,
+        # -ss before -i makes ffmpeg seek in the container instead of decoding everything up to the window
+        "-ss", f"{start_ms / 1000:.3f}",
+        "-i", source_path,
+        "-t", f"{(end_ms - start_ms) / 1000:.3f}",
+        "-vn",
+        output_path
+    ]
+    # ffmpeg decodes the window and encodes the clip in one process, the encode spans of a book add up to
+    # more than its slice span when CLIP_WORKERS clips are cut at once
+    with span("encode", items=1) as encode_span:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        encode_span.add(bytes=os.path.getsize(output_path))
+    return output_path
+
+
+def read_clip_pcm(source_path, start_ms, end_ms, input_args=(), sample_rate=16000):
+    """Decodes only the window of source_path into raw mono 16 bit little endian PCM at sample_rate
+    and returns the bytes, nothing is written to disk"""
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error",
+        *input_args,
+        "-ss", f"{start_ms / 1000:.3f}",
+        "-i", source_path,
+        "-t", f"{(end_ms - start_ms) / 1000:.3f}",
+        "-vn", "-ac", "1", "-ar", str(int(sample_rate)),
+        "-f", "s16le", "pipe:1"
+    ]
+    return subprocess.run(command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout
+
+
+def extract_clips(source_path, jobs, max_workers=CLIP_WORKERS, input_args=()):
+    """Slices every (start_ms, end_ms, output_path) job from source_path in parallel.
+    Returns a list of (output_path, error) in job order, error is None for clips that were written"""
+    jobs = list(jobs)
+    results = []
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(extract_clip, source_path, start_ms, end_ms, output_path, input_args)
+                   for start_ms, end_ms, output_path in jobs]
+
+        for future, (_, _, output_path) in zip(futures, jobs):
+            try:
+                future.result()
+                results.append((output_path, None))
+            except subprocess.CalledProcessError as e:
+                results.append((output_path, e.stderr.decode(errors="replace").strip() or e))
+            except OSError as e:
+                results.append((output_path, e))
+
+    return results
@@ -1,19 +1,27 @@
 from audible_api import AudibleAPI
 from constants import artifacts_root_directory
 from readwise import Readwise
+from notion import NotionExporter
+from job_runner import JobRunner
+from metrics import METRICS
 from typing import Optional
-import audible
 
 help_dict = {
     "authenticate": "Logs in to Audible and stores credentials locally to be re-used",
     "readwise_authenticate": "Logs in to Readwise and stores token locally",
-    "readwise_post_highlights": "Posts selected highlights to Readwise",
-    "list_books": "Lists the users books",
-    "download_books": "Downloads books and saves them locally",
-    "convert_audiobook": "Removes Audible DRM from the selected audiobooks and converts them to .mp3 so they can be sliced",
+    "notion_export_highlights": "Exports highlights of the selected books to a Notion database, one page per book, --database_id=... or NOTION_DATABASE_ID, token from NOTION_TOKEN, --title_property=Name (default Heading) and --author_property=Author to fill a text property with the author",
+    "readwise_post_highlights": "Posts new highlights of the selected books to Readwise, --batch_size=N highlights per request",
+    "list_books": "Lists the users books, served from the local library cache, --refresh=true refetches it",
+    "new_books": "Syncs the library and lists the books purchased since new_books was last run",
+    "download_books": "Downloads books and saves them locally, --workers=N books at once, --segments=N connections per book, --decrypt=true writes the .m4b while downloading (add --keep_aax=true to keep the encrypted copy), --verify=true re-checks the checksum of books downloaded before",
+    "convert_audiobook": "Removes Audible DRM from the selected audiobooks (.m4b), add --mp3=true to also keep an .mp3 copy",
     "get_bookmarks": "WIP, extracts all timestamps for bookmarks in the selected audiobook",
-    "transcribe_bookmarks": "Self-explanatory, connects to Speech Recognition API and outputs the result",
+    "transcribe_bookmarks": "Self-explanatory, connects to Speech Recognition API and outputs the result, --backend=google|sphinx|stub picks the engine",
+    "slice_and_transcribe": "Slices and transcribes new bookmarks in one pass without writing clip files, --archive=true also keeps the .flac clips",
+    "pipeline": "Fetches, slices, transcribes and posts new bookmarks to Readwise in one overlapping pass, --post=false skips Readwise",
+    "run_job": "Runs stages for many books without prompting, --job=job.json or --books=all|ASIN,ASIN|title:<text>|author:<text> --stages=download,convert,clip,transcribe,readwise,notion, writes a JSON summary",
     "export_bookmarks": "Export bookmarks to JSON file in current directory",
+    "daemon": "Runs in the background with Audible, the client pools and the library kept loaded, later 'python main.py <command>' calls are handed to it, stop it with daemon_stop",
     "quit/exit": "Exits this application"
 }
 
@@ -32,8 +40,7 @@ class Command:
   def welcome(self):
     # authenticate with login
     try:
-        credentials = audible.Authenticator.from_file(f"{artifacts_root_directory}/secrets/credentials.json")
-        self.audible_obj = AudibleAPI(credentials)
+        self.audible_obj = AudibleAPI.from_file(f"{artifacts_root_directory}/secrets/credentials.json")
     except FileNotFoundError:
         print("\nNo Audible credentials found, please run 'authenticate' to generate them")
         credentials = None
@@ -88,6 +95,7 @@ class Command:
         return
         
     # Takes the command supplied and sees if we have a function with the prefix cmd_ that we can execute with the given kwargs
+    METRICS.reset()
     if command == "help":
       self.show_help()
     elif command == "authenticate":
@@ -96,29 +104,51 @@ class Command:
         self.readwise_obj = await Readwise.authenticate()
     elif command == "quit" or command == "exit":
       return
+    elif command == "pipeline":
+        await self.audible_obj.cmd_pipeline(readwise=self.readwise_obj, **_kwargs)
+    elif command == "run_job":
+        await JobRunner(self.audible_obj, self.readwise_obj).cmd_run_job(**_kwargs)
+    elif command.startswith("notion_"):
+        await self.run_notion_command(command, _kwargs)
     elif command.startswith("readwise"):
-        books = await self.audible_obj.get_book_selection()
+        books = await self.audible_obj.get_book_selection(_kwargs.pop("books", None))
         command = command.replace("readwise_", "")
         await getattr(self.readwise_obj, f"cmd_{command}", self.invalid_command_callback)(books, **_kwargs)    
     else:    
         await getattr(self.audible_obj, f"cmd_{command}", self.invalid_command_callback)(**_kwargs)
-    
+
+    METRICS.report(command)
     await self.command_loop()
   
   async def execute_command(self, command_input):
-    """Execute a single command without entering the interactive loop"""
+    """Execute a single command without entering the interactive loop, its stage metrics are reported once it is done"""
+    command_parts = command_input.split()
+    METRICS.reset()
+    try:
+        return await self.run_command(command_input)
+    finally:
+        METRICS.report(command_parts[0] if command_parts else "")
+
+  async def run_command(self, command_input):
     command_parts = command_input.split()
     command = command_parts[0] if command_parts else ""
     
     # Initialize audible_obj if not already done
     if not self.audible_obj and command not in AUTHLESS_COMMANDS:
         try:
-            credentials = audible.Authenticator.from_file(f"{artifacts_root_directory}/secrets/credentials.json")
-            self.audible_obj = AudibleAPI(credentials)
+            self.audible_obj = AudibleAPI.from_file(f"{artifacts_root_directory}/secrets/credentials.json")
         except FileNotFoundError:
             print("\nNo Audible credentials found, please run 'authenticate' to generate them")
             return
     
+    # The Readwise token is only needed by the commands that post to Readwise
+    if not self.readwise_obj and (command in ["pipeline", "run_job"] or command.startswith("readwise_post")):
+        try:
+            with open(f"{artifacts_root_directory}/secrets/readwise_token.json", "r") as file:
+                self.readwise_obj = Readwise(file.read())
+        except FileNotFoundError:
+            pass
+    
     # Handle commands with simple parameters (like "export_bookmarks_simple 0")
     if len(command_parts) > 1 and command == "export_bookmarks_simple":
         try:
@@ -154,9 +184,15 @@ class Command:
         self.readwise_obj = await Readwise.authenticate()
     elif command == "quit" or command == "exit":
       return
+    elif command == "pipeline":
+        await self.audible_obj.cmd_pipeline(readwise=self.readwise_obj, **_kwargs)
+    elif command == "run_job":
+        return await JobRunner(self.audible_obj, self.readwise_obj).cmd_run_job(**_kwargs)
+    elif command.startswith("notion_"):
+        await self.run_notion_command(command, _kwargs)
     elif command.startswith("readwise"):
         if self.audible_obj:
-            books = await self.audible_obj.get_book_selection()
+            books = await self.audible_obj.get_book_selection(_kwargs.pop("books", None))
             command = command.replace("readwise_", "")
             await getattr(self.readwise_obj, f"cmd_{command}")(books, **_kwargs)
         else:
@@ -164,6 +200,30 @@ class Command:
     else:    
         await getattr(self.audible_obj, f"cmd_{command}")(**_kwargs)
 
+  # Notion commands are methods of a NotionExporter for the database given with --database_id
+  async def run_notion_command(self, command, _kwargs):
+      notion_obj = NotionExporter.from_env(_kwargs.pop("database_id", None),
+                                           title_property=_kwargs.pop("title_property", None),
+                                           author_property=_kwargs.pop("author_property", None))
+      if not notion_obj:
+          return
+
+      try:
+          books = await self.audible_obj.get_book_selection(_kwargs.pop("books", None))
+          if _kwargs:
+              print(f"Ignoring unknown options for {command}: {', '.join(f'--{key}' for key in _kwargs)}")
+          command = command.replace("notion_", "")
+          await getattr(notion_obj, f"cmd_{command}", self.invalid_command_callback)(books)
+      finally:
+          await notion_obj.close()
+
+  # Closes the pooled HTTP clients held by the API objects
+  async def close(self):
+      if self.audible_obj:
+          await self.audible_obj.close()
+      if self.readwise_obj:
+          await self.readwise_obj.close()
+
   # Callbacks
   async def invalid_command_callback(self):
       print("Invalid command, try again")      
@@ -0,0 +1,157 @@
+import contextlib
+import io
+import os
+import sys
+
+from command import Command
+from constants import artifacts_root_directory
+
+# Where the daemon listens, a socket only the user can open. Override with AUDIBLE_EXTRACTOR_DAEMON
+DAEMON_ENDPOINT = os.environ.get("AUDIBLE_EXTRACTOR_DAEMON",
+                                 f"ipc://{os.path.join(artifacts_root_directory, 'daemon.sock')}")
+
+# Held by the running daemon, the lock goes away with the process so a crashed daemon never counts as running
+DAEMON_LOCK_PATH = os.path.join(artifacts_root_directory, "daemon.lock")
+
+# in ms, a daemon that doesn't answer a ping this fast is busy with another command and ours waits in its queue
+DAEMON_PING_TIMEOUT = 300
+
+# These prompt for input, so they always run in the terminal that asked for them
+IN_PROCESS_COMMANDS = ["help", "daemon", "authenticate", "readwise_authenticate", "quit", "exit"]
+
+
+def zmq_available():
+    try:
+        import zmq.asyncio  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def acquire_lock():
+    """Takes the daemon lock in the daemon process and writes its pid into the lock file, returns the open
+    lock file, or None when a daemon already holds it"""
+    import fcntl
+    os.makedirs(artifacts_root_directory, exist_ok=True)
+    lock_file = open(DAEMON_LOCK_PATH, "a+")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    lock_file.truncate(0)
+    lock_file.write(str(os.getpid()))
+    lock_file.flush()
+    return lock_file
+
+
+def daemon_running():
+    """Probes the daemon lock without taking it over, the lock file and the pid in it are left alone"""
+    try:
+        import fcntl
+    except ImportError:
+        # No flock on Windows, commands always run in-process there
+        return False
+
+    try:
+        with open(DAEMON_LOCK_PATH) as lock_file:
+            # A shared lock only conflicts with the daemon's, probing clients don't block each other
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    # Nobody held it, closing the file gave our shared lock back
+    return False
+
+
+async def serve(endpoint=DAEMON_ENDPOINT):
+    """Keeps one Command, and with it the AudibleAPI, its client pools and the library in memory between commands.
+    Requests are {"command": "..."} and replies {"ok": bool, "output": "...", "needs_input": bool}, one command
+    at a time, the others wait in the socket's queue"""
+    import zmq
+    import zmq.asyncio
+
+    lock_file = acquire_lock()
+    if lock_file is None:
+        print("A daemon is already running, stop it with: python main.py daemon_stop")
+        return
+
+    cmd = Command()
+    context = zmq.asyncio.Context()
+    socket = context.socket(zmq.REP)
+    socket.bind(endpoint)
+    if endpoint.startswith("ipc://"):
+        os.chmod(endpoint[len("ipc://"):], 0o600)
+    print(f"Daemon listening on {endpoint}, stop it with: python main.py daemon_stop")
+
+    try:
+        while True:
+            request = await socket.recv_json()
+            command_input = request.get("command", "")
+
+            if command_input == "ping":
+                await socket.send_json({"ok": True, "output": ""})
+                continue
+            if command_input == "daemon_stop":
+                await socket.send_json({"ok": True, "output": "Daemon stopped\n"})
+                break
+
+            print(f"Running command: {command_input}")
+            ok, output, needs_input = await run_captured(cmd, command_input)
+            await socket.send_json({"ok": ok, "output": output, "needs_input": needs_input})
+    finally:
+        await cmd.close()
+        socket.close(linger=0)
+        context.term()
+        lock_file.close()
+
+
+async def run_captured(cmd, command_input):
+    """Runs a command in the daemon and returns (ok, everything it printed, whether it asked for input)"""
+    output = io.StringIO()
+    stdin = sys.stdin
+    # There is nobody to answer a prompt, input() raises EOFError instead of blocking the daemon
+    sys.stdin = io.StringIO("")
+    try:
+        with contextlib.redirect_stdout(output):
+            result = await cmd.execute_command(command_input)
+        return result is not False, output.getvalue(), False
+    except EOFError:
+        return False, output.getvalue(), True
+    except Exception as e:
+        return False, output.getvalue() + f"\nError while executing {command_input}: {e}\n", False
+    finally:
+        sys.stdin = stdin
+
+
+async def forward_command(command_input, endpoint=DAEMON_ENDPOINT):
+    """Runs the command in a running daemon and prints its output. Returns whether it succeeded, or None when
+    there is no daemon or the command asks for input, then it has to run in this process"""
+    command = command_input.split()[0] if command_input.split() else ""
+    if command in IN_PROCESS_COMMANDS or not zmq_available() or not daemon_running():
+        return None
+
+    import zmq
+    import zmq.asyncio
+
+    context = zmq.asyncio.Context()
+    socket = context.socket(zmq.REQ)
+    socket.connect(endpoint)
+    try:
+        # The daemon runs one command at a time, ours waits for the one it is running instead of racing it
+        await socket.send_json({"command": "ping"})
+        if not await socket.poll(DAEMON_PING_TIMEOUT):
+            print("The daemon is busy, this command runs once it is done with the current one")
+        await socket.recv_json()
+
+        await socket.send_json({"command": command_input})
+        reply = await socket.recv_json()
+        if reply.get("needs_input"):
+            print("This command asks for input, running it here")
+            return None
+        print(reply["output"], end="")
+        return reply["ok"]
+    finally:
+        socket.close(linger=0)
+        context.term()
@@ -0,0 +1,398 @@
+import asyncio
+import hashlib
+import json
+import os
+
+from ffmpeg_runner import FFmpegError, StreamDecryptor, probe_duration
+from metrics import progress_printer, span
+
+# How many audiobooks are downloaded at the same time
+DOWNLOAD_WORKERS = 4
+
+# How many parallel connections a single audiobook is split over, 1 downloads it as one stream
+DOWNLOAD_SEGMENTS = 1
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+STREAM_DECRYPT_FAILED = ("Could not decrypt {label} while downloading, download it without --decrypt=true "
+                         "and run convert_audiobook instead")
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadManager:
+    """Downloads several audiobooks at once over one pooled async HTTP client, writing to disk off the event loop.
+    Every download goes to a .part file first so a dropped connection can be resumed"""
+
+    def __init__(self, workers=DOWNLOAD_WORKERS, segments=DOWNLOAD_SEGMENTS, client=None, verify=False):
+        self.workers = max(1, int(workers))
+        # More than one segment fetches each book over that many parallel Range connections
+        self.segments = max(1, int(segments))
+        # With verify a finished download is only skipped once its checksum matches, not just its size
+        self.verify = verify
+        self.semaphore = asyncio.Semaphore(self.workers)
+        # A client passed in is owned by the caller and left open, otherwise the manager makes its own
+        self.client = client
+        self.owns_client = client is None
+
+    async def __aenter__(self):
+        if self.owns_client:
+            import httpx
+            max_connections = self.workers * self.segments
+            self.client = httpx.AsyncClient(
+                follow_redirects=True,
+                timeout=httpx.Timeout(30.0, read=120.0),
+                limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.owns_client:
+            await self.client.aclose()
+
+    @staticmethod
+    def manifest_path(path):
+        return f"{path}.json"
+
+    def is_complete(self, path):
+        """O(1) check for a finished download, the file has to be there with the size recorded when it was verified"""
+        try:
+            with open(self.manifest_path(path)) as f:
+                manifest = json.load(f)
+            return os.path.getsize(path) == manifest["size"]
+        except (OSError, ValueError, KeyError):
+            return False
+
+    async def is_downloaded(self, path):
+        """is_complete, or with verify the full checksum check. A file that fails it is removed to be downloaded again"""
+        if not self.is_complete(path):
+            return False
+        if not self.verify or await asyncio.to_thread(verify_file, path):
+            return True
+
+        print(f"{os.path.basename(path)} doesn't match the checksum it was downloaded with, downloading it again")
+        os.remove(path)
+        os.remove(self.manifest_path(path))
+        return False
+
+    @staticmethod
+    async def resolve_url(url):
+        return str(await url()) if callable(url) else url
+
+    async def download(self, url, path, label):
+        """Downloads url into path.part, resuming a previous partial download with a Range request,
+        and only moves it to path once the size, checksum and duration have been verified.
+        url can be a coroutine function returning it, it is then called once a worker slot is free
+        so a signed link doesn't expire while the download waits its turn"""
+        part_path = f"{path}.part"
+
+        async with self.semaphore:
+            url = await self.resolve_url(url)
+            with span("download", items=1, book=label) as download_span:
+                # A .part left by a single stream download is resumed as a single stream
+                resume_segments = os.path.exists(self.segments_state_path(part_path))
+                if resume_segments or (self.segments > 1 and not os.path.exists(part_path)):
+                    total_length, sha256 = await self.download_segmented(url, part_path, label, download_span)
+                else:
+                    total_length, sha256 = await self.download_stream(url, part_path, label, download_span)
+
+        return await self.finalize(part_path, path, total_length, sha256)
+
+    async def download_decrypted(self, url, m4b_path, label, activation_bytes, aax_path=None):
+        """Pipes the body of url straight into an ffmpeg decrypt process, so the .m4b is written while the .aax
+        arrives instead of being read back from disk by convert_audiobook. The encrypted copy is only written
+        when aax_path is given. ffmpeg needs the stream from its first byte, so this is always a single
+        connection and a failed download starts over. url is resolved like in download"""
+        m4b_part_path = f"{m4b_path}.part"
+        aax_part_path = f"{aax_path}.part" if aax_path else None
+        decryptor = StreamDecryptor(activation_bytes, m4b_part_path)
+
+        async with self.semaphore:
+            url = await self.resolve_url(url)
+            with span("download", items=1, book=label) as download_span, \
+                    span("decrypt", items=1, book=label) as decrypt_span:
+                aax_file = None
+                try:
+                    async with self.client.stream("GET", url) as response:
+                        if response.status_code != 200:
+                            await response.aread()
+                            raise DownloadError(f"HTTP {response.status_code}: {response.text[:200]}")
+
+                        print(f"Downloading and decrypting {label}")
+                        total_length = response.headers.get("content-length")
+                        total_length = int(total_length) if total_length is not None else None
+                        on_progress = progress_printer(label, total_length) if total_length else None
+
+                        await decryptor.start()
+                        if aax_part_path:
+                            aax_file = await asyncio.to_thread(open, aax_part_path, "wb")
+                        checksum = hashlib.sha256()
+                        dl = 0
+                        async for data in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                            if not await decryptor.write(data):
+                                # ffmpeg gave up on the stream, finish() raises with its error
+                                break
+                            if aax_file:
+                                await asyncio.to_thread(aax_file.write, data)
+                            checksum.update(data)
+                            dl += len(data)
+                            download_span.add(bytes=len(data))
+                            if on_progress:
+                                on_progress(dl)
+
+                    await decryptor.finish()
+                except FFmpegError as e:
+                    await decryptor.abort()
+                    raise DownloadError(f"{STREAM_DECRYPT_FAILED.format(label=label)}: {e}")
+                except BaseException:
+                    await decryptor.abort()
+                    raise
+                finally:
+                    if aax_file:
+                        await asyncio.to_thread(aax_file.close)
+                size = os.path.getsize(m4b_part_path) if os.path.exists(m4b_part_path) else 0
+                decrypt_span.add(bytes=size)
+                # ffmpeg can exit cleanly without writing any audio, i.e when the moov atom comes after it
+                decrypt_span.ok = size > 0
+
+        if total_length is not None and dl != total_length:
+            await decryptor.abort()
+            raise DownloadError(f"Download truncated, got {dl} of {total_length} bytes")
+
+        duration = None
+        try:
+            duration = await probe_duration(m4b_part_path) if size else None
+            readable = bool(duration)
+        except FileNotFoundError:
+            # ffprobe isn't installed, an empty .m4b is all we can catch
+            readable = size > 0
+        if not readable:
+            await decryptor.abort()
+            raise DownloadError(f"{STREAM_DECRYPT_FAILED.format(label=label)}, the partial .m4b has been removed")
+
+        os.replace(m4b_part_path, m4b_path)
+        # The checksum is the one of the encrypted stream, the .m4b itself is never read back
+        with open(self.manifest_path(m4b_path), "w") as f:
+            json.dump({"size": size, "aax_sha256": checksum.hexdigest(), "duration": duration}, f, indent=2)
+
+        if aax_part_path:
+            await self.finalize(aax_part_path, aax_path, total_length, checksum.hexdigest())
+        return size
+
+    async def download_stream(self, url, part_path, label, download_span=None):
+        """Single connection download, appends to an existing .part file when the server honours Range.
+        Received bytes are added to download_span"""
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        async with self.client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 416:
+                await response.aread()
+                # Content-Range: bytes */<size>, the .part already has every byte when the run before stopped
+                # between the last chunk and finalize
+                total_length = parse_content_range_total(response.headers.get("content-range"))
+                if total_length == offset:
+                    print(f"{label} was already downloaded completely, verifying it")
+                    checksum = await asyncio.to_thread(hash_file, part_path, hashlib.sha256())
+                    return total_length, checksum.hexdigest()
+
+                # The partial file doesn't match what the server has anymore, start over
+                os.remove(part_path)
+                raise DownloadError("Server rejected the resume range, partial download discarded, try again")
+
+            if response.status_code not in [200, 206]:
+                await response.aread()
+                raise DownloadError(f"HTTP {response.status_code}: {response.text[:200]}")
+
+            if response.status_code == 206:
+                print(f"Resuming {label} from {offset // DOWNLOAD_CHUNK_SIZE} MB")
+                total_length = parse_content_range_total(response.headers.get("content-range"))
+                mode = "ab"
+            else:
+                # Server ignored the Range header, it is sending the whole file again
+                print("Downloading %s" % label)
+                offset = 0
+                total_length = response.headers.get("content-length")
+                total_length = int(total_length) if total_length is not None else None
+                mode = "wb"
+
+            checksum = hashlib.sha256()
+            if offset:
+                await asyncio.to_thread(hash_file, part_path, checksum)
+
+            if total_length is None:  # no content length header
+                print(f"Unable to estimate download size for {label}, downloading, this might take a while...")
+                on_progress = None
+            else:
+                on_progress = progress_printer(label, total_length)
+
+            f = await asyncio.to_thread(open, part_path, mode)
+            try:
+                dl = offset
+                async for data in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, data)
+                    checksum.update(data)
+                    dl += len(data)
+                    if download_span:
+                        download_span.add(bytes=len(data))
+                    if on_progress:
+                        on_progress(dl)
+            finally:
+                await asyncio.to_thread(f.close)
+
+        return total_length, checksum.hexdigest()
+
+    @staticmethod
+    def segments_state_path(part_path):
+        return f"{part_path}.json"
+
+    async def probe_range_support(self, url):
+        """Returns the total size when the server answers a Range request with 206, None otherwise"""
+        async with self.client.stream("GET", url, headers={"Range": "bytes=0-0"}) as response:
+            # A server that ignores Range answers 200 with the whole audiobook, leaving the block
+            # closes the stream without reading any of it
+            if response.status_code != 206:
+                return None
+            await response.aread()
+            return parse_content_range_total(response.headers.get("content-range"))
+
+    async def download_segmented(self, url, part_path, label, download_span=None):
+        """Splits one file into byte ranges fetched over several connections into a preallocated .part file.
+        Finished segments are recorded next to it so an interrupted download only refetches the missing ones"""
+        state_path = self.segments_state_path(part_path)
+        state = None
+        if os.path.exists(state_path) and os.path.exists(part_path):
+            with open(state_path) as f:
+                state = json.load(f)
+
+        total_length = await self.probe_range_support(url)
+        if total_length is None:
+            print(f"Server doesn't support ranged downloads for {label}, falling back to a single connection")
+            if os.path.exists(state_path):
+                os.remove(state_path)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return await self.download_stream(url, part_path, label, download_span)
+
+        if not state or state.get("size") != total_length:
+            segment_size = -(-total_length // max(1, self.segments))
+            state = {
+                "size": total_length,
+                "segments": [[start, min(start + segment_size, total_length) - 1]
+                             for start in range(0, total_length, segment_size)],
+                "done": []
+            }
+
+            def preallocate():
+                with open(part_path, "wb") as f:
+                    f.truncate(total_length)
+            await asyncio.to_thread(preallocate)
+            self.save_segments_state(state_path, state)
+            print(f"Downloading {label} over {len(state['segments'])} connections")
+        else:
+            print(f"Resuming {label}, {len(state['done'])} of {len(state['segments'])} segments already done")
+
+        on_progress = progress_printer(label, total_length)
+        progress = [sum(end - start + 1 for index, (start, end) in enumerate(state["segments"])
+                        if index in state["done"])]
+
+        async def fetch_segment(index, start, end):
+            async with self.client.stream("GET", url, headers={"Range": f"bytes={start}-{end}"}) as response:
+                if response.status_code != 206:
+                    await response.aread()
+                    raise DownloadError(f"Segment {start}-{end} failed with HTTP {response.status_code}")
+
+                f = await asyncio.to_thread(open, part_path, "r+b")
+                try:
+                    await asyncio.to_thread(f.seek, start)
+                    written = 0
+                    async for data in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                        # Never write past the segment, in case the server sends more than was asked for
+                        data = data[:end - start + 1 - written]
+                        await asyncio.to_thread(f.write, data)
+                        written += len(data)
+                        progress[0] += len(data)
+                        if download_span:
+                            download_span.add(bytes=len(data))
+                        on_progress(progress[0])
+                finally:
+                    await asyncio.to_thread(f.close)
+
+            if written != end - start + 1:
+                raise DownloadError(f"Segment {start}-{end} truncated, got {written} bytes")
+            state["done"].append(index)
+            self.save_segments_state(state_path, state)
+
+        tasks = [asyncio.ensure_future(fetch_segment(index, start, end))
+                 for index, (start, end) in enumerate(state["segments"])
+                 if index not in state["done"]]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the other segments before giving up the worker slot, they would keep writing into the .part file
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        checksum = await asyncio.to_thread(hash_file, part_path, hashlib.sha256())
+        os.remove(state_path)
+        return total_length, checksum.hexdigest()
+
+    @staticmethod
+    def save_segments_state(state_path, state):
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+
+    async def finalize(self, part_path, path, total_length, sha256):
+        """Validates a finished .part file and moves it in place next to a manifest used to skip it on later runs"""
+        size = os.path.getsize(part_path)
+        if total_length is not None and size != total_length:
+            # Leave the .part file behind, the next run resumes from where this one stopped
+            raise DownloadError(f"Download truncated, got {size} of {total_length} bytes")
+
+        try:
+            duration = await probe_duration(part_path)
+        except FileNotFoundError:
+            # ffprobe isn't installed, size and checksum are all we can check
+            duration = None
+        else:
+            if not duration:
+                os.remove(part_path)
+                raise DownloadError("Downloaded file is not a readable audiobook, it has been removed")
+
+        os.replace(part_path, path)
+        with open(self.manifest_path(path), "w") as f:
+            json.dump({"size": size, "sha256": sha256, "duration": duration}, f, indent=2)
+
+        return size
+
+
+def parse_content_range_total(content_range):
+    # Content-Range: bytes 1000-5000/5001
+    try:
+        total = content_range.rsplit("/", 1)[1]
+        return None if total == "*" else int(total)
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+def hash_file(path, checksum):
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+            checksum.update(data)
+    return checksum
+
+
+def verify_file(path):
+    """Full integrity check of a finished download against the checksum stored in its manifest"""
+    try:
+        with open(DownloadManager.manifest_path(path)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if os.path.getsize(path) != manifest.get("size"):
+        return False
+    return hash_file(path, hashlib.sha256()).hexdigest() == manifest.get("sha256")
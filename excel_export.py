@@ -0,0 +1,65 @@
+import re
+
+# Excel limits sheet names to 31 characters and doesn't allow []:*?/\ in them
+SHEET_NAME_MAX_LENGTH = 31
+INVALID_SHEET_NAME_CHARACTERS = re.compile(r"[\[\]:*?/\\]")
+
+
+class TranscriptionWorkbook:
+    """Builds the transcriptions workbook once per run, one sheet per book. Rows are streamed to disk
+    in xlsxwriter's constant memory mode so memory doesn't grow with the number of clips"""
+
+    def __init__(self, path):
+        import xlsxwriter
+        self.path = path
+        self.workbook = xlsxwriter.Workbook(path, {"constant_memory": True})
+        self.sheet_names = set()
+
+        # Create header format to be used in all headers
+        self.header_format = self.workbook.add_format({
+            "valign": "vcenter",
+            "align": "center",
+            "bg_color": "#FFA500",
+            "bold": True,
+            "font_color": "#FFFFFF"})
+
+        # Set desired cell format
+        self.cell_format = self.workbook.add_format()
+        self.cell_format.set_align("vcenter")
+        self.cell_format.set_align("center")
+        self.cell_format.set_text_wrap(True)
+
+    def sheet_name(self, title):
+        base_name = INVALID_SHEET_NAME_CHARACTERS.sub("", title)[:SHEET_NAME_MAX_LENGTH] or "untitled"
+        name = base_name
+        counter = 2
+        # Two books can share the first 31 characters of their title
+        while name.lower() in self.sheet_names:
+            suffix = f" ({counter})"
+            name = base_name[:SHEET_NAME_MAX_LENGTH - len(suffix)] + suffix
+            counter += 1
+        self.sheet_names.add(name.lower())
+        return name
+
+    def add_book(self, title, rows):
+        """Writes a sheet for a book, rows is an iterable of (clip note, transcription) in clip order"""
+        worksheet = self.workbook.add_worksheet(self.sheet_name(title))
+
+        # Apply header format and format columns to fit data
+        worksheet.set_column("A:A", 50)
+        worksheet.set_column("B:B", 100)
+        worksheet.write(0, 0, "Clip Note", self.header_format)
+        worksheet.write(0, 1, "Transcription", self.header_format)
+
+        # Format cells for appropiate size, wrap the text for style points
+        # constant memory mode needs every row written in order, which rows from the sync state are
+        row_count = 0
+        for row, (heading, text) in enumerate(rows, start=1):
+            worksheet.set_row(row, 100, self.cell_format)
+            worksheet.write_string(row, 0, heading, self.cell_format)
+            worksheet.write_string(row, 1, text, self.cell_format)
+            row_count = row
+        return row_count
+
+    def close(self):
+        self.workbook.close()
@@ -0,0 +1,173 @@
+import asyncio
+import os
+
+from metrics import progress_printer, span
+
+# FFMPEG needs to be installed for this module! see readme for more details
+
+# How many books are converted at the same time, every ffmpeg process already uses more than one core
+FFMPEG_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+
+# in seconds, a single ffmpeg pass taking longer than this is killed and recorded as failed
+FFMPEG_TIMEOUT = 4 * 60 * 60
+
+
+class FFmpegError(Exception):
+    pass
+
+
+async def probe_duration(path, input_args=()):
+    """Returns the duration of a media file in seconds, or None when ffprobe can't tell"""
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", "-v", "error", *input_args,
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+
+    try:
+        return float(stdout.decode().strip())
+    except ValueError:
+        return None
+
+
+async def _terminate(process):
+    if process.returncode is not None:
+        return
+    process.terminate()
+    try:
+        await asyncio.wait_for(process.wait(), 5)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def _read_progress(stream, duration, on_progress):
+    # ffmpeg -progress writes key=value lines, out_time_us is the position in the output so far
+    async for raw_line in stream:
+        key, _, value = raw_line.decode(errors="replace").strip().partition("=")
+        if key in ["out_time_us", "out_time_ms"] and on_progress and duration:
+            try:
+                position = int(value) / 1000000
+            except ValueError:
+                continue
+            on_progress(min(position / duration, 1.0))
+        elif key == "progress" and value == "end" and on_progress:
+            on_progress(1.0)
+
+
+async def run_ffmpeg(args, duration=None, on_progress=None, timeout=FFMPEG_TIMEOUT):
+    """Runs one ffmpeg pass without a shell, args are everything after the global options.
+    on_progress is called with a 0-1 fraction when the input duration (in seconds) is known"""
+    command = [
+        "ffmpeg", "-nostdin", "-hide_banner", "-loglevel", "error", "-y",
+        "-progress", "pipe:1", "-nostats",
+        *args
+    ]
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stderr_task = asyncio.ensure_future(process.stderr.read())
+
+    try:
+        await asyncio.wait_for(_read_progress(process.stdout, duration, on_progress), timeout)
+        await process.wait()
+    except asyncio.TimeoutError:
+        await _terminate(process)
+        raise FFmpegError(f"ffmpeg timed out after {timeout}s")
+    except asyncio.CancelledError:
+        await _terminate(process)
+        raise
+    finally:
+        stderr = await stderr_task
+
+    if process.returncode != 0:
+        raise FFmpegError(stderr.decode(errors="replace").strip() or f"ffmpeg exited with {process.returncode}")
+
+
+class StreamDecryptor:
+    """An ffmpeg process decrypting an .aax that is written to it chunk by chunk into an .m4b, so a book can be
+    decrypted while it downloads. The mp4 demuxer reads its stdin front to back, which works because Audible
+    puts the moov atom in front of the audio"""
+
+    def __init__(self, activation_bytes, output_path):
+        self.activation_bytes = activation_bytes
+        self.output_path = output_path
+        self.process = None
+        self.stderr_task = None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-y",
+            "-activation_bytes", self.activation_bytes,
+            "-i", "pipe:0",
+            # The output has no .m4b extension until it is verified, so the muxer is named
+            "-c", "copy", "-f", "ipod", self.output_path,
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+        self.stderr_task = asyncio.ensure_future(self.process.stderr.read())
+        return self
+
+    async def write(self, data):
+        """Returns False once ffmpeg stopped reading, finish() then raises with the reason"""
+        try:
+            self.process.stdin.write(data)
+            await self.process.stdin.drain()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+
+    async def finish(self):
+        """Closes the stream and waits for ffmpeg to write the end of the .m4b"""
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        await self.process.wait()
+        stderr = await self.stderr_task
+        if self.process.returncode != 0:
+            raise FFmpegError(stderr.decode(errors="replace").strip() or f"ffmpeg exited with {self.process.returncode}")
+
+    async def abort(self):
+        if self.process:
+            await _terminate(self.process)
+            await self.stderr_task
+        if os.path.exists(self.output_path):
+            os.remove(self.output_path)
+
+
+class FFmpegRunner:
+
+    def __init__(self, workers=FFMPEG_WORKERS, timeout=FFMPEG_TIMEOUT):
+        self.semaphore = asyncio.Semaphore(max(1, int(workers)))
+        self.timeout = int(timeout)
+
+    async def run_steps(self, label, steps, duration=None):
+        """Runs the (stage, args, output_path) steps of one job in order, removing the output of a step that didn't finish.
+        stage is the metrics stage the step is timed as, i.e decrypt or transcode"""
+        async with self.semaphore:
+            for stage, args, output_path in steps:
+                try:
+                    with span(stage, items=1, book=label) as step_span:
+                        await run_ffmpeg(args, duration,
+                                         progress_printer(f"{label} -> {os.path.basename(output_path)}"),
+                                         self.timeout)
+                        step_span.add(bytes=os.path.getsize(output_path))
+                except BaseException:
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    raise
+
+    async def run_all(self, jobs):
+        """jobs is a list of (key, label, steps, duration), returns {key: error} for every job that failed"""
+        results = await asyncio.gather(
+            *[self.run_steps(label, steps, duration) for _, label, steps, duration in jobs],
+            return_exceptions=True)
+
+        failures = {}
+        for (key, _, _, _), result in zip(jobs, results):
+            if isinstance(result, asyncio.CancelledError):
+                raise result
+            if isinstance(result, Exception):
+                failures[key] = result
+        return failures
@@ -0,0 +1,269 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+
+from constants import artifacts_root_directory
+from sync_state import SyncState
+from downloader import DownloadManager, DOWNLOAD_SEGMENTS, DOWNLOAD_WORKERS
+from ffmpeg_runner import FFmpegRunner, FFMPEG_TIMEOUT, FFMPEG_WORKERS
+from transcription import TranscriptionPool, get_backend, DEFAULT_TRANSCRIPTION_BACKEND, TRANSCRIPTION_WORKERS
+
+# Every stage a job can run and the stages it needs first. A stage whose dependency isn't part of the job
+# assumes an earlier run already did it, i.e stages=transcribe,readwise for books that are already clipped
+JOB_STAGES = {
+    "download": [],
+    "convert": ["download"],
+    "clip": ["convert"],
+    "transcribe": ["clip"],
+    "readwise": ["transcribe"],
+    "notion": ["transcribe"]
+}
+
+# How many books go through the stage graph at the same time, the stages themselves are bounded by their own pools
+JOB_BOOK_CONCURRENCY = 4
+
+
+class JobError(Exception):
+    pass
+
+
+def stage_graph(stages):
+    """stages is a list of stage names, or a dict of stage name to the stages it depends on.
+    Returns {stage: [dependencies that are part of the job]}, raises JobError for unknown stages and cycles"""
+    if isinstance(stages, str):
+        stages = [stage.strip() for stage in stages.split(",") if stage.strip()]
+    if isinstance(stages, list):
+        stages = {stage: JOB_STAGES.get(stage, []) for stage in stages}
+
+    unknown = [stage for stage in stages if stage not in JOB_STAGES]
+    if unknown:
+        raise JobError(f"Unknown stages {', '.join(unknown)}, choose from: {', '.join(JOB_STAGES)}")
+    graph = {stage: [dependency for dependency in dependencies if dependency in stages]
+             for stage, dependencies in stages.items()}
+
+    visiting, done = set(), set()
+
+    def visit(stage):
+        if stage in done:
+            return
+        if stage in visiting:
+            raise JobError(f"Stage {stage} is part of a dependency cycle")
+        visiting.add(stage)
+        for dependency in graph[stage]:
+            visit(dependency)
+        done.add(stage)
+
+    for stage in graph:
+        visit(stage)
+    return graph
+
+
+class JobRunner:
+    """Runs a list of stages for many books without prompting, for cron and other unattended runs.
+    Books go through the stage graph independently and concurrently, one failing doesn't hold back the others,
+    and the outcome of every stage of every book is written to a JSON summary"""
+
+    def __init__(self, api, readwise=None):
+        self.api = api
+        self.readwise = readwise
+        self.notion = None
+        self.manager = None
+        self.ffmpeg_runner = None
+        self.activation_bytes = None
+        self.transcription_pool = None
+        self.transcribed_books = []
+
+    def load_job(self, job=None, **overrides):
+        """Reads the job file and applies the command line flags on top of it"""
+        spec = {}
+        if job:
+            with open(job) as f:
+                spec = json.load(f)
+        spec.update({key: value for key, value in overrides.items() if value is not None})
+        spec.setdefault("options", {})
+        return spec
+
+    async def cmd_run_job(self, job=None, books=None, stages=None, concurrency=None, summary=None, **options):
+        """Returns whether every stage of every book succeeded, options like --backend=stub are passed to every stage"""
+        try:
+            spec = self.load_job(job, books=books, stages=stages, concurrency=concurrency, summary=summary)
+            graph = stage_graph(spec.get("stages") or [])
+        except (OSError, ValueError, JobError) as e:
+            print(f"Invalid job: {e}")
+            return False
+
+        if not graph:
+            print(f"No stages to run, pass --stages=... with any of: {', '.join(JOB_STAGES)}")
+            return False
+        if spec.get("books") is None:
+            print("No books selected, pass --books=all, a comma separated list of ASINs, title:<text> or author:<text>")
+            return False
+
+        li_books = await self.api.get_book_selection(spec["books"])
+        stage_options = {stage: {**options, **spec["options"].get(stage, {})} for stage in graph}
+        semaphore = asyncio.Semaphore(max(1, int(spec.get("concurrency") or JOB_BOOK_CONCURRENCY)))
+        started_at = datetime.now().isoformat()
+        print(f"Running {', '.join(graph)} for {len(li_books)} books")
+
+        async def run_book(book):
+            async with semaphore:
+                return await self.run_book(book, graph, stage_options)
+
+        try:
+            await self.setup(graph, stage_options)
+            results = await asyncio.gather(*[run_book(book) for book in li_books])
+        except (ValueError, JobError) as e:
+            print(f"Invalid job: {e}")
+            return False
+        finally:
+            await self.teardown()
+
+        summary = {
+            "started_at": started_at,
+            "finished_at": datetime.now().isoformat(),
+            "stages": graph,
+            "books": results,
+            "succeeded": sum(result["status"] == "ok" for result in results),
+            "failed": sum(result["status"] != "ok" for result in results)
+        }
+        self.write_summary(summary, spec.get("summary"))
+        return summary["failed"] == 0
+
+    # Creates the pools the stages share across books, only for the stages that are part of the job
+    async def setup(self, graph, stage_options):
+        if "download" in graph:
+            options = stage_options["download"]
+            self.manager = DownloadManager(workers=options.get("workers", DOWNLOAD_WORKERS),
+                                           segments=options.get("segments", DOWNLOAD_SEGMENTS),
+                                           client=self.api.get_http_client(),
+                                           verify=str(options.get("verify")).lower() == "true")
+            await self.manager.__aenter__()
+            if str(options.get("decrypt")).lower() == "true":
+                self.activation_bytes = self.api.get_activation_bytes()
+        if "convert" in graph:
+            options = stage_options["convert"]
+            self.activation_bytes = self.api.get_activation_bytes()
+            self.ffmpeg_runner = FFmpegRunner(workers=options.get("workers", FFMPEG_WORKERS),
+                                              timeout=options.get("timeout", FFMPEG_TIMEOUT))
+        if "transcribe" in graph:
+            options = stage_options["transcribe"]
+            self.transcription_pool = TranscriptionPool(get_backend(options.get("backend", DEFAULT_TRANSCRIPTION_BACKEND)),
+                                                        workers=options.get("workers", TRANSCRIPTION_WORKERS))
+        if "readwise" in graph and not self.readwise:
+            raise JobError("No Readwise Token found, run readwise_authenticate first")
+        if "notion" in graph:
+            from notion import NotionExporter
+            options = stage_options["notion"]
+            self.notion = NotionExporter.from_env(options.get("database_id"),
+                                                  title_property=options.get("title_property"),
+                                                  author_property=options.get("author_property"))
+            if not self.notion:
+                raise JobError("Notion is not configured")
+
+    async def teardown(self):
+        if self.manager:
+            await self.manager.__aexit__(None, None, None)
+        if self.transcription_pool:
+            self.transcription_pool.backend.close()
+        if self.transcribed_books:
+            # Later stages like readwise save the exported flags through their own SyncState, so the state is
+            # read back from disk instead of writing the one held since the transcribe stage over it
+            for title in self.transcribed_books:
+                SyncState(os.path.join(artifacts_root_directory, "audiobooks", title)).write_contents()
+            self.api.write_workbook()
+            self.api.get_clip_cache().save()
+        if self.notion:
+            await self.notion.close()
+
+    async def run_book(self, book, graph, stage_options):
+        """Runs every stage once its dependencies succeeded, independent stages of a book run at the same time"""
+        result = {"asin": book.get("asin"), "title": book.get("title"), "stages": {}}
+        tasks = {}
+
+        async def run_stage(stage):
+            dependencies = [await tasks[dependency] for dependency in graph[stage]]
+            if not all(dependencies):
+                result["stages"][stage] = {"status": "skipped", "error": "a stage it depends on failed"}
+                return False
+
+            start = time.perf_counter()
+            try:
+                details = await getattr(self, f"stage_{stage}")(book, stage_options[stage])
+                result["stages"][stage] = {"status": "ok", **(details or {})}
+            except Exception as e:
+                print(f"{stage} failed for {book.get('title')}: {e}")
+                result["stages"][stage] = {"status": "failed", "error": str(e)}
+            result["stages"][stage]["seconds"] = round(time.perf_counter() - start, 3)
+            return result["stages"][stage]["status"] == "ok"
+
+        for stage in graph:
+            tasks[stage] = asyncio.ensure_future(run_stage(stage))
+        await asyncio.gather(*tasks.values())
+
+        result["status"] = "ok" if all(stage["status"] == "ok" for stage in result["stages"].values()) else "failed"
+        return result
+
+    def title_path(self, book):
+        title = book.get("title") or "untitled"
+        title = title.lower().replace(" ", "_")
+        return os.path.join(artifacts_root_directory, "audiobooks", title, title)
+
+    async def stage_download(self, book, options):
+        book_infos = await self.api.get_book_infos(book.get("asin"))
+        if not book_infos:
+            raise JobError("could not get the book details from Audible")
+        # With decrypt the .m4b is written while downloading and the convert stage finds it already converted
+        activation_bytes = self.activation_bytes if str(options.get("decrypt")).lower() == "true" else None
+        keep_aax = str(options.get("keep_aax")).lower() == "true"
+        if not await self.api.download_book(book_infos["item"], self.manager, activation_bytes, keep_aax):
+            raise JobError("Audible doesn't allow downloading this book")
+
+    async def stage_convert(self, book, options):
+        if os.path.exists(f"{self.title_path(book)}.m4b"):
+            return {"note": "already converted"}
+
+        job = await self.api.get_convert_job(book, self.activation_bytes, str(options.get("mp3")).lower() == "true")
+        if not job:
+            raise JobError("no .aax to convert")
+        _, label, steps, duration = job
+        await self.ffmpeg_runner.run_steps(label, steps, duration)
+
+    async def stage_clip(self, book, options):
+        plan = await self.api.get_bookmarks(book)
+        if not plan:
+            raise JobError("no audio to slice clips from")
+        if plan["failed"]:
+            raise JobError(f"{plan['failed']} of {len(plan['to_slice'])} clips could not be sliced")
+        return {"clips": len(plan["clips"]), "sliced": len(plan["to_slice"]), "removed": len(plan["removed"])}
+
+    async def stage_transcribe(self, book, options):
+        title, state, jobs = self.api.prepare_transcription(book, self.transcription_pool.backend)
+        self.transcribed_books.append(title)
+        failures = await self.api.transcribe_clips(self.transcription_pool, jobs)
+        state.save()
+        if failures:
+            raise JobError(f"{failures} of {len(jobs)} clips could not be transcribed")
+        return {"transcribed": len(jobs)}
+
+    async def stage_readwise(self, book, options):
+        if not await self.readwise.post_book(book):
+            raise JobError("not every highlight could be posted to Readwise")
+
+    async def stage_notion(self, book, options):
+        return {"exported": await self.notion.export_book_highlights(book)}
+
+    def write_summary(self, summary, path=None):
+        if not path:
+            jobs_dir_path = os.path.join(artifacts_root_directory, "jobs")
+            os.makedirs(jobs_dir_path, exist_ok=True)
+            path = os.path.join(jobs_dir_path, f"summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+
+        for result in summary["books"]:
+            stages = ", ".join(f"{stage}: {outcome['status']}" for stage, outcome in result["stages"].items())
+            print(f"{result['status'].upper():6} {result['title']} ({stages})")
+        print(f"{summary['succeeded']} books succeeded, {summary['failed']} failed, summary saved to {path}")
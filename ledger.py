@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import time
+
+from constants import artifacts_root_directory
+
+
+def highlight_key(highlight):
+    """Identifies a highlight by what it says and which book it is from, the same text posted twice is one highlight"""
+    payload = json.dumps([highlight.get("title"), highlight.get("author"), highlight.get("text"), highlight.get("note")])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class DeliveryLedger:
+    """Local record of the highlights an export target already accepted, so reruns only send new ones.
+    Unlike the per book sync state it also covers books posted from contents.json"""
+
+    def __init__(self, name):
+        self.dir_path = os.path.join(artifacts_root_directory, "ledgers")
+        self.path = os.path.join(self.dir_path, f"{name}.json")
+        # delivered maps highlight_key to the time it was delivered, refs maps names to ids on the target,
+        # i.e the Notion page of a book
+        self.data = {"delivered": {}, "refs": {}}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.data.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    def save(self):
+        os.makedirs(self.dir_path, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+    @property
+    def delivered(self):
+        return self.data["delivered"]
+
+    @property
+    def refs(self):
+        return self.data["refs"]
+
+    def set_ref(self, name, ref):
+        self.refs[name] = ref
+        self.save()
+
+    def is_delivered(self, highlight):
+        return highlight_key(highlight) in self.delivered
+
+    def mark_delivered(self, highlights):
+        now = time.time()
+        for highlight in highlights:
+            self.delivered[highlight_key(highlight)] = now
+        self.save()
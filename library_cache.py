@@ -0,0 +1,100 @@
+import os
+import time
+from datetime import datetime, timezone
+
+from constants import artifacts_root_directory
+
+# in seconds, how long the cached library is served before it is refreshed with the items added since the last sync
+LIBRARY_CACHE_TTL = 6 * 60 * 60
+
+
+class LibraryCache:
+    """Keeps the user's library and book infos on disk in msgpack, one file per account and locale"""
+
+    def __init__(self, account, locale, ttl=LIBRARY_CACHE_TTL):
+        self.path = os.path.join(artifacts_root_directory, "cache", f"library_{account}_{locale}.msgpack")
+        self.ttl = ttl
+        self.data = {
+            # epoch seconds of the last sync, and the same moment as the ISO date Audible filters on
+            "synced_at": None,
+            "synced_at_iso": None,
+            "items": [],
+            # asins that showed up in a sync since new books were last shown
+            "new_asins": [],
+            "book_infos": {},
+            # What the items were fetched with, a cache filled with other response groups needs a full sync
+            "response_groups": None
+        }
+        self.load()
+
+    def load(self):
+        import msgpack
+        try:
+            with open(self.path, "rb") as f:
+                self.data.update(msgpack.unpackb(f.read(), raw=False))
+        except (OSError, ValueError, msgpack.exceptions.ExtraData):
+            pass
+
+    def save(self):
+        import msgpack
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(msgpack.packb(self.data, use_bin_type=True))
+        os.replace(tmp_path, self.path)
+
+    @property
+    def items(self):
+        return self.data["items"]
+
+    @property
+    def synced_at_iso(self):
+        return self.data["synced_at_iso"]
+
+    @property
+    def response_groups(self):
+        return self.data["response_groups"]
+
+    def is_fresh(self):
+        synced_at = self.data["synced_at"]
+        return synced_at is not None and time.time() - synced_at < self.ttl
+
+    def mark_synced(self):
+        self.data["synced_at"] = time.time()
+        self.data["synced_at_iso"] = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def replace_items(self, items, response_groups=None):
+        known_asins = {item["asin"] for item in self.items}
+        if known_asins:
+            self.add_new_asins([item["asin"] for item in items if item["asin"] not in known_asins])
+        self.data["items"] = list(items)
+        self.data["response_groups"] = response_groups
+        self.mark_synced()
+
+    def merge_items(self, items):
+        """Merges items fetched since the last sync, new purchases go first like in the Audible library order"""
+        by_asin = {item["asin"]: item for item in items}
+        known_asins = {item["asin"] for item in self.items}
+        new_items = [item for item in items if item["asin"] not in known_asins]
+
+        self.data["items"] = new_items + [by_asin.get(item["asin"], item) for item in self.items]
+        self.add_new_asins([item["asin"] for item in new_items])
+        self.mark_synced()
+
+    def add_new_asins(self, asins):
+        self.data["new_asins"] += [asin for asin in asins if asin not in self.data["new_asins"]]
+
+    def pop_new_items(self):
+        """Returns the books that arrived since this was last called"""
+        new_asins = set(self.data["new_asins"])
+        self.data["new_asins"] = []
+        return [item for item in self.items if item["asin"] in new_asins]
+
+    def get_book_info(self, asin):
+        entry = self.data["book_infos"].get(asin)
+        if entry and time.time() - entry["fetched_at"] < self.ttl:
+            return entry["book"]
+        return None
+
+    def set_book_info(self, asin, book):
+        self.data["book_infos"][asin] = {"fetched_at": time.time(), "book": book}
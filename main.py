@@ -1,6 +1,7 @@
 import asyncio
 import sys
 from command import Command
+from daemon import forward_command, serve
 
 async def main():
     cmd = Command()
@@ -9,10 +10,26 @@ async def main():
     if len(sys.argv) > 1:
         # Join all arguments after the script name as the command
         command_input = ' '.join(sys.argv[1:])
+        if sys.argv[1] == "daemon":
+            await serve()
+            return
+
         print(f"Running command: {command_input}")
-        
-        # Execute the command directly
-        await cmd.execute_command(command_input)
+
+        # A running daemon already has the credentials, client pools and library loaded
+        result = await forward_command(command_input)
+        if result is None and sys.argv[1] == "daemon_stop":
+            print("No daemon is running")
+        elif result is None:
+            # Execute the command directly
+            try:
+                result = await cmd.execute_command(command_input)
+            finally:
+                await cmd.close()
+
+        # Commands that report an outcome, like run_job, fail the process so schedulers notice
+        if result is False:
+            sys.exit(1)
     else:
         # Interactive mode
         cmd.welcome()
@@ -20,6 +37,8 @@ async def main():
             await cmd.command_loop()
         except KeyboardInterrupt:
             print("\nExiting...")
+        finally:
+            await cmd.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
\ No newline at end of file
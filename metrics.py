@@ -0,0 +1,191 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from constants import artifacts_root_directory
+
+# The stages commands are timed in, in the order the summary table lists them
+METRIC_STAGES = ["library_fetch", "download_url", "download", "decrypt", "transcode", "bookmark_fetch", "slice",
+                 "encode", "recognize", "export"]
+
+# What is written after every command besides the summary table, comma separated: jsonl, prometheus
+METRICS_EXPORT = os.environ.get("AUDIBLE_EXTRACTOR_METRICS", "")
+
+# spans.jsonl and the <command>.prom textfiles go here, point it at node_exporter's --collector.textfile.directory
+METRICS_DIR = os.environ.get("AUDIBLE_EXTRACTOR_METRICS_DIR", os.path.join(artifacts_root_directory, "metrics"))
+
+# Prometheus gauges written for every stage, from the totals of the last run of a command
+PROMETHEUS_FAMILIES = [
+    ("seconds", "audibleextractor_stage_seconds", "Time spent in the stage, overlapping spans add up"),
+    ("spans", "audibleextractor_stage_spans", "How many times the stage ran"),
+    ("errors", "audibleextractor_stage_errors", "How many times the stage failed"),
+    ("bytes", "audibleextractor_stage_bytes", "Bytes the stage read, wrote or sent"),
+    ("items", "audibleextractor_stage_items", "Books, clips, records or highlights the stage handled")
+]
+
+
+class Span:
+    """One timed run of a stage, add() the bytes and items it handled while it is open"""
+
+    def __init__(self, stage, labels):
+        self.stage = stage
+        self.labels = labels
+        self.bytes = 0
+        self.items = 0
+        self.ok = True
+        self.started_at = time.time()
+        self.seconds = 0.0
+
+    def add(self, bytes=0, items=0):
+        self.bytes += int(bytes)
+        self.items += int(items)
+
+    def as_dict(self):
+        return {
+            "stage": self.stage,
+            "started_at": self.started_at,
+            "seconds": round(self.seconds, 6),
+            "bytes": self.bytes,
+            "items": self.items,
+            "ok": self.ok,
+            **self.labels
+        }
+
+
+class Metrics:
+    """Collects the spans of the running command, spans can be opened from any task or worker thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans = []
+        self.started_at = time.time()
+
+    def reset(self):
+        with self.lock:
+            self.spans = []
+        self.started_at = time.time()
+
+    @contextmanager
+    def span(self, stage, bytes=0, items=0, **labels):
+        """Times the block as one run of stage, it counts as an error when the block raises or sets span.ok = False"""
+        span = Span(stage, labels)
+        span.add(bytes, items)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException:
+            span.ok = False
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            with self.lock:
+                self.spans.append(span)
+
+    def summary(self):
+        """Returns {stage: {"spans", "errors", "seconds", "max_seconds", "bytes", "items"}}, known stages first"""
+        with self.lock:
+            spans = list(self.spans)
+
+        summary = {}
+        for span in spans:
+            totals = summary.setdefault(span.stage, {"spans": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                                     "bytes": 0, "items": 0})
+            totals["spans"] += 1
+            totals["errors"] += not span.ok
+            totals["seconds"] += span.seconds
+            totals["max_seconds"] = max(totals["max_seconds"], span.seconds)
+            totals["bytes"] += span.bytes
+            totals["items"] += span.items
+
+        order = {stage: index for index, stage in enumerate(METRIC_STAGES)}
+        return dict(sorted(summary.items(), key=lambda item: (order.get(item[0], len(order)), item[0])))
+
+    def format_summary(self, command):
+        lines = [f"Metrics for {command} ({time.time() - self.started_at:.1f}s, busy time adds up overlapping spans)",
+                 f"{'stage':16}{'spans':>7}{'errors':>8}{'busy s':>10}{'max s':>9}{'MB':>10}{'items':>9}{'MB/s':>9}"]
+        for stage, totals in self.summary().items():
+            mb = totals["bytes"] / (1024 * 1024)
+            rate = mb / totals["seconds"] if totals["seconds"] else 0.0
+            lines.append(f"{stage:16}{totals['spans']:7}{totals['errors']:8}{totals['seconds']:10.2f}"
+                         f"{totals['max_seconds']:9.2f}{mb:10.1f}{totals['items']:9}{rate:9.1f}")
+        return "\n".join(lines)
+
+    def write_jsonl(self, command, path=None):
+        """Appends every span of the run as a JSON line, tagged with the command and when the run started"""
+        path = path or os.path.join(METRICS_DIR, "spans.jsonl")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            spans = list(self.spans)
+        with open(path, "a") as f:
+            for span in spans:
+                f.write(json.dumps({"command": command, "run_started_at": self.started_at, **span.as_dict()}) + "\n")
+        return path
+
+    def write_prometheus(self, command, path=None):
+        """Replaces the command's textfile with the stage totals of this run, the textfile collector
+        reads every *.prom file in its directory so each command keeps its own file"""
+        safe_command = re.sub(r"\W", "_", command) or "command"
+        path = path or os.path.join(METRICS_DIR, f"{safe_command}.prom")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        summary = self.summary()
+        lines = []
+        for key, name, description in PROMETHEUS_FAMILIES:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge"]
+            for stage, totals in summary.items():
+                lines.append(f'{name}{{command="{safe_command}",stage="{stage}"}} {totals[key]}')
+        lines += ["# HELP audibleextractor_run_seconds Wall time of the last run of the command",
+                  "# TYPE audibleextractor_run_seconds gauge",
+                  f'audibleextractor_run_seconds{{command="{safe_command}"}} {time.time() - self.started_at:.3f}',
+                  "# HELP audibleextractor_run_timestamp_seconds When the last run of the command started",
+                  "# TYPE audibleextractor_run_timestamp_seconds gauge",
+                  f'audibleextractor_run_timestamp_seconds{{command="{safe_command}"}} {self.started_at:.3f}']
+
+        # The collector may read the file at any moment, so it is swapped in whole
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+        return path
+
+    def report(self, command, exports=METRICS_EXPORT):
+        """Prints the summary table of the command that just ran and writes the configured exports"""
+        if not self.spans:
+            return
+        print(f"\n{self.format_summary(command)}")
+
+        for export in [export.strip() for export in exports.split(",") if export.strip()]:
+            try:
+                if export == "jsonl":
+                    print(f"Spans appended to {self.write_jsonl(command)}")
+                elif export == "prometheus":
+                    print(f"Metrics written to {self.write_prometheus(command)}")
+                else:
+                    print(f"Unknown metrics export {export}, choose from: jsonl, prometheus")
+            except OSError as e:
+                print(f"Could not write {export} metrics: {e}")
+
+
+METRICS = Metrics()
+
+
+def span(stage, **kwargs):
+    """Times a stage of the running command, see Metrics.span"""
+    return METRICS.span(stage, **kwargs)
+
+
+def progress_printer(label, total=1):
+    """Returns on_progress(done) that prints every 10% of total, so several books downloading or converting
+    at once don't flood the terminal. Without a total done is the finished fraction"""
+    last_step = [-1]
+
+    def on_progress(done):
+        step = int(10 * done / total)
+        if step > last_step[0]:
+            last_step[0] = step
+            print(f"{label}: {step * 10}%")
+
+    return on_progress
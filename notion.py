@@ -1,44 +1,187 @@
-import requests
+import asyncio
+import json
 import os
-from datetime import datetime
+
+from constants import artifacts_root_directory
+from errors import ExternalError
+from ledger import DeliveryLedger
+from metrics import span
+from ratelimit import RateLimiter, RequestError, send_with_retries
+from sync_state import SyncState
+
+NOTION_API_URL = "https://api.notion.com/v1"
+NOTION_VERSION = "2022-06-28"
+
+# The title property every Notion database has unless it was renamed, override with --title_property
+NOTION_TITLE_PROPERTY = "Heading"
+
+# Notion allows an average of 3 requests per second per integration
+NOTION_RATE_LIMIT = 3
+# Books exported at the same time, the blocks of one book are appended in order
+NOTION_CONCURRENCY = 3
+
+# Notion limits: children per append request and characters per rich text object
+NOTION_BLOCKS_PER_REQUEST = 100
+NOTION_TEXT_LIMIT = 2000
+
+# Failed requests (429, 5xx, network errors) are retried this many times, waiting BACKOFF * 2^attempt seconds
+# unless Notion says how long to wait
+NOTION_RETRIES = 5
+NOTION_BACKOFF = 1.0
+
+
+class NotionError(Exception):
+    pass
+
+
+def rich_text(content):
+    content = content or ""
+    return [{"type": "text", "text": {"content": content[start:start + NOTION_TEXT_LIMIT]}}
+            for start in range(0, max(len(content), 1), NOTION_TEXT_LIMIT)]
+
+
+def highlight_blocks(highlight):
+    """The note of a clip becomes a heading above the quoted transcription"""
+    blocks = []
+    if highlight.get("note"):
+        blocks.append({"object": "block", "type": "heading_3", "heading_3": {"rich_text": rich_text(highlight["note"])}})
+    blocks.append({"object": "block", "type": "quote", "quote": {"rich_text": rich_text(highlight["text"])}})
+    return blocks
+
+
+def load_highlights(title):
+    """Every transcribed highlight of a book, from the sync state or contents.json for books transcribed before it"""
+    title_dir_path = os.path.join(artifacts_root_directory, "audiobooks", title)
+    state = SyncState(title_dir_path)
+    if state.records:
+        return state.highlights()
+
+    contents_path = os.path.join(title_dir_path, "trancribed_clips", "contents.json")
+    if not os.path.exists(contents_path):
+        return []
+    with open(contents_path) as f:
+        return json.load(f)
+
 
 class NotionExporter:
-    def post_notion(text_heading, text_content):
+    """Exports highlights to a Notion database, one page per book with the highlights appended as blocks.
+    Pages and delivered highlights are kept in a ledger per database so reruns only append new highlights"""
+
+    def __init__(self, token, database_id, title_property=NOTION_TITLE_PROPERTY, author_property=None,
+                 rate=NOTION_RATE_LIMIT, concurrency=NOTION_CONCURRENCY):
+        self.token = token
+        self.database_id = database_id
+        # The book's title goes into the database's title property, the author into a text property
+        # only when one is named, so the exporter works with any database
+        self.title_property = title_property
+        self.author_property = author_property
+        self.rate_limiter = RateLimiter(rate)
+        self.concurrency = max(1, int(concurrency))
+        self.ledger = DeliveryLedger(f"notion_{database_id}")
+        self._client = None
+
+    @classmethod
+    def from_env(cls, database_id=None, title_property=None, author_property=None, **kwargs):
+        """Reads the integration token from NOTION_TOKEN and the database from --database_id or NOTION_DATABASE_ID.
+        The page properties come from --title_property/--author_property or NOTION_TITLE_PROPERTY/NOTION_AUTHOR_PROPERTY"""
         token = os.environ.get("NOTION_TOKEN")
-        url = "https://api.notion.com/v1/pages"
-
-        data = {
-            "parent": {"database_id": "1b9cbc3855e942e6b6ecf9bc0bde3a49"},
-            "properties": {
-                "Heading": {
-                    "title": [
-                        {
-                            "text": {
-                                "content": text_heading
-                            }
-                        }
-                    ]
+        database_id = database_id or os.environ.get("NOTION_DATABASE_ID")
+        if not token or not database_id:
+            print("Set NOTION_TOKEN and pass --database_id=... (or set NOTION_DATABASE_ID) to export to Notion")
+            return None
+        title_property = title_property or os.environ.get("NOTION_TITLE_PROPERTY") or NOTION_TITLE_PROPERTY
+        author_property = author_property or os.environ.get("NOTION_AUTHOR_PROPERTY")
+        return cls(token, database_id, title_property=title_property, author_property=author_property, **kwargs)
+
+    # One pooled client for every request to Notion, created on first use
+    def get_client(self):
+        if self._client is None:
+            import httpx
+            self._client = httpx.AsyncClient(
+                base_url=NOTION_API_URL,
+                headers={
+                    "Authorization": f"Bearer {self.token}",
+                    "Accept": "application/json",
+                    "Notion-Version": NOTION_VERSION
                 },
-                "Content": {
-                    "rich_text": [
-                        {
-                            "text": {
-                                "content": text_content
-                            }
-                        }
-                    ]
-                }
-            }}
-        import json
-        data = json.dumps(data)
-
-        headers = {
-            "Authorization": f"Bearer {token}",
-            "Accept": "application/json",
-            "Notion-Version": "2022-02-22",
-            "Content-Type": "application/json"
-        }
-
-        response = requests.post(url, headers=headers, data=data)
-
-        print(response.text)
+                timeout=httpx.Timeout(30.0))
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def request(self, method, path, payload):
+        with span("export", target="notion", items=len(payload.get("children", []))) as export_span:
+            try:
+                response = await send_with_retries(
+                    lambda: self.get_client().request(method, path, json=payload),
+                    self.rate_limiter, NOTION_RETRIES, NOTION_BACKOFF, "Notion")
+            except RequestError as e:
+                raise NotionError(f"{method} {path} failed: {e}")
+            export_span.add(bytes=len(response.request.content))
+            return response.json()
+
+    async def get_book_page(self, title, author):
+        page_id = self.ledger.refs.get(title)
+        if page_id:
+            return page_id
+
+        properties = {self.title_property: {"title": rich_text(title)}}
+        if self.author_property:
+            properties[self.author_property] = {"rich_text": rich_text(author)}
+        page = await self.request("POST", "/pages", {
+            "parent": {"database_id": self.database_id},
+            "properties": properties
+        })
+        self.ledger.set_ref(title, page["id"])
+        return page["id"]
+
+    async def export_book(self, title, author, highlights):
+        """Appends the highlights that aren't on the book's page yet, returns how many were appended"""
+        pending = [highlight for highlight in highlights if not self.ledger.is_delivered(highlight)]
+        if not pending:
+            return 0
+
+        page_id = await self.get_book_page(title, author)
+
+        # Fill every append request with as many whole highlights as fit, so a highlight is never split
+        batch, blocks = [], []
+        appended = 0
+        for highlight in pending + [None]:
+            new_blocks = highlight_blocks(highlight) if highlight else []
+            if batch and (highlight is None or len(blocks) + len(new_blocks) > NOTION_BLOCKS_PER_REQUEST):
+                await self.request("PATCH", f"/blocks/{page_id}/children", {"children": blocks})
+                self.ledger.mark_delivered(batch)
+                appended += len(batch)
+                batch, blocks = [], []
+            if highlight:
+                batch.append(highlight)
+                blocks.extend(new_blocks)
+        return appended
+
+    async def export_book_highlights(self, book):
+        """Exports the transcribed highlights of a library book, returns how many were appended"""
+        title_value = book.get("title", {})
+        _title = title_value if isinstance(title_value, str) else title_value.get("title", "untitled")
+        highlights = load_highlights(_title.lower().replace(" ", "_"))
+        if not highlights:
+            print(f"No transcriptions found for {_title}, run transcribe_bookmarks first")
+            return 0
+
+        appended = await self.export_book(_title, highlights[0].get("author"), highlights)
+        print(f"{_title}: {appended} highlights exported to Notion")
+        return appended
+
+    async def cmd_export_highlights(self, books):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def export(book):
+            async with semaphore:
+                await self.export_book_highlights(book)
+
+        results = await asyncio.gather(*[export(book) for book in books], return_exceptions=True)
+        for book, result in zip(books, results):
+            if isinstance(result, Exception):
+                ExternalError(self.cmd_export_highlights, book.get("asin"), result).show_error()
@@ -0,0 +1,95 @@
+import asyncio
+
+# Items buffered between two stages, a slow stage makes the ones before it wait instead of piling work up in memory
+PIPELINE_QUEUE_SIZE = 16
+
+# in seconds, how long a stage that takes batches waits for its batch to fill up before it handles a partial one
+PIPELINE_BATCH_LINGER = 1.0
+
+# Put on a stage's queue once the stage before it handed over its last item
+_DONE = object()
+
+
+class Stage:
+    """A step of a Pipeline. handler is an async function that takes a list of up to batch_size items and
+    returns the items for the next stage, `workers` batches are handled at the same time.
+    A batch is handed over once it is full, or linger seconds after its first item arrived"""
+
+    def __init__(self, name, handler, workers=1, batch_size=1, linger=PIPELINE_BATCH_LINGER):
+        self.name = name
+        self.handler = handler
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.linger = max(0.0, float(linger))
+
+
+class Pipeline:
+    """Runs stages connected by bounded queues, an item moves on to the next stage as soon as it is handled
+    so the network, CPU and disk work of different stages overlap"""
+
+    def __init__(self, stages, queue_size=PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = max(1, int(queue_size))
+        self.counts = {stage.name: 0 for stage in stages}
+
+    async def next_batch(self, stage, inbox):
+        """Waits for one item, then for more until the batch is full, stage.linger has passed or the stage
+        before is done. Returns None once the stage before is done"""
+        item = await inbox.get()
+        if item is _DONE:
+            # Leave it for the other workers of this stage
+            inbox.put_nowait(_DONE)
+            return None
+
+        batch = [item]
+        deadline = asyncio.get_running_loop().time() + stage.linger
+        while len(batch) < stage.batch_size:
+            try:
+                timeout = deadline - asyncio.get_running_loop().time()
+                item = inbox.get_nowait() if timeout <= 0 else await asyncio.wait_for(inbox.get(), timeout)
+            except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                break
+            if item is _DONE:
+                inbox.put_nowait(_DONE)
+                break
+            batch.append(item)
+        return batch
+
+    async def work(self, stage, inbox, outbox):
+        while True:
+            batch = await self.next_batch(stage, inbox)
+            if batch is None:
+                return
+
+            try:
+                results = await stage.handler(batch)
+            except Exception as e:
+                # Handlers report their own per item errors, this keeps one bad batch from stalling the pipeline
+                print(f"{stage.name} failed for {len(batch)} items: {e}")
+                continue
+
+            self.counts[stage.name] += len(batch)
+            if outbox is not None:
+                for result in results or ():
+                    await outbox.put(result)
+
+    async def run_stage(self, stage, inbox, outbox):
+        await asyncio.gather(*[self.work(stage, inbox, outbox) for _ in range(stage.workers)])
+        if outbox is not None:
+            await outbox.put(_DONE)
+
+    async def run(self, items):
+        """Feeds items to the first stage and returns once every stage is drained,
+        the outputs of the last stage are dropped"""
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+            await queues[0].put(_DONE)
+
+        await asyncio.gather(
+            feed(),
+            *[self.run_stage(stage, queues[index], queues[index + 1] if index + 1 < len(queues) else None)
+              for index, stage in enumerate(self.stages)])
+        return self.counts
@@ -0,0 +1,81 @@
+import asyncio
+from urllib.parse import urlsplit
+
+
+class RequestError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Spaces requests out so that at most `rate` of them start per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / float(rate) if rate else 0
+        self.next_slot = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        # Without a rate there is no spacing, but a pause still holds requests back
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            now = loop.time()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # Pushes every waiting request back, i.e after the server answered with Retry-After
+    def pause(self, seconds):
+        loop = asyncio.get_running_loop()
+        self.next_slot = max(self.next_slot, loop.time() + float(seconds))
+
+
+class HostRateLimiter:
+    """One RateLimiter per host, so a slow service doesn't hold back requests to the others"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.limiters = {}
+
+    def for_url(self, url):
+        host = urlsplit(str(url)).netloc
+        if host not in self.limiters:
+            self.limiters[host] = RateLimiter(self.rate)
+        return self.limiters[host]
+
+    async def wait(self, url):
+        await self.for_url(url).wait()
+
+
+async def send_with_retries(send, rate_limiter, retries, backoff, service):
+    """Sends a request through the rate limiter until it is answered with 200 and returns that response.
+    Network errors, 429 and 5xx are retried up to retries times, waiting backoff * 2^attempt seconds unless the
+    server says how long to wait. send makes one attempt and returns the httpx response, RequestError is raised
+    with the last error once the request is given up on"""
+    import httpx
+    for attempt in range(retries + 1):
+        await rate_limiter.wait()
+        delay = backoff * 2 ** attempt
+        try:
+            response = await send()
+        except httpx.TransportError as e:
+            error = e
+        else:
+            if response.status_code == 200:
+                return response
+
+            error = f"{response.status_code} {response.text}"
+            if response.status_code != 429 and response.status_code < 500:
+                break
+
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                delay = int(retry_after)
+
+        if attempt < retries:
+            # Pausing the rate limiter makes every request wait it out, not just this one
+            print(f"{service} error: {error}, retrying in {delay:.0f}s")
+            rate_limiter.pause(delay)
+
+    raise RequestError(error)
@@ -1,45 +1,132 @@
 import os
 import json
 from constants import artifacts_root_directory
-import requests
+from sync_state import SyncState
+from ledger import DeliveryLedger
+from metrics import span
+from ratelimit import RateLimiter, RequestError, send_with_retries
+
+READWISE_HIGHLIGHTS_URL = "https://readwise.io/api/v2/highlights/"
+
+# Highlights sent per request, the pipeline posts whatever was transcribed since the last post up to this many
+READWISE_BATCH_SIZE = 100
+
+# Requests per second, Readwise answers 429 with a Retry-After header when we go over its limit anyway
+READWISE_RATE_LIMIT = 1
+
+# Failed requests (429, 5xx, network errors) are retried this many times, waiting BACKOFF * 2^attempt seconds
+# unless Readwise says how long to wait
+READWISE_RETRIES = 5
+READWISE_BACKOFF = 2.0
 
 class Readwise:
-  
-  def __init__(self, token):
-    self.token = token
-  
+
+  def __init__(self, token, batch_size=READWISE_BATCH_SIZE, rate=READWISE_RATE_LIMIT):
+    self.token = token.strip()
+    self.batch_size = max(1, int(batch_size))
+    self.rate_limiter = RateLimiter(rate)
+    self.ledger = DeliveryLedger("readwise")
+    self._client = None
+
   @classmethod
   async def authenticate(self) -> "Readwise":
       if os.path.exists(f"{artifacts_root_directory}/secrets/readwise_token.json"):
-          print(f"You are already authenticated, to switch accounts, delete secrets directory under {artifacts_root_directory} and try again")          
+          print(f"You are already authenticated, to switch accounts, delete secrets directory under {artifacts_root_directory} and try again")
       token = input("Readwise Token (Go to https://readwise.io/access_token) to get one):")
-      
+
       os.makedirs(f"{artifacts_root_directory}/secrets/", exist_ok=True)
       with open(f"{artifacts_root_directory}/secrets/readwise_token.json", "w") as f:
         f.write(str(token))
       print("Token saved locally successfully")
-      
+
       return Readwise(token)
-  
-  async def cmd_post_highlights(self, books):
+
+  # One pooled client for every request to Readwise, created on first use
+  def get_client(self):
+    if self._client is None:
+      import httpx
+      self._client = httpx.AsyncClient(
+        headers={"Authorization": f"Token {self.token}"},
+        timeout=httpx.Timeout(30.0))
+    return self._client
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+  async def cmd_post_highlights(self, books, batch_size=None):
     if not os.path.exists(f"{artifacts_root_directory}/secrets/readwise_token.json"):
       print("You are not authenticated with readwise. Use the Command readwise-authenticate first")
       return
-    
+
+    if batch_size:
+      self.batch_size = max(1, int(batch_size))
+
     for book in books:
-      print("Posting to Readwise…")
-      title = book.get("title", {}).get("title", 'untitled')
-      title = title.lower().replace(" ", "_")
-      
-      with open(f"{artifacts_root_directory}/audiobooks/{title}/trancribed_clips/contents.json", "r") as f:
+      await self.post_book(book)
+
+  # Posts the new highlights of a book, returns whether every one of them is on Readwise now
+  async def post_book(self, book):
+    print("Posting to Readwise…")
+    title_value = book.get("title", {})
+    title = title_value if isinstance(title_value, str) else title_value.get("title", 'untitled')
+    title = title.lower().replace(" ", "_")
+
+    # Only post the highlights transcribed since the last successful post
+    state = SyncState(f"{artifacts_root_directory}/audiobooks/{title}")
+    keys, highlights = state.unexported_highlights()
+
+    if not state.records:
+      # Book was transcribed before sync state existed, the ledger keeps reruns from posting it again
+      contents_path = f"{artifacts_root_directory}/audiobooks/{title}/trancribed_clips/contents.json"
+      if not os.path.exists(contents_path):
+        print(f"No transcriptions found for {title}, run transcribe_bookmarks first")
+        return False
+      with open(contents_path, "r") as f:
         highlights = json.load(f)
-      
-      response = requests.post(url="https://readwise.io/api/v2/highlights/", 
-                               headers={"Authorization": f"Token {self.token}"}, 
-                               json={"highlights": highlights})
-
-      if response.status_code != 200:
-          print(f"Error: {response.status_code}")
-          print(response.text)
-      else:
-          print("Highlights posted successfully")
+
+    if not highlights:
+      print("No new highlights to post")
+      return True
+
+    delivered = await self.post_highlights(highlights)
+
+    state.mark_exported([key for index, key in enumerate(keys) if index in delivered])
+    if state.records:
+      state.save()
+    return len(delivered) == len(highlights)
+
+  async def post_highlights(self, highlights):
+    """Posts the highlights that aren't in the ledger yet in bulk requests of batch_size.
+    Returns the indexes of the highlights Readwise has, posted now or on an earlier run"""
+    delivered = {index for index, highlight in enumerate(highlights) if self.ledger.is_delivered(highlight)}
+    pending = [index for index in range(len(highlights)) if index not in delivered]
+    if delivered:
+      print(f"Skipping {len(delivered)} highlights already posted to Readwise")
+
+    for start in range(0, len(pending), self.batch_size):
+      chunk = pending[start:start + self.batch_size]
+      chunk_highlights = [highlights[index] for index in chunk]
+      if await self.post_chunk(chunk_highlights):
+        self.ledger.mark_delivered(chunk_highlights)
+        delivered.update(chunk)
+
+    print(f"{len(delivered)} of {len(highlights)} highlights on Readwise")
+    return delivered
+
+  # Returns whether Readwise accepted the highlights
+  async def post_chunk(self, highlights):
+    with span("export", target="readwise", items=len(highlights)) as export_span:
+      try:
+        response = await send_with_retries(
+          lambda: self.get_client().post(READWISE_HIGHLIGHTS_URL, json={"highlights": highlights}),
+          self.rate_limiter, READWISE_RETRIES, READWISE_BACKOFF, "Readwise")
+      except RequestError as e:
+        print(f"Error: {e}")
+        export_span.ok = False
+        return False
+
+      print(f"{len(highlights)} highlights posted successfully")
+      export_span.add(bytes=len(response.request.content))
+      return True
@@ -0,0 +1,230 @@
+import json
+import os
+import time
+
+SYNC_STATE_FILE_NAME = "sync_state.json"
+
+HIGHLIGHT_SOURCE_TYPE = "audible_bookmark_extractor"
+
+# While clips are transcribed the state is saved after this many clips or this many seconds, whichever comes first
+CHECKPOINT_CLIPS = 50
+CHECKPOINT_INTERVAL = 5
+
+# Records imported from a book transcribed before the sync state existed, they aren't tied to a sidecar record
+LEGACY_KEY_PREFIX = "legacy|"
+
+
+def record_key(record):
+    """Identifies a sidecar record across runs by its type, position and creation time"""
+    return f"{record.get('type', '')}|{record.get('startPosition', '')}|{record.get('creationTime', '')}"
+
+
+class SyncState:
+    """Per book record of which sidecar records were already sliced, transcribed and exported,
+    so later runs only process what changed on Audible since the last one"""
+
+    def __init__(self, title_dir_path):
+        self.title_dir_path = title_dir_path
+        self.path = os.path.join(title_dir_path, SYNC_STATE_FILE_NAME)
+        # records maps record_key to {"clip": file name, "window": [start, end], "note": str, "cache_key": str,
+        # "text": str, "exported": bool}
+        self.data = {"title": None, "author": None, "records": {}}
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+        # Whether the state was read from disk, a book without one has only what import_legacy found
+        self.tracked = False
+        self.load()
+        if not self.tracked:
+            self.import_legacy()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.data.update(json.load(f))
+            self.tracked = True
+        except (OSError, ValueError):
+            pass
+
+    def import_legacy(self):
+        """Books transcribed before the sync state only have their clips/ and contents.json, both become records
+        so the first run neither transcribes them again nor writes an empty contents.json over them"""
+        clips_dir_path = os.path.join(self.title_dir_path, "clips")
+        file_names = [name for name in os.listdir(clips_dir_path) if name.endswith(".flac")] \
+            if os.path.isdir(clips_dir_path) else []
+        try:
+            with open(os.path.join(self.title_dir_path, "trancribed_clips", "contents.json")) as f:
+                highlights = json.load(f)
+        except (OSError, ValueError):
+            highlights = []
+        if not file_names and not highlights:
+            return
+
+        # Clips with a note were named after it. The others are clip1.flac, clip2.flac... transcribed in directory
+        # order, their highlights only line up with the files when none of them failed. Clips of a book that was
+        # never transcribed keep no text so they are transcribed
+        texts = {}
+        unmatched = []
+        unnamed_files = [name for name in file_names if name.startswith("clip")]
+        unnamed_highlights = [highlight for highlight in highlights if not highlight.get("note")]
+        if len(unnamed_files) == len(unnamed_highlights):
+            texts.update(zip(unnamed_files, [highlight.get("text") for highlight in unnamed_highlights]))
+        elif highlights:
+            texts.update((name, "") for name in unnamed_files)
+            unmatched += unnamed_highlights
+        for highlight in highlights:
+            if not highlight.get("note"):
+                continue
+            if f"{highlight['note']}.flac" in file_names:
+                texts[f"{highlight['note']}.flac"] = highlight.get("text")
+            else:
+                unmatched.append(highlight)
+
+        for file_name in file_names:
+            note = None if file_name.startswith("clip") else file_name[:-len(".flac")]
+            self.add_legacy_record(file_name, note, texts.get(file_name))
+        for index, highlight in enumerate(unmatched):
+            self.add_legacy_record(f"highlight_{index + 1}.flac", highlight.get("note"), highlight.get("text"))
+
+        if highlights:
+            self.set_book(highlights[0].get("title"), highlights[0].get("author"))
+
+    def add_legacy_record(self, file_name, note, text):
+        self.records[f"{LEGACY_KEY_PREFIX}{file_name}"] = {
+            "clip": file_name,
+            "window": [],
+            "note": note,
+            "cache_key": None,
+            "text": text,
+            "exported": False
+        }
+
+    def save(self):
+        os.makedirs(self.title_dir_path, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self.unsaved = 0
+        self.saved_at = time.monotonic()
+
+    def checkpoint(self):
+        """Called after every transcribed clip, saves now and then instead of rewriting the whole file every time.
+        The caller still has to save() once it is done"""
+        self.unsaved += 1
+        if self.unsaved >= CHECKPOINT_CLIPS or time.monotonic() - self.saved_at >= CHECKPOINT_INTERVAL:
+            self.save()
+
+    @property
+    def records(self):
+        return self.data["records"]
+
+    def set_book(self, title, author):
+        self.data["title"] = title
+        self.data["author"] = author
+
+    def plan(self, clips, require_files=True):
+        """clips maps record_key to {"clip", "window", "note"} for every clip currently on Audible.
+        Returns (keys that need slicing, entries of records deleted on Audible), renames clips whose note changed.
+        Without require_files a transcribed record counts as done even when its clip file was never written"""
+        legacy_keys = {entry["clip"]: key for key, entry in self.records.items() if key.startswith(LEGACY_KEY_PREFIX)}
+        to_slice = []
+        for key, clip in clips.items():
+            entry = self.records.get(key)
+            clip_path = os.path.join(self.title_dir_path, "clips", clip["clip"])
+
+            if entry is None and clip["clip"] in legacy_keys:
+                # A clip named after the same note as an imported one is the same bookmark, it keeps its text
+                entry = self.records.pop(legacy_keys.pop(clip["clip"]))
+                entry.update(window=list(clip["window"]), cache_key=clip.get("cache_key"))
+                self.records[key] = entry
+
+            if entry and entry["window"] == list(clip["window"]):
+                old_clip_path = os.path.join(self.title_dir_path, "clips", entry["clip"])
+                if entry["clip"] != clip["clip"] and os.path.exists(old_clip_path):
+                    # A note was added or edited, the audio is the same so only the file name changes
+                    os.replace(old_clip_path, clip_path)
+                    entry["clip"] = clip["clip"]
+                    entry["note"] = clip["note"]
+                    entry["exported"] = False
+                if os.path.exists(clip_path) or (not require_files and entry["text"] is not None):
+                    continue
+            elif entry:
+                # The clip window moved, i.e different offsets, the old audio is stale
+                self.remove_artifacts([entry])
+            to_slice.append(key)
+
+        removed = [self.records.pop(key) for key in list(self.records) if key not in clips]
+        return to_slice, removed
+
+    def mark_sliced(self, key, clip):
+        # Writing the clip file of a record that was transcribed from memory keeps its transcription
+        entry = self.records.get(key)
+        unchanged = entry is not None and entry["window"] == list(clip["window"])
+        self.records[key] = {
+            "clip": clip["clip"],
+            "window": list(clip["window"]),
+            "note": clip["note"],
+            "cache_key": clip.get("cache_key"),
+            "text": entry["text"] if unchanged else None,
+            "exported": entry["exported"] if unchanged else False
+        }
+        return self.records[key]
+
+    def mark_planned(self, clips, keys):
+        """Records the planned clips of keys without writing their files, for in-memory transcription.
+        A record whose window didn't change is left as it is"""
+        for key in keys:
+            entry = self.records.get(key)
+            if not entry or entry["window"] != list(clips[key]["window"]):
+                self.mark_sliced(key, clips[key])
+
+    def remove_artifacts(self, entries):
+        for entry in entries:
+            clip_path = os.path.join(self.title_dir_path, "clips", entry["clip"])
+            if os.path.exists(clip_path):
+                os.remove(clip_path)
+
+    def remove_untracked_clips(self):
+        """Removes clips left behind by earlier runs that no record points to anymore"""
+        clips_dir_path = os.path.join(self.title_dir_path, "clips")
+        tracked = {entry["clip"] for entry in self.records.values()}
+        for file_name in os.listdir(clips_dir_path):
+            if file_name.endswith(".flac") and file_name not in tracked:
+                os.remove(os.path.join(clips_dir_path, file_name))
+
+    def untranscribed(self):
+        return [(key, entry) for key, entry in self.sorted_records() if entry["text"] is None]
+
+    def sorted_records(self):
+        return sorted(self.records.items(), key=lambda item: item[1]["window"])
+
+    def highlight(self, entry):
+        highlight = {"title": self.data["title"], "author": self.data["author"]}
+        if entry.get("note"):
+            highlight["note"] = entry["note"]
+        highlight["source_type"] = HIGHLIGHT_SOURCE_TYPE
+        highlight["text"] = entry["text"]
+        return highlight
+
+    def highlights(self):
+        """Every transcribed highlight of the book in clip order, what goes into contents.json"""
+        return [self.highlight(entry) for _, entry in self.sorted_records() if entry["text"]]
+
+    def unexported_highlights(self):
+        """(keys, highlights) for the transcribed records that haven't been exported yet"""
+        pending = [(key, entry) for key, entry in self.sorted_records() if entry["text"] and not entry["exported"]]
+        return [key for key, _ in pending], [self.highlight(entry) for _, entry in pending]
+
+    def mark_exported(self, keys):
+        for key in keys:
+            if key in self.records:
+                self.records[key]["exported"] = True
+
+    def write_contents(self):
+        # Nothing to go on, a contents.json written by an older version stays as it is
+        if not self.records and not self.tracked:
+            return
+        transcribed_clips_dir_path = os.path.join(self.title_dir_path, "trancribed_clips")
+        os.makedirs(transcribed_clips_dir_path, exist_ok=True)
+        with open(os.path.join(transcribed_clips_dir_path, "contents.json"), "w") as f:
+            json.dump(self.highlights(), f, indent=4)
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the root of the repository, next to main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def artifacts_dir(tmp_path, monkeypatch):
+    """Points the caches and ledgers at a temporary directory instead of ~/audibleextractor"""
+    import clip_cache
+    import ledger
+    import library_cache
+    for module in [clip_cache, ledger, library_cache]:
+        monkeypatch.setattr(module, "artifacts_root_directory", str(tmp_path))
+    return tmp_path
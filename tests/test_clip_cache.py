@@ -0,0 +1,84 @@
+import itertools
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import clip_cache
+from clip_cache import ClipCache
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    # Every use gets its own time, so the least recently used entry is always clear
+    ticks = itertools.count()
+    monkeypatch.setattr(clip_cache, "time", SimpleNamespace(time=lambda: next(ticks)))
+
+
+def write_clip(path, size):
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return str(path)
+
+
+def test_cached_clip_is_copied_back(artifacts_dir, tmp_path):
+    cache = ClipCache()
+    clip_path = write_clip(tmp_path / "clip1.flac", 100)
+    cache.put_clip("a", clip_path)
+    cache.save()
+
+    dest_path = str(tmp_path / "clip1 again.flac")
+    reloaded = ClipCache()
+    assert reloaded.get_clip("a", dest_path)
+    assert os.path.getsize(dest_path) == 100
+    # Cached clips are copies, evicting them frees their space
+    assert os.stat(dest_path).st_nlink == 1
+    assert os.stat(reloaded.cached_path("a")).st_nlink == 1
+
+    assert not reloaded.get_clip("b", dest_path)
+    assert reloaded.stats["clip_hits"] == 1 and reloaded.stats["clip_misses"] == 1
+
+
+def test_least_recently_used_clips_are_evicted(artifacts_dir, tmp_path):
+    cache = ClipCache(max_bytes=250)
+    for key in "abc":
+        cache.put_clip(key, write_clip(tmp_path / f"{key}.flac", 100))
+        if key == "b":
+            cache.get_clip("a", str(tmp_path / "used.flac"))
+
+    assert sorted(cache.entries) == ["a", "c"]
+    assert cache.stats["evictions"] == 1
+    assert not os.path.exists(os.path.join(cache.dir_path, "b.flac"))
+
+
+def test_transcripts_count_towards_the_budget(artifacts_dir):
+    cache = ClipCache(max_bytes=10)
+    cache.put_transcript("a", "whisper", "0123456")
+    cache.put_transcript("b", "whisper", "0123456")
+    cache.save()
+
+    assert list(ClipCache().entries) == ["b"]
+    assert cache.get_transcript("b", "whisper") == "0123456"
+    assert cache.get_transcript("b", "google") is None
+
+
+def test_number_of_entries_is_capped(artifacts_dir):
+    cache = ClipCache(max_entries=2)
+    for key in "abcd":
+        cache.put_transcript(key, "whisper", "")
+    cache.save()
+
+    assert sorted(cache.entries) == ["c", "d"]
+
+
+def test_clip_linked_into_the_cache_by_an_older_version_is_replaced(artifacts_dir, tmp_path):
+    cache = ClipCache()
+    clip_path = write_clip(tmp_path / "clip1.flac", 100)
+    os.makedirs(cache.dir_path)
+    os.link(clip_path, os.path.join(cache.dir_path, "a.flac"))
+
+    cache.put_clip("a", clip_path)
+
+    assert os.stat(clip_path).st_nlink == 1
+    assert cache.get_clip("a", clip_path)
+    assert os.path.getsize(clip_path) == 100
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+import daemon
+
+
+@pytest.fixture
+def lock_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "daemon.lock")
+    monkeypatch.setattr(daemon, "artifacts_root_directory", str(tmp_path))
+    monkeypatch.setattr(daemon, "DAEMON_LOCK_PATH", path)
+    return path
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+def test_no_daemon_without_a_lock_file(lock_path):
+    assert not daemon.daemon_running()
+    assert not os.path.exists(lock_path)
+
+
+def test_probing_a_running_daemon_keeps_its_pid(lock_path):
+    lock_file = daemon.acquire_lock()
+    try:
+        assert read(lock_path) == str(os.getpid())
+        assert daemon.daemon_running()
+        assert daemon.daemon_running()
+        assert read(lock_path) == str(os.getpid())
+        assert daemon.acquire_lock() is None
+    finally:
+        lock_file.close()
+
+
+def test_lock_left_by_a_stopped_daemon_is_free(lock_path):
+    daemon.acquire_lock().close()
+
+    assert not daemon.daemon_running()
+    assert read(lock_path) == str(os.getpid())
+
+    # The probe gave the lock back, a new daemon can still start
+    lock_file = daemon.acquire_lock()
+    assert lock_file is not None
+    lock_file.close()
@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import json
+import os
+
+import httpx
+import pytest
+
+import downloader
+from downloader import DownloadError, DownloadManager
+
+BOOK = bytes(range(256)) * 4096
+URL = "https://cdn.example/book.aax"
+
+
+@pytest.fixture(autouse=True)
+def readable_audio(monkeypatch):
+    # There is no real audiobook to probe, every finished download counts as readable
+    async def probe_duration(path, input_args=()):
+        return 60.0
+    monkeypatch.setattr(downloader, "probe_duration", probe_duration)
+
+
+class Server:
+    """Serves BOOK and records the Range header of every request. honour_range=False answers like a server
+    without Range support, fail_start makes the segment starting there fail once the others are under way"""
+
+    def __init__(self, honour_range=True, fail_start=None):
+        self.honour_range = honour_range
+        self.fail_start = fail_start
+        self.ranges = []
+        self.bytes_sent = 0
+        # Bodies that were started but never sent to the end
+        self.unfinished = 0
+
+    async def body(self, data):
+        # Sent in small pieces so a cancelled download stops part way
+        self.unfinished += 1
+        for start in range(0, len(data), 4096):
+            await asyncio.sleep(0.001)
+            self.bytes_sent += len(data[start:start + 4096])
+            yield data[start:start + 4096]
+        self.unfinished -= 1
+
+    async def handle(self, request):
+        header = request.headers.get("range")
+        self.ranges.append(header)
+        if not header or not self.honour_range:
+            return httpx.Response(200, content=self.body(BOOK))
+
+        start, _, end = header[len("bytes="):].partition("-")
+        start = int(start)
+        end = int(end) if end else len(BOOK) - 1
+        if start >= len(BOOK):
+            return httpx.Response(416, headers={"Content-Range": f"bytes */{len(BOOK)}"})
+        if start == self.fail_start:
+            await asyncio.sleep(0.02)
+            return httpx.Response(500, content=b"broken")
+        return httpx.Response(206, content=self.body(BOOK[start:end + 1]),
+                              headers={"Content-Range": f"bytes {start}-{end}/{len(BOOK)}"})
+
+
+def download(server, path, **kwargs):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(server.handle)) as client:
+            async with DownloadManager(client=client, **kwargs) as manager:
+                return await manager.download(URL, path, "book")
+    return asyncio.run(run())
+
+
+def write_part(path, data):
+    with open(f"{path}.part", "wb") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_writes_the_file_and_its_manifest(tmp_path):
+    path = str(tmp_path / "book.aax")
+
+    assert download(Server(), path) == len(BOOK)
+
+    assert read(path) == BOOK
+    assert not os.path.exists(f"{path}.part")
+    with open(f"{path}.json") as f:
+        assert json.load(f)["sha256"] == hashlib.sha256(BOOK).hexdigest()
+    assert DownloadManager().is_complete(path)
+
+
+def test_download_resumes_a_partial_file(tmp_path):
+    path = str(tmp_path / "book.aax")
+    write_part(path, BOOK[:1000])
+    server = Server()
+
+    download(server, path)
+
+    assert server.ranges == ["bytes=1000-"]
+    assert read(path) == BOOK
+    with open(f"{path}.json") as f:
+        assert json.load(f)["sha256"] == hashlib.sha256(BOOK).hexdigest()
+
+
+def test_complete_part_is_finalized_when_the_server_answers_416(tmp_path):
+    path = str(tmp_path / "book.aax")
+    write_part(path, BOOK)
+    server = Server()
+
+    assert download(server, path) == len(BOOK)
+
+    assert server.ranges == [f"bytes={len(BOOK)}-"]
+    assert read(path) == BOOK
+
+
+def test_part_larger_than_the_book_is_discarded_on_416(tmp_path):
+    path = str(tmp_path / "book.aax")
+    write_part(path, BOOK + b"extra")
+
+    with pytest.raises(DownloadError, match="partial download discarded"):
+        download(Server(), path)
+    assert not os.path.exists(f"{path}.part")
+
+
+def test_server_ignoring_range_sends_the_whole_book_again(tmp_path):
+    path = str(tmp_path / "book.aax")
+    write_part(path, b"stale bytes")
+    server = Server(honour_range=False)
+
+    download(server, path)
+
+    assert server.ranges == ["bytes=11-"]
+    assert read(path) == BOOK
+
+
+def test_verify_downloads_a_corrupted_book_again(tmp_path):
+    path = str(tmp_path / "book.aax")
+    download(Server(), path)
+    with open(path, "r+b") as f:
+        f.seek(5000)
+        f.write(b"\xff")
+
+    assert asyncio.run(DownloadManager().is_downloaded(path))
+    assert not asyncio.run(DownloadManager(verify=True).is_downloaded(path))
+    assert not os.path.exists(path)
+    assert not os.path.exists(f"{path}.json")
+
+    download(Server(), path)
+    assert asyncio.run(DownloadManager(verify=True).is_downloaded(path))
+
+
+SEGMENT = len(BOOK) // 4
+
+
+def test_segmented_download_fetches_every_range(tmp_path):
+    path = str(tmp_path / "book.aax")
+    server = Server()
+
+    download(server, path, segments=4)
+
+    assert read(path) == BOOK
+    assert server.ranges[0] == "bytes=0-0"
+    assert sorted(server.ranges[1:]) == sorted(f"bytes={start}-{start + SEGMENT - 1}"
+                                               for start in range(0, len(BOOK), SEGMENT))
+    assert not os.path.exists(f"{path}.part.json")
+
+
+def test_segmented_download_falls_back_without_reading_the_probe_body(tmp_path):
+    path = str(tmp_path / "book.aax")
+    server = Server(honour_range=False)
+
+    download(server, path, segments=4)
+
+    assert read(path) == BOOK
+    assert server.ranges == ["bytes=0-0", None]
+    # The probe got the whole book as a 200 and closed it after the first piece at most
+    assert server.bytes_sent <= len(BOOK) + 4096
+
+
+def test_failed_segment_cancels_the_others_and_resumes_later(tmp_path):
+    path = str(tmp_path / "book.aax")
+    server = Server(fail_start=SEGMENT)
+
+    with pytest.raises(DownloadError, match="HTTP 500"):
+        download(server, path, segments=4)
+
+    # The other segments were cancelled part way instead of running to the end
+    assert server.unfinished == 3
+    assert server.bytes_sent < len(BOOK) - SEGMENT
+    with open(f"{path}.part.json") as f:
+        done = json.load(f)["done"]
+    assert 1 not in done
+
+    retry = Server()
+    download(retry, path, segments=4)
+    assert read(path) == BOOK
+    assert len(retry.ranges) == 1 + 4 - len(done)
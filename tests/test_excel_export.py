@@ -0,0 +1,44 @@
+import re
+import zipfile
+
+from excel_export import SHEET_NAME_MAX_LENGTH, TranscriptionWorkbook
+
+
+def sheet_names(path):
+    with zipfile.ZipFile(path) as archive:
+        return re.findall(r'<sheet name="([^"]*)"', archive.read("xl/workbook.xml").decode())
+
+
+def sheet_texts(path, number):
+    # Constant memory mode writes the strings inline in the sheet
+    with zipfile.ZipFile(path) as archive:
+        return re.findall(r"<t[^>]*>([^<]*)</t>", archive.read(f"xl/worksheets/sheet{number}.xml").decode())
+
+
+def test_one_sheet_per_book_with_its_rows_in_order(tmp_path):
+    path = str(tmp_path / "All_Transcriptions.xlsx")
+    workbook = TranscriptionWorkbook(path)
+
+    assert workbook.add_book("First book", [("clip1", "Hello"), ("Chapter two", "World")]) == 2
+    assert workbook.add_book("Second book", iter([])) == 0
+    workbook.close()
+
+    assert sheet_names(path) == ["First book", "Second book"]
+    assert sheet_texts(path, 1) == ["Clip Note", "Transcription", "clip1", "Hello", "Chapter two", "World"]
+    assert sheet_texts(path, 2) == ["Clip Note", "Transcription"]
+
+
+def test_sheet_names_are_made_valid_and_unique(tmp_path):
+    workbook = TranscriptionWorkbook(str(tmp_path / "book.xlsx"))
+    long_title = "A Very Long Audiobook Title: Part One"
+
+    names = [workbook.sheet_name(long_title), workbook.sheet_name(long_title), workbook.sheet_name("a very long "
+             "audiobook title: part one"), workbook.sheet_name("What? [Unabridged]"), workbook.sheet_name("//")]
+    workbook.close()
+
+    assert names[0] == "A Very Long Audiobook Title Par"
+    assert names[1] == "A Very Long Audiobook Title (2)"
+    assert names[2] == "a very long audiobook title (3)"
+    assert names[3] == "What Unabridged"
+    assert names[4] == "untitled"
+    assert all(len(name) <= SHEET_NAME_MAX_LENGTH for name in names)
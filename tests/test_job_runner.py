@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+from job_runner import JOB_STAGES, JobError, JobRunner, stage_graph
+
+
+def test_stage_graph_from_names():
+    assert stage_graph("download, convert,clip") == {"download": [], "convert": ["download"], "clip": ["convert"]}
+
+
+def test_stage_graph_drops_dependencies_outside_the_job():
+    assert stage_graph(["transcribe", "readwise", "notion"]) == {
+        "transcribe": [],
+        "readwise": ["transcribe"],
+        "notion": ["transcribe"]
+    }
+
+
+def test_stage_graph_from_a_dict():
+    assert stage_graph({"download": [], "clip": ["download"]}) == {"download": [], "clip": ["download"]}
+
+
+def test_stage_graph_rejects_unknown_stages():
+    with pytest.raises(JobError, match="Unknown stages upload"):
+        stage_graph("download,upload")
+
+
+def test_stage_graph_rejects_cycles():
+    with pytest.raises(JobError, match="cycle"):
+        stage_graph({"download": ["clip"], "clip": ["download"]})
+
+
+class RecordingRunner(JobRunner):
+    """Stages that only record when they ran, failing the ones named in fail"""
+
+    def __init__(self, fail=()):
+        super().__init__(api=None)
+        self.fail = fail
+        self.ran = []
+        for stage in JOB_STAGES:
+            setattr(self, f"stage_{stage}", self.recorder(stage))
+
+    def recorder(self, stage):
+        async def run_stage(book, options):
+            await asyncio.sleep(0.01)
+            self.ran.append(stage)
+            if stage in self.fail:
+                raise JobError(f"{stage} broke")
+            return {"book": book["asin"]}
+        return run_stage
+
+
+def run_book(runner, stages):
+    graph = stage_graph(stages)
+    return asyncio.run(runner.run_book({"asin": "A1", "title": "Book"}, graph, {stage: {} for stage in graph}))
+
+
+def test_run_book_runs_stages_after_their_dependencies():
+    runner = RecordingRunner()
+
+    result = run_book(runner, "download,convert,clip,transcribe,readwise,notion")
+
+    assert result["status"] == "ok"
+    assert runner.ran[:4] == ["download", "convert", "clip", "transcribe"]
+    assert sorted(runner.ran[4:]) == ["notion", "readwise"]
+    assert result["stages"]["clip"]["book"] == "A1"
+
+
+def test_run_book_skips_the_stages_after_a_failed_one():
+    runner = RecordingRunner(fail=["clip"])
+
+    result = run_book(runner, "convert,clip,transcribe,readwise")
+
+    assert result["status"] == "failed"
+    assert runner.ran == ["convert", "clip"]
+    assert result["stages"]["clip"] == {"status": "failed", "error": "clip broke",
+                                        "seconds": result["stages"]["clip"]["seconds"]}
+    assert result["stages"]["transcribe"]["status"] == "skipped"
+    assert result["stages"]["readwise"]["status"] == "skipped"
+
+
+def test_run_book_keeps_independent_stages_going():
+    runner = RecordingRunner(fail=["readwise"])
+
+    result = run_book(runner, "transcribe,readwise,notion")
+
+    assert result["stages"]["notion"]["status"] == "ok"
+    assert result["stages"]["readwise"]["status"] == "failed"
@@ -0,0 +1,35 @@
+from ledger import DeliveryLedger, highlight_key
+
+HIGHLIGHT = {"title": "Book", "author": "Author", "text": "Quote", "note": "Chapter one"}
+
+
+def test_delivered_highlights_are_remembered(artifacts_dir):
+    ledger = DeliveryLedger("readwise")
+    assert not ledger.is_delivered(HIGHLIGHT)
+
+    ledger.mark_delivered([HIGHLIGHT])
+
+    assert DeliveryLedger("readwise").is_delivered(dict(HIGHLIGHT))
+    assert not DeliveryLedger("notion").is_delivered(HIGHLIGHT)
+    assert (artifacts_dir / "ledgers" / "readwise.json").exists()
+
+
+def test_highlight_key_depends_on_the_text_and_the_book():
+    assert highlight_key(HIGHLIGHT) == highlight_key(dict(HIGHLIGHT, location=10))
+    assert highlight_key(HIGHLIGHT) != highlight_key(dict(HIGHLIGHT, text="Another quote"))
+    assert highlight_key(HIGHLIGHT) != highlight_key(dict(HIGHLIGHT, title="Another book"))
+
+
+def test_refs_are_saved(artifacts_dir):
+    DeliveryLedger("notion").set_ref("Book", "page-id")
+
+    assert DeliveryLedger("notion").refs == {"Book": "page-id"}
+
+
+def test_a_corrupt_ledger_starts_empty(artifacts_dir):
+    (artifacts_dir / "ledgers").mkdir()
+    (artifacts_dir / "ledgers" / "readwise.json").write_text("{not json")
+
+    ledger = DeliveryLedger("readwise")
+
+    assert ledger.delivered == {} and ledger.refs == {}
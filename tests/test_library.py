@@ -0,0 +1,134 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+
+import audible_api
+from audible_api import AudibleAPI, LIBRARY_RESPONSE_GROUPS
+from library_cache import LIBRARY_CACHE_TTL, LibraryCache
+
+
+class LibraryClient:
+    """Answers library requests like Audible, items only have authors when contributors is asked for"""
+
+    def __init__(self, size, page_size, total_count=True):
+        self.size = size
+        self.page_size = page_size
+        self.total_count = total_count
+        self.requests = []
+
+    def item(self, index, response_groups):
+        item = {"asin": f"B{index:09d}", "title": f"Book {index}"}
+        if "contributors" in response_groups:
+            item["authors"] = [{"name": f"Author {index}"}]
+        return item
+
+    async def get(self, path, response_callback=None, params=None, **kwargs):
+        self.requests.append(params)
+        start = (params["page"] - 1) * params["num_results"]
+        items = [self.item(index, params.get("response_groups", ""))
+                 for index in range(start, min(start + params["num_results"], self.size))]
+        headers = {"total-count": str(self.size)} if self.total_count else {}
+        return httpx.Response(200, json={"items": items}, headers=headers,
+                              request=httpx.Request("GET", f"https://api.audible.com/1.0/{path}"))
+
+
+def library_api(client):
+    api = AudibleAPI(SimpleNamespace(locale=SimpleNamespace(country_code="us"), customer_info={"user_id": "me"}))
+    api.get_client = lambda: client
+    return api
+
+
+def test_library_requests_ask_for_the_authors(artifacts_dir):
+    client = LibraryClient(3, audible_api.LIBRARY_PAGE_SIZE)
+    api = library_api(client)
+
+    asyncio.run(api.get_library())
+
+    assert all("contributors" in params["response_groups"] for params in client.requests)
+    assert api.get_book_authors(api.select_books("B000000001")[0]) == "Author 1"
+    assert [book["asin"] for book in api.select_books("author:author 2")] == ["B000000002"]
+
+
+def test_cache_filled_without_authors_is_synced_again(artifacts_dir):
+    stale = LibraryCache("me", "us")
+    stale.replace_items([{"asin": "B000000000", "title": "Book 0"}])
+    stale.save()
+    client = LibraryClient(1, audible_api.LIBRARY_PAGE_SIZE)
+    api = library_api(client)
+
+    asyncio.run(api.get_library())
+
+    assert len(client.requests) == 1
+    assert api.library["items"][0]["authors"] == [{"name": "Author 0"}]
+    assert LibraryCache("me", "us").response_groups == LIBRARY_RESPONSE_GROUPS
+
+    # Synced with the authors now, the fresh cache is served as it is
+    asyncio.run(library_api(client).get_library())
+    assert len(client.requests) == 1
+
+
+def test_items_without_authors_never_match_an_author():
+    api = AudibleAPI(None)
+    api.library = {"items": [{"asin": "A1", "title": "No contributors"}]}
+
+    assert api.select_books("author:someone") == []
+    assert api.get_book_authors(api.select_books("A1")[0]) == "Unknown Author"
+
+
+def asins(items):
+    return [item["asin"] for item in items]
+
+
+def test_pages_after_the_total_count_are_fetched_in_library_order(artifacts_dir, monkeypatch):
+    monkeypatch.setattr(audible_api, "LIBRARY_PAGE_SIZE", 10)
+    client = LibraryClient(25, 10)
+
+    assert asyncio.run(library_api(client).get_library()) == [f"B{index:09d}" for index in range(25)]
+    assert [params["page"] for params in client.requests] == [1, 2, 3]
+
+
+def test_without_a_total_count_pages_are_fetched_until_one_comes_back_short(artifacts_dir, monkeypatch):
+    monkeypatch.setattr(audible_api, "LIBRARY_PAGE_SIZE", 10)
+    client = LibraryClient(20, 10, total_count=False)
+    pages = []
+
+    asyncio.run(library_api(client).get_library(on_items=lambda items: pages.append(len(items))))
+
+    assert pages == [10, 10, 0]
+    assert [params["page"] for params in client.requests] == [1, 2, 3]
+
+
+def test_fresh_cache_is_served_without_requests(artifacts_dir):
+    asyncio.run(library_api(LibraryClient(3, audible_api.LIBRARY_PAGE_SIZE)).get_library())
+    client = LibraryClient(3, audible_api.LIBRARY_PAGE_SIZE)
+
+    assert len(asyncio.run(library_api(client).get_library())) == 3
+    assert client.requests == []
+
+
+def test_stale_cache_only_fetches_the_books_bought_since_the_last_sync(artifacts_dir):
+    asyncio.run(library_api(LibraryClient(3, audible_api.LIBRARY_PAGE_SIZE)).get_library())
+    cache = LibraryCache("me", "us")
+    cache.data["synced_at"] -= LIBRARY_CACHE_TTL + 1
+    cache.save()
+    client = LibraryClient(4, audible_api.LIBRARY_PAGE_SIZE)
+
+    library = asyncio.run(library_api(client).get_library())
+
+    assert client.requests[0]["purchased_after"] == cache.synced_at_iso
+    # New purchases go first, like in the Audible library
+    assert library == ["B000000003", "B000000000", "B000000001", "B000000002"]
+    cache = LibraryCache("me", "us")
+    assert cache.is_fresh()
+    assert asins(cache.pop_new_items()) == ["B000000003"]
+    assert cache.pop_new_items() == []
+
+
+def test_book_infos_expire_with_the_ttl(artifacts_dir):
+    cache = LibraryCache("me", "us", ttl=60)
+    cache.set_book_info("B1", {"title": "Book"})
+    assert cache.get_book_info("B1") == {"title": "Book"}
+
+    cache.data["book_infos"]["B1"]["fetched_at"] -= 61
+    assert cache.get_book_info("B1") is None
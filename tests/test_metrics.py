@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+import metrics
+from metrics import Metrics, progress_printer
+
+
+def recorded_metrics():
+    recorded = Metrics()
+    with recorded.span("export", target="readwise") as export_span:
+        export_span.add(items=3)
+    with recorded.span("download", bytes=100, items=1):
+        pass
+    with recorded.span("download", bytes=50, items=1) as download_span:
+        download_span.ok = False
+    with pytest.raises(ValueError):
+        with recorded.span("custom"):
+            raise ValueError("broken")
+    return recorded
+
+
+def test_summary_adds_up_the_spans_of_each_stage_in_stage_order():
+    summary = recorded_metrics().summary()
+
+    assert list(summary) == ["download", "export", "custom"]
+    assert summary["download"]["spans"] == 2
+    assert summary["download"]["errors"] == 1
+    assert summary["download"]["bytes"] == 150
+    assert summary["export"]["items"] == 3
+    assert summary["custom"]["errors"] == 1
+
+
+def test_jsonl_appends_every_span_with_its_labels(tmp_path):
+    path = str(tmp_path / "spans.jsonl")
+    recorded = recorded_metrics()
+
+    recorded.write_jsonl("sync", path)
+    recorded.write_jsonl("sync", path)
+
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 8
+    assert lines[0]["command"] == "sync"
+    assert lines[0]["stage"] == "export" and lines[0]["target"] == "readwise" and lines[0]["ok"]
+    assert lines[0]["run_started_at"] == recorded.started_at
+
+
+def test_prometheus_textfile_has_a_gauge_per_stage(tmp_path):
+    path = str(tmp_path / "sync.prom")
+
+    recorded_metrics().write_prometheus("readwise post", path)
+
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'audibleextractor_stage_bytes{command="readwise_post",stage="download"} 150' in lines
+    assert 'audibleextractor_stage_errors{command="readwise_post",stage="custom"} 1' in lines
+    assert "# TYPE audibleextractor_stage_seconds gauge" in lines
+    assert any(line.startswith('audibleextractor_run_seconds{command="readwise_post"}') for line in lines)
+    assert not (tmp_path / "sync.prom.tmp").exists()
+
+
+def test_report_writes_the_configured_exports(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+
+    recorded_metrics().report("sync", exports="jsonl, prometheus,csv")
+
+    out = capsys.readouterr().out
+    assert "Metrics for sync" in out
+    assert "Unknown metrics export csv" in out
+    assert (tmp_path / "spans.jsonl").exists()
+    assert (tmp_path / "sync.prom").exists()
+
+
+def test_report_is_quiet_without_spans(capsys):
+    Metrics().report("sync", exports="jsonl")
+
+    assert capsys.readouterr().out == ""
+
+
+def test_progress_is_printed_every_ten_percent(capsys):
+    on_progress = progress_printer("book", 1000)
+    for done in [0, 50, 100, 150, 990, 1000]:
+        on_progress(done)
+
+    assert capsys.readouterr().out.splitlines() == ["book: 0%", "book: 10%", "book: 90%", "book: 100%"]
+
+    on_fraction = progress_printer("book")
+    on_fraction(0.55)
+    assert capsys.readouterr().out == "book: 50%\n"
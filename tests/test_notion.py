@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import httpx
+
+from notion import NotionExporter
+
+
+class NotionServer:
+    def __init__(self):
+        self.pages = []
+        self.appended = []
+
+    def handle(self, request):
+        payload = json.loads(request.content)
+        if request.url.path == "/v1/pages":
+            self.pages.append(payload)
+            return httpx.Response(200, json={"id": f"page-{len(self.pages)}"})
+        self.appended.extend(payload["children"])
+        return httpx.Response(200, json={})
+
+
+def export(server, highlights, **kwargs):
+    exporter = NotionExporter("token", "database", rate=0, **kwargs)
+    exporter._client = httpx.AsyncClient(base_url="https://api.notion.com/v1",
+                                         transport=httpx.MockTransport(server.handle))
+
+    async def run():
+        try:
+            return await exporter.export_book("Title", "Author", highlights)
+        finally:
+            await exporter.close()
+    return asyncio.run(run())
+
+
+def highlight(text, note=None):
+    return {"title": "Title", "author": "Author", "note": note, "text": text}
+
+
+def test_page_only_has_the_title_unless_an_author_property_is_named(artifacts_dir):
+    server = NotionServer()
+    export(server, [highlight("one")])
+
+    assert server.pages[0]["properties"] == {"Heading": {"title": [{"type": "text", "text": {"content": "Title"}}]}}
+
+
+def test_title_and_author_properties_can_be_named(artifacts_dir):
+    server = NotionServer()
+    export(server, [highlight("one")], title_property="Name", author_property="Writer")
+
+    properties = server.pages[0]["properties"]
+    assert list(properties) == ["Name", "Writer"]
+    assert properties["Writer"]["rich_text"][0]["text"]["content"] == "Author"
+
+
+def test_only_new_highlights_are_appended(artifacts_dir):
+    server = NotionServer()
+    assert export(server, [highlight("one", note="Chapter one")]) == 1
+    assert export(server, [highlight("one", note="Chapter one"), highlight("two")]) == 1
+
+    assert len(server.pages) == 1
+    assert [block["type"] for block in server.appended] == ["heading_3", "quote", "quote"]
+
+
+def test_from_env_reads_the_properties(monkeypatch):
+    monkeypatch.setenv("NOTION_TOKEN", "token")
+    monkeypatch.setenv("NOTION_AUTHOR_PROPERTY", "Author")
+
+    exporter = NotionExporter.from_env("database", title_property="Name")
+
+    assert (exporter.title_property, exporter.author_property) == ("Name", "Author")
+    assert NotionExporter.from_env("database").title_property == "Heading"
@@ -0,0 +1,121 @@
+import asyncio
+
+from pipeline import Pipeline, Stage
+
+
+def run(pipeline, items):
+    return asyncio.run(pipeline.run(items))
+
+
+def test_items_go_through_every_stage():
+    results = []
+
+    async def double(batch):
+        return [item * 2 for item in batch]
+
+    async def collect(batch):
+        results.extend(batch)
+
+    counts = run(Pipeline([Stage("double", double, workers=3), Stage("collect", collect)]), range(10))
+
+    assert sorted(results) == [item * 2 for item in range(10)]
+    assert counts == {"double": 10, "collect": 10}
+
+
+def test_batches_never_exceed_the_batch_size():
+    batch_sizes = []
+
+    async def slow(batch):
+        await asyncio.sleep(0.01)
+        return batch
+
+    async def record(batch):
+        batch_sizes.append(len(batch))
+        await asyncio.sleep(0.01)
+
+    run(Pipeline([Stage("slow", slow, workers=4), Stage("record", record, batch_size=3)]), range(20))
+
+    assert sum(batch_sizes) == 20
+    assert max(batch_sizes) <= 3
+
+
+def test_a_failing_batch_does_not_stall_the_pipeline(capsys):
+    results = []
+
+    async def flaky(batch):
+        if batch == [3]:
+            raise ValueError("bad item")
+        return batch
+
+    async def collect(batch):
+        results.extend(batch)
+
+    counts = run(Pipeline([Stage("flaky", flaky), Stage("collect", collect)]), range(6))
+
+    assert sorted(results) == [0, 1, 2, 4, 5]
+    assert counts == {"flaky": 5, "collect": 5}
+    assert "flaky failed for 1 items: bad item" in capsys.readouterr().out
+
+
+def test_stages_may_filter_items():
+    results = []
+
+    async def evens(batch):
+        return [item for item in batch if item % 2 == 0]
+
+    async def collect(batch):
+        results.extend(batch)
+
+    run(Pipeline([Stage("evens", evens), Stage("collect", collect)], queue_size=1), range(10))
+
+    assert sorted(results) == [0, 2, 4, 6, 8]
+
+
+def test_empty_input():
+    async def never(batch):
+        raise AssertionError("no items")
+
+    assert run(Pipeline([Stage("never", never)]), []) == {"never": 0}
+
+
+def test_batches_fill_up_while_items_trickle_in():
+    batch_sizes = []
+
+    async def trickle(batch):
+        await asyncio.sleep(0.005)
+        return batch
+
+    async def post(batch):
+        batch_sizes.append(len(batch))
+
+    run(Pipeline([Stage("trickle", trickle), Stage("post", post, batch_size=10, linger=5)]), range(25))
+
+    assert batch_sizes == [10, 10, 5]
+
+
+def test_a_partial_batch_is_handed_over_after_the_linger():
+    batch_sizes = []
+
+    async def slow(batch):
+        await asyncio.sleep(0.1)
+        return batch
+
+    async def post(batch):
+        batch_sizes.append(len(batch))
+
+    run(Pipeline([Stage("slow", slow), Stage("post", post, batch_size=10, linger=0.01)]), range(3))
+
+    assert batch_sizes == [1, 1, 1]
+
+
+def test_the_last_batch_does_not_wait_out_the_linger():
+    async def post(batch):
+        pass
+
+    async def timed():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await Pipeline([Stage("post", post, batch_size=10, linger=30)]).run(range(3))
+        return loop.time() - started
+
+    assert asyncio.run(timed()) < 1
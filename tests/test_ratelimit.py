@@ -0,0 +1,104 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ratelimit import HostRateLimiter, RateLimiter, RequestError, send_with_retries
+
+
+class Responses:
+    """Answers each attempt with the next of the given responses, exceptions are raised instead"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.attempts = 0
+
+    async def send(self):
+        self.attempts += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def send(responses, rate_limiter=None, retries=3):
+    return asyncio.run(send_with_retries(responses.send, rate_limiter or RateLimiter(0), retries, 0.01, "Test"))
+
+
+def test_ok_response_is_returned():
+    responses = Responses(httpx.Response(200, json={"ok": True}))
+
+    assert send(responses).json() == {"ok": True}
+    assert responses.attempts == 1
+
+
+def test_server_errors_and_network_errors_are_retried(capsys):
+    responses = Responses(httpx.Response(503, text="busy"), httpx.ConnectError("refused"), httpx.Response(200))
+
+    assert send(responses).status_code == 200
+    assert responses.attempts == 3
+    assert "Test error: 503 busy, retrying" in capsys.readouterr().out
+
+
+def test_client_errors_are_not_retried():
+    responses = Responses(httpx.Response(400, text="bad highlight"), httpx.Response(200))
+
+    with pytest.raises(RequestError, match="400 bad highlight"):
+        send(responses)
+    assert responses.attempts == 1
+
+
+def test_the_last_error_is_raised_once_the_retries_run_out():
+    responses = Responses(*[httpx.Response(500, text="down")] * 3)
+
+    with pytest.raises(RequestError, match="500 down"):
+        send(responses, retries=2)
+    assert responses.attempts == 3
+
+
+def test_retry_after_pauses_the_rate_limiter():
+    responses = Responses(httpx.Response(429, headers={"Retry-After": "1"}), httpx.Response(200))
+
+    async def timed():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await send_with_retries(responses.send, RateLimiter(0), 3, 0.01, "Test")
+        return loop.time() - started
+
+    # Without the Retry-After the backoff would have retried after 0.01s
+    assert asyncio.run(timed()) >= 1
+
+
+def test_rate_limiter_spaces_requests_out():
+    async def start_times():
+        loop = asyncio.get_running_loop()
+        limiter = RateLimiter(20)
+        times = []
+
+        async def request():
+            await limiter.wait()
+            times.append(loop.time())
+        await asyncio.gather(*[request() for _ in range(5)])
+        return times
+
+    times = sorted(asyncio.run(start_times()))
+    assert all(later - earlier >= 0.04 for earlier, later in zip(times, times[1:]))
+
+
+def test_pause_holds_back_the_next_request():
+    async def waited():
+        loop = asyncio.get_running_loop()
+        limiter = RateLimiter(1000)
+        limiter.pause(0.2)
+        started = loop.time()
+        await limiter.wait()
+        return loop.time() - started
+
+    assert asyncio.run(waited()) >= 0.19
+
+
+def test_hosts_have_their_own_limiter():
+    limiter = HostRateLimiter(1)
+
+    assert limiter.for_url("https://readwise.io/api/v2/highlights/") is limiter.for_url("https://readwise.io/other")
+    assert limiter.for_url("https://readwise.io/") is not limiter.for_url("https://api.notion.com/")
@@ -0,0 +1,47 @@
+from audible_api import AudibleAPI
+
+
+def library_api():
+    api = AudibleAPI(None)
+    api.library = {"items": [
+        {"asin": "A1", "title": "The Pragmatic Programmer", "authors": [{"name": "David Thomas"}, {"name": "Andrew Hunt"}]},
+        {"asin": "A2", "title": "Deep Work", "authors": [{"name": "Cal Newport"}]},
+        {"asin": "A3", "title": "Digital Minimalism", "authors": [{"name": "Cal Newport"}]}
+    ]}
+    return api
+
+
+def asins(books):
+    return [book["asin"] for book in books]
+
+
+def test_select_all():
+    api = library_api()
+    assert asins(api.select_books("all")) == ["A1", "A2", "A3"]
+    assert asins(api.select_books("")) == ["A1", "A2", "A3"]
+
+
+def test_select_by_asin_keeps_the_given_order():
+    assert asins(library_api().select_books("A3, A1")) == ["A3", "A1"]
+    assert asins(library_api().select_books(["A2"])) == ["A2"]
+
+
+def test_select_skips_asins_missing_from_the_library(capsys):
+    assert asins(library_api().select_books("A2,B9")) == ["A2"]
+    assert "B9" in capsys.readouterr().out
+
+
+def test_select_by_title_and_author():
+    api = library_api()
+    assert asins(api.select_books("title:deep")) == ["A2"]
+    assert asins(api.select_books("author:newport")) == ["A2", "A3"]
+    assert asins(api.select_books("author:nobody")) == []
+
+
+def test_selected_books_carry_their_authors():
+    api = library_api()
+    book = api.select_books("A1")[0]
+
+    assert book["title"] == "The Pragmatic Programmer"
+    assert api.get_book_authors(book) == "David Thomas, Andrew Hunt"
+    assert api.get_book_authors({"title": "No authors", "asin": "A4"}) == "Unknown Author"
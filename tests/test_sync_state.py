@@ -0,0 +1,214 @@
+import json
+import os
+
+from sync_state import HIGHLIGHT_SOURCE_TYPE, SyncState
+
+
+def clip(name, window, note=""):
+    return {"clip": name, "window": window, "note": note, "cache_key": f"key-{name}"}
+
+
+def write_clip(state, name):
+    clips_dir_path = os.path.join(state.title_dir_path, "clips")
+    os.makedirs(clips_dir_path, exist_ok=True)
+    with open(os.path.join(clips_dir_path, name), "wb") as f:
+        f.write(b"flac")
+
+
+def sliced_state(tmp_path, clips):
+    """A state that already sliced and wrote every clip"""
+    state = SyncState(str(tmp_path))
+    for key, value in clips.items():
+        state.mark_sliced(key, value)
+        write_clip(state, value["clip"])
+    return state
+
+
+def test_plan_slices_new_records(tmp_path):
+    state = SyncState(str(tmp_path))
+    clips = {"a": clip("clip_1.flac", [0, 10]), "b": clip("clip_2.flac", [20, 30])}
+
+    to_slice, removed = state.plan(clips)
+
+    assert sorted(to_slice) == ["a", "b"]
+    assert removed == []
+
+
+def test_plan_skips_sliced_records(tmp_path):
+    clips = {"a": clip("clip_1.flac", [0, 10])}
+    state = sliced_state(tmp_path, clips)
+
+    assert state.plan(clips) == ([], [])
+
+
+def test_plan_slices_again_when_the_clip_file_is_missing(tmp_path):
+    clips = {"a": clip("clip_1.flac", [0, 10])}
+    state = sliced_state(tmp_path, clips)
+    os.remove(os.path.join(str(tmp_path), "clips", "clip_1.flac"))
+
+    assert state.plan(clips) == (["a"], [])
+
+
+def test_plan_moved_window_removes_the_stale_clip(tmp_path):
+    state = sliced_state(tmp_path, {"a": clip("clip_1.flac", [0, 10])})
+
+    to_slice, removed = state.plan({"a": clip("clip_5.flac", [50, 60])})
+
+    assert to_slice == ["a"]
+    assert removed == []
+    assert not os.path.exists(os.path.join(str(tmp_path), "clips", "clip_1.flac"))
+
+
+def test_plan_renames_the_clip_when_the_note_changed(tmp_path):
+    state = sliced_state(tmp_path, {"a": clip("clip_1.flac", [0, 10])})
+    state.records["a"]["text"] = "transcribed"
+    state.records["a"]["exported"] = True
+
+    to_slice, removed = state.plan({"a": clip("clip_1_note.flac", [0, 10], note="note")})
+
+    assert (to_slice, removed) == ([], [])
+    entry = state.records["a"]
+    assert entry["clip"] == "clip_1_note.flac"
+    assert entry["note"] == "note"
+    assert entry["text"] == "transcribed"
+    # The note is part of the highlight, so it has to be exported again
+    assert entry["exported"] is False
+    assert sorted(os.listdir(os.path.join(str(tmp_path), "clips"))) == ["clip_1_note.flac"]
+
+
+def test_plan_returns_records_deleted_on_audible(tmp_path):
+    state = sliced_state(tmp_path, {"a": clip("clip_1.flac", [0, 10]), "b": clip("clip_2.flac", [20, 30])})
+
+    to_slice, removed = state.plan({"a": clip("clip_1.flac", [0, 10])})
+
+    assert to_slice == []
+    assert [entry["clip"] for entry in removed] == ["clip_2.flac"]
+    assert list(state.records) == ["a"]
+
+
+def test_plan_without_require_files_skips_transcribed_records(tmp_path):
+    clips = {"a": clip("clip_1.flac", [0, 10]), "b": clip("clip_2.flac", [20, 30])}
+    state = SyncState(str(tmp_path))
+    state.mark_planned(clips, list(clips))
+    state.records["a"]["text"] = "transcribed"
+
+    assert state.plan(clips, require_files=False) == (["b"], [])
+    assert sorted(state.plan(clips, require_files=True)[0]) == ["a", "b"]
+
+
+def test_mark_planned_keeps_the_text_of_unchanged_records(tmp_path):
+    clips = {"a": clip("clip_1.flac", [0, 10])}
+    state = SyncState(str(tmp_path))
+    state.mark_planned(clips, ["a"])
+    state.records["a"]["text"] = "transcribed"
+
+    state.mark_planned(clips, ["a"])
+    assert state.records["a"]["text"] == "transcribed"
+
+    state.mark_planned({"a": clip("clip_5.flac", [50, 60])}, ["a"])
+    assert state.records["a"]["text"] is None
+
+
+def test_state_survives_a_reload(tmp_path):
+    state = sliced_state(tmp_path, {"a": clip("clip_1.flac", [0, 10])})
+    state.set_book("Title", "Author")
+    state.save()
+
+    reloaded = SyncState(str(tmp_path))
+    assert reloaded.records == state.records
+    assert reloaded.data["author"] == "Author"
+
+
+def legacy_book(tmp_path, file_names, highlights):
+    """A book transcribed before sync_state.json existed, clips/ and contents.json only"""
+    for name in file_names:
+        write_clip(SyncState(str(tmp_path)), name)
+    transcribed_clips_dir_path = os.path.join(str(tmp_path), "trancribed_clips")
+    os.makedirs(transcribed_clips_dir_path, exist_ok=True)
+    with open(os.path.join(transcribed_clips_dir_path, "contents.json"), "w") as f:
+        json.dump(highlights, f)
+
+
+def legacy_highlight(text, note=None):
+    highlight = {"title": "Title", "author": "Author"}
+    if note:
+        highlight["note"] = note
+    highlight["source_type"] = HIGHLIGHT_SOURCE_TYPE
+    highlight["text"] = text
+    return highlight
+
+
+def test_legacy_clips_and_contents_are_imported(tmp_path):
+    legacy_book(tmp_path, ["clip1.flac", "Chapter one.flac"],
+                [legacy_highlight("first"), legacy_highlight("noted", note="Chapter one")])
+
+    state = SyncState(str(tmp_path))
+
+    assert not state.tracked
+    assert {entry["clip"]: entry["text"] for entry in state.records.values()} == {
+        "clip1.flac": "first", "Chapter one.flac": "noted"}
+    assert state.untranscribed() == []
+    assert sorted(h["text"] for h in state.highlights()) == ["first", "noted"]
+    assert state.data["author"] == "Author"
+
+
+def test_legacy_clips_without_contents_get_transcribed(tmp_path):
+    legacy_book(tmp_path, ["clip1.flac", "clip2.flac"], [])
+
+    state = SyncState(str(tmp_path))
+
+    assert sorted(entry["clip"] for _, entry in state.untranscribed()) == ["clip1.flac", "clip2.flac"]
+    state.remove_untracked_clips()
+    assert sorted(os.listdir(os.path.join(str(tmp_path), "clips"))) == ["clip1.flac", "clip2.flac"]
+
+
+def test_unmatched_legacy_highlights_are_kept(tmp_path):
+    # Two clips but one highlight, one of them failed so neither can be matched to the text
+    legacy_book(tmp_path, ["clip1.flac", "clip2.flac"], [legacy_highlight("only one")])
+
+    state = SyncState(str(tmp_path))
+
+    assert [h["text"] for h in state.highlights()] == ["only one"]
+    assert state.untranscribed() == []
+
+
+def test_write_contents_keeps_legacy_highlights(tmp_path):
+    highlights = [legacy_highlight("first"), legacy_highlight("second")]
+    legacy_book(tmp_path, [], highlights)
+
+    SyncState(str(tmp_path)).write_contents()
+
+    with open(os.path.join(str(tmp_path), "trancribed_clips", "contents.json")) as f:
+        assert json.load(f) == highlights
+
+
+def test_write_contents_skips_a_book_with_nothing_to_write(tmp_path):
+    SyncState(str(tmp_path)).write_contents()
+    assert not os.path.exists(os.path.join(str(tmp_path), "trancribed_clips", "contents.json"))
+
+
+def test_plan_keeps_the_text_of_a_legacy_clip_with_the_same_note(tmp_path):
+    legacy_book(tmp_path, ["clip1.flac", "Chapter one.flac"],
+                [legacy_highlight("first"), legacy_highlight("noted", note="Chapter one")])
+    state = SyncState(str(tmp_path))
+
+    to_slice, removed = state.plan({"a": clip("Chapter one.flac", [0, 10], note="Chapter one"),
+                                    "b": clip("clip_20.flac", [20, 30])})
+
+    assert to_slice == ["b"]
+    assert [entry["clip"] for entry in removed] == ["clip1.flac"]
+    assert state.records["a"]["text"] == "noted"
+    assert state.records["a"]["window"] == [0, 10]
+
+
+def test_checkpoint_saves_every_few_clips(tmp_path, monkeypatch):
+    monkeypatch.setattr("sync_state.CHECKPOINT_CLIPS", 3)
+    monkeypatch.setattr("sync_state.CHECKPOINT_INTERVAL", 3600)
+    state = SyncState(str(tmp_path))
+
+    state.checkpoint()
+    state.checkpoint()
+    assert not os.path.exists(state.path)
+    state.checkpoint()
+    assert os.path.exists(state.path)
+    assert state.unsaved == 0
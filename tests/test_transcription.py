@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+import speech_recognition as sr
+
+from transcription import TranscriptionBackend, TranscriptionPool
+
+
+class FakeAudio:
+    def __init__(self, text):
+        self.frame_data = text.encode()
+
+
+class EchoBackend(TranscriptionBackend):
+    """Hands back the text each audio was made from, failing the first `failures` batches"""
+
+    name = "echo"
+
+    def __init__(self, batch_size=1, failures=0):
+        self.batch_size = batch_size
+        self.failures = failures
+        self.batches = []
+
+    def transcribe_batch(self, audios):
+        self.batches.append(len(audios))
+        if self.failures:
+            self.failures -= 1
+            raise sr.RequestError("quota exceeded")
+        return [audio.frame_data.decode() for audio in audios]
+
+
+def job(text, delay=0):
+    def load():
+        import time
+        time.sleep(delay)
+        return FakeAudio(text)
+    return load
+
+
+def broken_job():
+    raise OSError("clip is not a flac file")
+
+
+def run(pool, jobs, on_result=None):
+    return asyncio.run(pool.run(jobs, on_result))
+
+
+def test_results_come_back_in_job_order():
+    # Early clips load slowest, so their batches finish last
+    jobs = [job(f"clip {index}", delay=0.01 * (6 - index)) for index in range(6)]
+    done = []
+
+    results = run(TranscriptionPool(EchoBackend(batch_size=2), workers=3), jobs,
+                  lambda index, result: done.append(index))
+
+    assert results == [f"clip {index}" for index in range(6)]
+    assert sorted(done) == list(range(6))
+    assert done != list(range(6))
+
+
+def test_batches_hold_at_most_the_batch_size():
+    backend = EchoBackend(batch_size=4)
+
+    run(TranscriptionPool(backend), [job(str(index)) for index in range(10)])
+
+    assert sorted(backend.batches) == [2, 4, 4]
+
+
+def test_recognizer_errors_are_retried(capsys):
+    backend = EchoBackend(failures=2)
+
+    assert run(TranscriptionPool(backend, retries=2, backoff=0.001), [job("hello")]) == ["hello"]
+    assert backend.batches == [1, 1, 1]
+    assert "Recognizer error: quota exceeded, retrying" in capsys.readouterr().out
+
+
+def test_the_error_is_returned_once_the_retries_run_out():
+    backend = EchoBackend(failures=3)
+
+    [result] = run(TranscriptionPool(backend, retries=1, backoff=0.001), [job("hello")])
+
+    assert isinstance(result, sr.RequestError)
+    assert backend.batches == [1, 1]
+
+
+def test_an_unreadable_clip_fails_on_its_own():
+    backend = EchoBackend(batch_size=3)
+
+    results = run(TranscriptionPool(backend), [job("a"), broken_job, job("c")])
+
+    assert results[0] == "a" and results[2] == "c"
+    assert isinstance(results[1], OSError)
+    assert backend.batches == [2]
+
+
+def test_workers_bound_the_batches_in_flight():
+    in_flight = []
+    running = 0
+
+    class CountingBackend(EchoBackend):
+        def transcribe_batch(self, audios):
+            nonlocal running
+            import time
+            running += 1
+            in_flight.append(running)
+            time.sleep(0.01)
+            running -= 1
+            return super().transcribe_batch(audios)
+
+    run(TranscriptionPool(CountingBackend(), workers=2), [job(str(index)) for index in range(8)])
+
+    assert max(in_flight) == 2
+
+
+@pytest.mark.parametrize("workers", [0, -1])
+def test_at_least_one_worker(workers):
+    assert run(TranscriptionPool(EchoBackend(), workers=workers), [job("a")]) == ["a"]
+
+
+def test_backends_must_implement_transcribe_batch():
+    class Incomplete(TranscriptionBackend):
+        name = "incomplete"
+
+    with pytest.raises(TypeError, match="transcribe_batch"):
+        Incomplete()
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+import os
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+from clips import read_clip_pcm
+from metrics import span
+
+# How many batches are sent to the recognizer at once, match it to the quota of the speech API
+TRANSCRIPTION_WORKERS = 4
+
+# Transient recognizer failures (network, quota) are retried this many times, waiting BACKOFF * 2^attempt seconds
+TRANSCRIPTION_RETRIES = 3
+TRANSCRIPTION_BACKOFF = 2.0
+
+DEFAULT_TRANSCRIPTION_BACKEND = "google"
+
+
+def load_clip(clip_path):
+    import speech_recognition as sr
+    r = sr.Recognizer()
+    with sr.AudioFile(clip_path) as source:
+        return r.record(source)
+
+
+# Bytes per sample of the PCM handed to the recognizer, signed 16 bit
+PCM_SAMPLE_WIDTH = 2
+
+
+def pcm_loader(source_path, window, input_args=(), sample_rate=16000):
+    """A TranscriptionPool job that slices the window straight into memory instead of reading a clip file"""
+    def load():
+        import speech_recognition as sr
+        try:
+            with span("slice", items=1) as slice_span:
+                pcm = read_clip_pcm(source_path, *window, input_args=input_args, sample_rate=sample_rate)
+                slice_span.add(bytes=len(pcm))
+        except subprocess.CalledProcessError as e:
+            raise OSError(e.stderr.decode(errors="replace").strip() or str(e))
+        return sr.AudioData(pcm, sample_rate, PCM_SAMPLE_WIDTH)
+    return load
+
+
+class TranscriptionBackend(ABC):
+    """A speech engine behind transcribe_bookmarks. Subclasses set name, the key get_backend knows them by,
+    and implement transcribe_batch. Register them in TRANSCRIPTION_BACKENDS"""
+
+    name = None
+    # How many clips are handed to transcribe_batch at once
+    batch_size = 1
+    # Mono sample rate in memory clips are decoded at, 16kHz is what speech models are trained on
+    sample_rate = 16000
+
+    @abstractmethod
+    def transcribe_batch(self, audios):
+        """Runs in a worker thread, audios are speech_recognition.AudioData. Returns one text per audio in the
+        same order, "" when there is no intelligible speech. speech_recognition.RequestError is retried by
+        the pool, any other exception fails the whole batch"""
+
+    def close(self):
+        """Frees what the backend holds, i.e worker processes, once every batch is done"""
+
+
+class GoogleBackend(TranscriptionBackend):
+    """Free Google Web Speech API, one rate limited request per clip"""
+
+    name = "google"
+
+    def transcribe_batch(self, audios):
+        import speech_recognition as sr
+        r = sr.Recognizer()
+        texts = []
+        for audio in audios:
+            try:
+                texts.append(r.recognize_google(audio))
+            except sr.UnknownValueError:
+                texts.append("")
+        return texts
+
+
+def recognize_sphinx(audio):
+    import speech_recognition as sr
+    try:
+        return sr.Recognizer().recognize_sphinx(audio)
+    except sr.UnknownValueError:
+        return ""
+
+
+class SphinxBackend(TranscriptionBackend):
+    """Offline CMU Sphinx engine, batches are spread over a process per CPU core.
+    Needs the optional pocketsphinx package (pip install pocketsphinx)"""
+
+    name = "sphinx"
+
+    def __init__(self, processes=None):
+        try:
+            import pocketsphinx  # noqa: F401
+        except ImportError:
+            raise ValueError("The sphinx backend needs pocketsphinx, install it with: pip install pocketsphinx")
+
+        self.processes = processes or os.cpu_count() or 1
+        self.batch_size = self.processes * 2
+        self.executor = ProcessPoolExecutor(max_workers=self.processes)
+
+    def transcribe_batch(self, audios):
+        return list(self.executor.map(recognize_sphinx, audios))
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class StubBackend(TranscriptionBackend):
+    """Deterministic, instant engine for tests and benchmarks, the text only depends on the audio"""
+
+    name = "stub"
+    batch_size = 32
+
+    def transcribe_batch(self, audios):
+        texts = []
+        for audio in audios:
+            digest = hashlib.sha1(audio.frame_data).hexdigest()[:8]
+            seconds = len(audio.frame_data) / (audio.sample_rate * audio.sample_width)
+            texts.append(f"stub transcription {digest} {seconds:.1f}s")
+        return texts
+
+
+TRANSCRIPTION_BACKENDS = {
+    GoogleBackend.name: GoogleBackend,
+    SphinxBackend.name: SphinxBackend,
+    StubBackend.name: StubBackend
+}
+
+
+def get_backend(name=DEFAULT_TRANSCRIPTION_BACKEND):
+    if name not in TRANSCRIPTION_BACKENDS:
+        raise ValueError(f"Unknown transcription backend {name}, choose from: {', '.join(TRANSCRIPTION_BACKENDS)}")
+    return TRANSCRIPTION_BACKENDS[name]()
+
+
+class TranscriptionPool:
+    """Transcribes clips of any number of books in batches, with a bounded number of batches in flight"""
+
+    def __init__(self, backend=None, workers=TRANSCRIPTION_WORKERS, retries=TRANSCRIPTION_RETRIES,
+                 backoff=TRANSCRIPTION_BACKOFF):
+        self.backend = backend or get_backend()
+        self.semaphore = asyncio.Semaphore(max(1, int(workers)))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+
+    async def transcribe_batch(self, audios):
+        import speech_recognition as sr
+        for attempt in range(self.retries + 1):
+            try:
+                with span("recognize", items=len(audios), bytes=sum(len(audio.frame_data) for audio in audios),
+                          backend=self.backend.name):
+                    return await asyncio.to_thread(self.backend.transcribe_batch, audios)
+            except sr.RequestError as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                print(f"Recognizer error: {e}, retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+
+    async def run(self, jobs, on_result=None):
+        """jobs is a list of clip paths or pcm_loader callables, returns the text (or the exception) for every
+        job in job order.
+        on_result(index, result) is called as soon as each clip is done, i.e to checkpoint progress"""
+        results = [None] * len(jobs)
+        batch_size = max(1, self.backend.batch_size)
+
+        def load(index):
+            try:
+                job = jobs[index]
+                return job() if callable(job) else load_clip(job)
+            except Exception as e:
+                return e
+
+        async def run_batch(start):
+            # Clips are only decoded once the batch gets a worker, so memory holds at most `workers` batches
+            async with self.semaphore:
+                batch = {}
+                for index in range(start, min(start + batch_size, len(jobs))):
+                    batch[index] = await asyncio.to_thread(load, index)
+
+                # A clip that can't be read fails on its own, the rest of the batch still goes to the recognizer
+                loaded = [index for index, audio in batch.items() if not isinstance(audio, Exception)]
+                try:
+                    texts = await self.transcribe_batch([batch[index] for index in loaded]) if loaded else []
+                    batch.update(zip(loaded, texts))
+                except Exception as e:
+                    batch.update((index, e) for index in loaded)
+
+            for index, result in batch.items():
+                results[index] = result
+                if on_result:
+                    on_result(index, result)
+
+        await asyncio.gather(*[run_batch(start) for start in range(0, len(jobs), batch_size)])
+        return results